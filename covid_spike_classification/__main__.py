@@ -3,26 +3,77 @@
 import argparse
 import datetime
 import os
-import shutil
-import tempfile
+import re
+import sqlite3
+import sys
 
 from .config import CSCConfig
+from .index import default_index_dir
 
-from .core import (
-    basecall,
-    map_reads,
-    check_variants
-)
+# options watch mode doesn't support, with the reason where it isn't obvious
+WATCH_CONFLICTS = {
+    "batch_calling": "",
+    "group_pattern": "",
+    "lineages": "",
+    "metrics": "",
+    "profile": "",
+    "prometheus": "",
+    "resume": ", watch mode keeps its own ledger",
+    "shard": "",
+    "store": "",
+    "triage": "",
+    "zip_results": ", results are appended to per-run files",
+}
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("reads",
-                        help="A zip file or directory containing the ab1 files to call variants on.")
+def parse_shard(value):
+    """Parse a shard given as i/N into an (i, N) tuple."""
+    index, _, count = value.partition("/")
+    try:
+        shard = (int(index), int(count))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, expected i/N like 1/4") from None
+    if not 1 <= shard[0] <= shard[1]:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, i needs to be between 1 and N")
+    return shard
+
+
+def parse_args(argv=None):
+    """Parse and check the command line arguments, argv defaults to sys.argv."""
+    parser = argparse.ArgumentParser(epilog="Use 'covid-spike-classification merge --help' for merging the "
+                                            "outputs of --shard runs, 'covid-spike-classification serve "
+                                            "--help' for classifying uploads over HTTP, and "
+                                            "'covid-spike-classification query --help' for exporting the "
+                                            "samples of a --store.")
+    parser.add_argument("reads", nargs="*",
+                        help="A zip file or directory containing the ab1 files to call variants on. With more than "
+                             "one, all plates are processed on one shared worker pool and each plate's results "
+                             "are written to <outdir>/<plate name>.")
+    parser.add_argument("--manifest",
+                        help="File listing plates to process like several reads arguments, one zip file or "
+                             "directory per line, optionally followed by a tab and the plate's output name.")
+    parser.add_argument("--combined", action="store_true", default=False,
+                        help="When processing several plates, also write all rows to <outdir>/results.csv, "
+                             "with the plate name as an extra first column.")
     parser.add_argument("-r", "--reference", default=os.path.join(os.getcwd(), "ref", "NC_045512.fasta"),
                         help="Reference FASTA file to use (default: %(default)s).")
+    parser.add_argument("--index-dir", default=os.environ.get("CSC_INDEX_DIR", default_index_dir()),
+                        help="Directory to build and cache reference indices in, unless bowtie2 and samtools "
+                             "indices already exist next to the reference (default: $CSC_INDEX_DIR if set, "
+                             "otherwise ~/.cache/covid-spike-classification/indices).")
+    parser.add_argument("--amplicon", action="store_true", default=False,
+                        help="Align reads against a sub-reference covering only the tracked codons plus "
+                             "--amplicon-margin bases on either side. Results are reported in full reference "
+                             "coordinates.")
+    parser.add_argument("--amplicon-margin", type=int, default=1000,
+                        help="Bases to add on either side of the tracked codons in --amplicon mode "
+                             "(default: %(default)s).")
     parser.add_argument("-i", "--input-format", choices=["ab1", "fasta", "fastq"], default="ab1",
                         help="Select which input format to expect. Choices: %(choices)s. default: %(default)s")
+    parser.add_argument("--basecaller", choices=["tracy", "native"], default="tracy",
+                        help="How to basecall ab1 files. tracy runs 'tracy basecall' on every file, native reads "
+                             "the basecalls and qualities the sequencer stored in the file in-process and trims "
+                             "low quality ends (default: %(default)s).")
     parser.add_argument("-o", "--outdir",
                         default=datetime.datetime.now().strftime("%Y-%m-%d"),
                         help="File to write result CSV and fastq files to (default: %(default)s).")
@@ -34,26 +85,199 @@ def main():
                         help="Debug mode: Keep bam file around when the parsing crashes")
     parser.add_argument("--show-unexpected", action="store_true", default=False,
                         help="Show unexpected mutations instead of reporting 'no known mutation'")
+    parser.add_argument("--scan", action="store_true", default=False,
+                        help="Call every spike codon the reads cover and list all amino acid substitutions "
+                             "found in an extra 'substitutions' column. Disables --fast-path.")
     parser.add_argument("--silence-warnings", action="store_true", default=False,
                         help="Silence D614G warnings.")
     parser.add_argument("-z", "--zip-results", action="store_true", default=False,
                         help="Create a zipfile from the output directory instead of the output directory.")
-    args = parser.parse_args()
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of samples to process in parallel (default: %(default)s).")
+    parser.add_argument("-t", "--threads", type=int, default=None,
+                        help="Total number of threads to use, split between parallel jobs and the tools they run "
+                             "(default: one thread per job).")
+    parser.add_argument("--pileup-engine", choices=["samtools", "native"], default="samtools",
+                        help="Engine to pile up reads at the tracked codons with. 'native' reads the alignments "
+                             "in-process instead of running samtools mpileup. Choices: %(choices)s. "
+                             "default: %(default)s")
+    parser.add_argument("--direct-sam", action="store_true", default=False,
+                        help="Call variants straight from bowtie2's SAM output using the native pileup engine, "
+                             "skipping bam file creation, sorting and indexing.")
+    parser.add_argument("--keep-bams", action="store_true", default=False,
+                        help="With --direct-sam, still write sorted and indexed bam files to <outdir>/bams "
+                             "for debugging.")
+    parser.add_argument("--no-fastqs", action="store_true", default=False,
+                        help="Don't write the basecalled fastq files of ab1 input to the output directory.")
+    parser.add_argument("--fast-path", action="store_true", default=False,
+                        help="Read the tracked codons straight from single-read inputs by anchoring flanking "
+                             "reference k-mers, only aligning reads where that fails. The comment column "
+                             "records which path each sample took.")
+    parser.add_argument("--group-pattern", metavar="REGEX",
+                        help="Group the input files of each sample, like forward and reverse reads, into one "
+                             "alignment and pileup that combines the evidence of all its reads, giving one row "
+                             "per sample. The regular expression is searched in the file names, its 'sample' "
+                             "group or else its first group names the sample, e.g. '^(.+)_[FR]\\.'. "
+                             "Files it doesn't match are processed on their own.")
+    parser.add_argument("--triage", action="store_true", default=False,
+                        help="Check the read length, base quality, N fraction and the tracked codons the reads "
+                             "span before aligning, and skip samples failing the thresholds below with the "
+                             "reason in the comment column. The statistics of all samples are written to "
+                             "triage.csv.")
+    parser.add_argument("--triage-min-length", type=int, default=100,
+                        help="Minimum length of the longest read after trimming ends below Phred 20 "
+                             "(default: %(default)s).")
+    parser.add_argument("--triage-min-quality", type=float, default=10,
+                        help="Minimum mean Phred quality of the trimmed reads (default: %(default)s).")
+    parser.add_argument("--triage-max-n", type=float, default=0.5,
+                        help="Maximum fraction of bases that aren't A, C, G or T (default: %(default)s).")
+    parser.add_argument("--triage-min-codons", type=int, default=1,
+                        help="Minimum number of tracked codons whose flanking reference k-mers are found in "
+                             "the reads (default: %(default)s).")
+    parser.add_argument("--batch-calling", action="store_true", default=False,
+                        help="Call the tracked mutations of all samples at once with NumPy once the whole plate "
+                             "is piled up, and write results.csv in one go. Needs numpy installed.")
+    parser.add_argument("--cache-dir", default=os.environ.get("CSC_CACHE_DIR"),
+                        help="Cache per-sample results in this directory and reuse them for unchanged input files "
+                             "(default: $CSC_CACHE_DIR if set, otherwise no cache).")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="Maximum size of the result cache in MB, least recently used results are "
+                             "evicted first (default: %(default)s).")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+                        help="Don't use the result cache, even if a cache directory is set.")
+    parser.add_argument("--refresh", action="store_true", default=False,
+                        help="Recompute all results and overwrite them in the result cache.")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Keep a journal of the finished stages of every sample in the output directory "
+                             "and, if it already has one, only do the work still missing. Samples that fail "
+                             "are logged and reported as failed instead of aborting the run, and are retried "
+                             "on the next --resume.")
+    parser.add_argument("--lineages", metavar="CSV",
+                        help="Assign each sample the best matching lineages of this table, with the columns "
+                             "lineage, required and optional listing space-separated tracked mutations, and "
+                             "add lineage and lineage_confidence columns to the results. NA calls count as "
+                             "unknown. See ref/lineages.csv.")
+    parser.add_argument("--store", metavar="DB",
+                        help="Also append every sample's calls, quality ratios, comment and input hash to this "
+                             "SQLite results store, shared by all runs. Samples already stored with the same "
+                             "input and settings are skipped. Query it with 'covid-spike-classification query'.")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="Only process the i-th of N shards of the input files, picked by a hash of the file "
+                             "names. Combine the outputs of all shards with 'covid-spike-classification merge'.")
+    parser.add_argument("--metrics", action="store_true", default=False,
+                        help="Write wall time, CPU time, peak memory and exit status of every pipeline stage and "
+                             "external tool run, overall and per sample, plus cache and failure counters to "
+                             "metrics.json next to results.csv.")
+    parser.add_argument("--prometheus", action="store_true", default=False,
+                        help="Also write the run totals of --metrics to metrics.prom in the Prometheus text "
+                             "format, for node_exporter's textfile collector. Implies --metrics.")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="Profile the Python side of the run with cProfile and write the stats to "
+                             "profile.pstats, e.g. for snakeviz or flameprof flamegraphs. Implies --metrics.")
+    parser.add_argument("-w", "--watch", metavar="DIR",
+                        help="Keep running and process new input files and zip files as they appear in DIR, "
+                             "appending to a results file per run in the output directory.")
+    parser.add_argument("--poll-interval", type=float, default=2.0,
+                        help="Seconds between checks of the watched directory (default: %(default)s).")
+    args = parser.parse_args(argv)
+
+    args.plates = [(reads, None) for reads in args.reads]
+    if args.manifest:
+        from . import plates
+        try:
+            args.plates.extend(plates.read_manifest(args.manifest))
+        except OSError as err:
+            parser.error(f"can't read --manifest: {err}")
+    multi_plate = len(args.plates) > 1 or args.manifest is not None
+    args.reads = None if multi_plate or not args.plates else args.plates[0][0]
+
+    if not args.plates and args.watch is None:
+        parser.error("either reads or --watch is required")
+    if args.plates and args.watch is not None:
+        parser.error("reads and --manifest can't be combined with --watch")
+    if args.combined and not multi_plate:
+        parser.error("--combined needs several plates")
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.threads is None:
+        args.threads = args.jobs
+
+    if args.watch:
+        check_watch_options(parser, args)
+
+    if args.group_pattern is not None:
+        try:
+            if re.compile(args.group_pattern).groups == 0:
+                parser.error("--group-pattern needs a group naming the sample")
+        except re.error as err:
+            parser.error(f"invalid --group-pattern: {err}")
+
+    if args.batch_calling:
+        if args.scan:
+            parser.error("--batch-calling can't be combined with --scan")
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            parser.error("--batch-calling needs numpy, install it with 'pip install numpy'")
 
+    return args
+
+
+def check_watch_options(parser, args):
+    """Reject the options watch mode doesn't support."""
+    for option, reason in WATCH_CONFLICTS.items():
+        if getattr(args, option):
+            parser.error(f"--{option.replace('_', '-')} can't be combined with --watch{reason}")
+
+
+def main():
+    # subcommands and modes only import what they use
+    if sys.argv[1:2] == ["merge"]:
+        from . import merge
+        merge.main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["serve"]:
+        from . import serve
+        serve.main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["query"]:
+        from . import store
+        store.main(sys.argv[2:])
+        return
+
+    args = parse_args()
     config = CSCConfig.from_args(args)
 
-    os.makedirs(args.outdir, exist_ok=True)
-
-    with tempfile.TemporaryDirectory() as tmpdir:
-        basecall(tmpdir, config)
-        map_reads(tmpdir, config)
-        check_variants(tmpdir, config)
-        if config.stdout:
-            outfile = open(os.path.join(config.outdir, "results.csv"), "r")
-            print(outfile.read())
-        if config.zip_results:
-            shutil.make_archive(config.outdir, "zip", root_dir=config.outdir)
-            shutil.rmtree(config.outdir, ignore_errors=True)
+    if config.watch:
+        from . import watch
+        os.makedirs(args.outdir, exist_ok=True)
+        watch.main(config, args.poll_interval)
+        return
+
+    # reads is only unset when several plates were given
+    if args.reads is None:
+        from . import plates
+        plates.main(config, args.plates, args.combined)
+        return
+
+    from .classifier import Classifier
+    from .journal import JournalError
+    from .lineage import LineageError
+    from .store import StoreError
+
+    with Classifier.from_config(config) as classifier:
+        try:
+            classifier.write_results()
+        except JournalError as err:
+            print(f"Can't resume: {err}", file=sys.stderr)
+            sys.exit(1)
+        except (StoreError, sqlite3.Error) as err:
+            print(f"Can't use the store: {err}", file=sys.stderr)
+            sys.exit(1)
+        except LineageError as err:
+            print(f"Can't read the lineage table: {err}", file=sys.stderr)
+            sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+"""Alignment-free codon calling by anchoring exact reference k-mers flanking each codon."""
+
+import functools
+
+from Bio.Seq import reverse_complement
+
+from .pileup import MIN_BASE_QUALITY, MAX_PRINTED_QUALITY, load_reference
+
+ANCHOR_LENGTH = 12
+# how far away from the codon an anchor may be placed to avoid other tracked codons
+MAX_ANCHOR_DISTANCE = 100
+# bowtie2 assigns this quality to all bases of FASTA input
+FASTA_QUALITY = 40
+
+
+class Anchor:
+    __slots__ = (
+        'codon_start',
+        'left',
+        'left_start',
+        'right',
+        'right_start',
+    )
+
+    def __init__(self, codon_start, left, left_start, right, right_start):
+        # all positions are 1-based reference coordinates
+        self.codon_start = codon_start
+        self.left = left
+        self.left_start = left_start
+        self.right = right
+        self.right_start = right_start
+
+    def locate(self, sequence):
+        """Find the 0-based offset of the codon in the sequence, or None if the anchors
+        are missing, ambiguous or inconsistent."""
+        left = _find_unique(sequence, self.left)
+        right = _find_unique(sequence, self.right)
+        if left is None or right is None:
+            return None
+        # insertions or deletions between the anchors shift the codon
+        if right - left != self.right_start - self.left_start:
+            return None
+        return left + self.codon_start - self.left_start
+
+
+def _find_unique(sequence, kmer):
+    first = sequence.find(kmer)
+    if first == -1 or sequence.find(kmer, first + 1) != -1:
+        return None
+    return first
+
+
+def _is_unique_anchor(genome, kmer):
+    return "N" not in kmer and len(kmer) == ANCHOR_LENGTH and _find_unique(genome, kmer) is not None
+
+
+def build_anchors(reference, regions):
+    """Pick a unique reference k-mer on either side of each codon region.
+
+    Anchors never overlap any of the tracked codons, so mutations in neighbouring
+    codons don't break them. Returns a dict of region: Anchor, or region: None
+    when no suitable anchors exist.
+    """
+    tracked = set()
+    parsed = {}
+    for region in regions:
+        chrom, coords = region.rsplit(":", 1)
+        start, end = (int(coord) for coord in coords.split("-"))
+        tracked.update((chrom, pos) for pos in range(start, end + 1))
+        parsed[region] = (chrom, start, end)
+
+    genomes = {}
+    anchors = {}
+    for region, (chrom, start, end) in parsed.items():
+        if chrom not in genomes:
+            genomes[chrom] = reference.fetch(chrom, 1, reference.entries[chrom][0]).upper()
+        genome = genomes[chrom]
+
+        def free(kmer_start):
+            return not any((chrom, pos) in tracked for pos in range(kmer_start, kmer_start + ANCHOR_LENGTH))
+
+        def kmer_at(kmer_start):
+            return genome[kmer_start - 1:kmer_start - 1 + ANCHOR_LENGTH]
+
+        left = right = None
+        for distance in range(MAX_ANCHOR_DISTANCE):
+            kmer_start = start - ANCHOR_LENGTH - distance
+            if kmer_start >= 1 and free(kmer_start) and _is_unique_anchor(genome, kmer_at(kmer_start)):
+                left = kmer_start
+                break
+        for distance in range(MAX_ANCHOR_DISTANCE):
+            kmer_start = end + 1 + distance
+            if free(kmer_start) and _is_unique_anchor(genome, kmer_at(kmer_start)):
+                right = kmer_start
+                break
+
+        if left is None or right is None:
+            anchors[region] = None
+        else:
+            anchors[region] = Anchor(start, kmer_at(left), left, kmer_at(right), right)
+    return anchors
+
+
+@functools.lru_cache(maxsize=None)
+def load_anchors(reference_path, regions):
+    """Build the anchors for a reference file once, regions must be a tuple."""
+    return build_anchors(load_reference(reference_path), regions)
+
+
+def anchored_columns(reference, anchors, sequence, qualities):
+    """Read the codon bases of all regions straight from a read.
+
+    Returns the same dict of region: [(reference base, read base, quality), ...] as
+    pileup.pileup_columns, or None if any codon can't be anchored unambiguously on
+    exactly one strand of the read.
+    """
+    sequence = sequence.upper()
+    strands = [(sequence, qualities, False), (reverse_complement(sequence), qualities[::-1], True)]
+    located = []
+    for strand_sequence, strand_qualities, is_reverse in strands:
+        offsets = {}
+        for region, anchor in anchors.items():
+            if anchor is None:
+                return None
+            offset = anchor.locate(strand_sequence)
+            if offset is not None:
+                offsets[region] = offset
+        if offsets:
+            located.append((strand_sequence, strand_qualities, is_reverse, offsets))
+
+    if len(located) != 1:
+        return None
+    strand_sequence, strand_qualities, is_reverse, offsets = located[0]
+    if len(offsets) != len(anchors):
+        return None
+
+    columns = {}
+    for region, offset in offsets.items():
+        chrom = region.rsplit(":", 1)[0]
+        codon_start = anchors[region].codon_start
+        ref_bases = reference.fetch(chrom, codon_start, codon_start + 2)
+        region_columns = []
+        for i, ref_base in enumerate(ref_bases):
+            base = strand_sequence[offset + i]
+            quality = strand_qualities[offset + i]
+            if quality < MIN_BASE_QUALITY:
+                region_columns.append((ref_base, "*", ord("*") - 33))
+                continue
+            if base == ref_base.upper():
+                base = ref_base
+            elif is_reverse:
+                base = base.lower()
+            region_columns.append((ref_base, base, min(quality, MAX_PRINTED_QUALITY)))
+        columns[region] = region_columns
+    return columns
@@ -0,0 +1,269 @@
+"""Read inputs from directories or zip files and write outputs to directories or zip files."""
+
+import glob
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import threading
+import zipfile
+
+
+class InputFile:
+    """A single input file, either on disk or a member of a zip file, optionally gzip compressed."""
+
+    __slots__ = (
+        '_archive',
+        '_member',
+        'name',
+        'path',
+    )
+
+    def __init__(self, name, path=None, archive=None, member=None):
+        # file name without folders or .gz ending, used for sample ids and output file names
+        self.name = name
+        # path on disk, if the file can be read directly by external tools
+        self.path = path
+        self._archive = archive
+        self._member = member
+
+    def __repr__(self):
+        return f"InputFile({self.name!r})"
+
+    @classmethod
+    def from_path(cls, path):
+        name = os.path.basename(path)
+        if name.endswith(".gz"):
+            return cls(name[:-3], archive=_GzipFile(path))
+        return cls(name, path=path)
+
+    def read(self):
+        """Read the full, uncompressed content of the file."""
+        if self.path is not None:
+            with open(self.path, "rb") as handle:
+                return handle.read()
+        return self._archive.read(self._member)
+
+    def digest(self):
+        return hashlib.sha256(self.read()).hexdigest()
+
+    def materialize(self, directory):
+        """Return a path external tools can read the file from, spooling it to directory if needed."""
+        if self.path is not None:
+            return self.path
+        path = os.path.join(directory, self.name)
+        with open(path, "wb") as handle:
+            handle.write(self.read())
+        return path
+
+
+class InputGroup:
+    """The input files holding all reads of one sample, processed like a single input file.
+
+    Its content is the content of all members, one after another, so it can only stand in for
+    several fasta or fastq files. ab1 members need to be basecalled one by one.
+    """
+
+    __slots__ = (
+        'members',
+        'name',
+    )
+
+    def __init__(self, name, members):
+        self.name = name
+        self.members = members
+
+    def __repr__(self):
+        return f"InputGroup({self.name!r}, {self.members!r})"
+
+    def read(self):
+        parts = []
+        for member in self.members:
+            data = member.read()
+            parts.append(data if data.endswith(b"\n") else data + b"\n")
+        return b"".join(parts)
+
+    def digest(self):
+        digest = hashlib.sha256()
+        for member in self.members:
+            digest.update(f"{member.name}\t{member.digest()}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def materialize(self, directory):
+        path = os.path.join(directory, self.name)
+        with open(path, "wb") as handle:
+            handle.write(self.read())
+        return path
+
+
+class InputData:
+    """An input file held in memory, like the reads handed to the Python API."""
+
+    __slots__ = (
+        'data',
+        'name',
+    )
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def __repr__(self):
+        return f"InputData({self.name!r})"
+
+    def read(self):
+        return self.data
+
+    def digest(self):
+        return hashlib.sha256(self.data).hexdigest()
+
+    def materialize(self, directory):
+        path = os.path.join(directory, self.name)
+        with open(path, "wb") as handle:
+            handle.write(self.data)
+        return path
+
+
+def group_inputs(inputs, pattern):
+    """Group input files by the sample named by the compiled regular expression pattern.
+
+    The pattern is searched in each file name, its 'sample' group or else its first group names
+    the sample. Files it doesn't match are samples of their own, like without grouping.
+    Returns the groups and single input files sorted by name.
+    """
+    singles = []
+    groups = {}
+    for input_file in inputs:
+        match = pattern.search(input_file.name)
+        if match is None:
+            singles.append(input_file)
+            continue
+        sample = match.group("sample") if "sample" in pattern.groupindex else match.group(1)
+        _, _, extension = input_file.name.partition(".")
+        name = f"{sample}.{extension}" if extension else sample
+        groups.setdefault(name, InputGroup(name, [])).members.append(input_file)
+    return sorted(singles + list(groups.values()), key=lambda input_file: input_file.name)
+
+
+class _GzipFile:
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, _member):
+        with gzip.open(self.path, "rb") as handle:
+            return handle.read()
+
+
+class _ZipArchive:
+    """Thread-safe access to the members of a zip file."""
+
+    def __init__(self, path):
+        self._zip_file = zipfile.ZipFile(path)
+        self._lock = threading.Lock()
+
+    def namelist(self):
+        return self._zip_file.namelist()
+
+    def read(self, member):
+        with self._lock:
+            data = self._zip_file.read(member)
+        if member.endswith(".gz"):
+            data = gzip.decompress(data)
+        return data
+
+
+def list_inputs(reads, input_format, recursive=False):
+    """List all input files of the given format in a directory or zip file, sorted by name.
+
+    Zip members are found in all nested folders. Gzip compressed files are found as well.
+    """
+    suffixes = (f".{input_format}", f".{input_format}.gz")
+    if os.path.isdir(reads):
+        pattern = os.path.join(reads, "**", "*") if recursive else os.path.join(reads, "*")
+        inputs = [InputFile.from_path(path) for path in glob.glob(pattern, recursive=recursive)
+                  if path.endswith(suffixes) and os.path.isfile(path)]
+    else:
+        archive = _ZipArchive(reads)
+        inputs = []
+        for member in archive.namelist():
+            if not member.endswith(suffixes):
+                continue
+            name = os.path.basename(member)
+            if name.endswith(".gz"):
+                name = name[:-3]
+            inputs.append(InputFile(name, archive=archive, member=member))
+    return sorted(inputs, key=lambda input_file: input_file.name)
+
+
+class OutputDirectory:
+    """Write output files to a directory."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def add_file(self, source, name):
+        target = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(source, target)
+
+    def write(self, name, data):
+        target = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as handle:
+            handle.write(data)
+
+    def open_text(self, name):
+        return open(os.path.join(self.path, name), "w")
+
+    def close(self):
+        pass
+
+
+class OutputZip:
+    """Write output files straight into a zip file, as they are created."""
+
+    def __init__(self, path):
+        self.path = path
+        self._zip_file = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        self._lock = threading.Lock()
+
+    def add_file(self, source, name):
+        with self._lock:
+            self._zip_file.write(source, name)
+
+    def write(self, name, data):
+        with self._lock:
+            self._zip_file.writestr(name, data)
+
+    def open_text(self, name):
+        """Open a text file that is added to the zip file once closed.
+
+        zip files can only be written one member at a time, so text files are
+        collected in memory to allow other files to be added in the meantime.
+        """
+        return _ZipTextMember(self, name)
+
+    def close(self):
+        with self._lock:
+            self._zip_file.close()
+
+
+class _ZipTextMember(io.StringIO):
+    def __init__(self, output, name):
+        super().__init__()
+        self._output = output
+        self._name = name
+
+    def close(self):
+        if not self.closed:
+            self._output.write(self._name, self.getvalue().encode("utf-8"))
+        super().close()
+
+
+def open_output(config):
+    """Open the output directory or, with zip_results, the output zip file of a config."""
+    if config.zip_results:
+        return OutputZip(f"{config.outdir}.zip")
+    return OutputDirectory(config.outdir)
@@ -0,0 +1,180 @@
+"""Call the tracked variants of a whole plate at once with NumPy.
+
+Requires the optional numpy dependency, install with `pip install covid-spike-classification[batch]`.
+"""
+
+import sys
+
+import numpy as np
+
+from .codons import CODON_TABLE, IUPAC_BASES, TranslationError
+from .core import (
+    CODONS,
+    REGIONS,
+    PendingRow,
+    _score_to_ratio,
+)
+from .metrics import count
+from .pileup import MAX_PRINTED_QUALITY as MAX_QUALITY
+
+MISSING = 0
+DELETED = 1
+# codes 2 and up are the IUPAC bases
+CODE_LETTERS = "*" + "".join(IUPAC_BASES)
+UNKNOWN = len(CODE_LETTERS) + 1
+NUM_CODES = UNKNOWN + 1
+
+
+def _build_base_codes():
+    """Map every byte to the code of the base it stands for, folding lower case bases."""
+    codes = np.full(256, UNKNOWN, dtype=np.uint8)
+    codes[0] = MISSING
+    for code, letter in enumerate(CODE_LETTERS, start=1):
+        codes[ord(letter)] = code
+        codes[ord(letter.lower())] = code
+    return codes
+
+
+def _build_amino_acid_table():
+    """Map the combined codes of three bases to the amino acid of that codon, X for invalid codons."""
+    table = np.full(NUM_CODES ** 3, ord("X"), dtype=np.uint8)
+    for codon, amino_acid in CODON_TABLE.items():
+        first, second, third = (CODE_LETTERS.index(base) + 1 for base in codon)
+        table[(first * NUM_CODES + second) * NUM_CODES + third] = ord(amino_acid)
+    return table
+
+
+BASE_CODES = _build_base_codes()
+AMINO_ACID_TABLE = _build_amino_acid_table()
+CHARACTERS = np.array([chr(i) for i in range(256)], dtype=object)
+RATIOS = np.array([_score_to_ratio(score) for score in range(MAX_QUALITY + 1)], dtype=object)
+
+
+def gather(pending, regions):
+    """Gather the pileup columns of all samples into samples x regions x 3 matrices.
+
+    Returns the reference base codes, read base codes, whether the read bases differ from the
+    reference bases, the base qualities and a samples x regions matrix marking the codons that
+    are fully covered.
+    """
+    reference_bases = bytearray()
+    read_bases = bytearray()
+    qualities = []
+    missing = b"\0\0\0"
+    for row in pending:
+        for region in regions:
+            columns = row.columns.get(region) or []
+            if len(columns) < 3:
+                reference_bases += missing
+                read_bases += missing
+                qualities.extend((0, 0, 0))
+                continue
+            for reference_base, read_base, quality in columns[:3]:
+                reference_bases += reference_base[:1].encode("ascii", "replace")
+                read_bases += read_base[:1].encode("ascii", "replace")
+                qualities.append(quality)
+
+    shape = (len(pending), len(regions), 3)
+    reference_bytes = np.frombuffer(bytes(reference_bases), dtype=np.uint8).reshape(shape)
+    read_bytes = np.frombuffer(bytes(read_bases), dtype=np.uint8).reshape(shape)
+    # like the per-sample calls, bases only match with the same case
+    mismatch = reference_bytes != read_bytes
+    read_codes = BASE_CODES[read_bytes]
+    quality_matrix = np.array(qualities, dtype=np.int64).reshape(shape)
+    covered = (read_codes != MISSING).all(axis=-1)
+    return BASE_CODES[reference_bytes], read_codes, mismatch, quality_matrix, covered
+
+
+def translate_codes(codes):
+    """Translate a ... x 3 matrix of base codes into a matrix of amino acid bytes."""
+    index = (codes[..., 0].astype(np.int64) * NUM_CODES + codes[..., 1]) * NUM_CODES + codes[..., 2]
+    return AMINO_ACID_TABLE[index]
+
+
+def call_matrix(pending, config):
+    """Call all tracked variants of the pending rows.
+
+    Returns samples x variants matrices of the result cells, of the found mutations, of the
+    probability ratios and of whether there is a probability ratio.
+    """
+    regions = list(CODONS)
+    region_index = {region: i for i, region in enumerate(regions)}
+    variants = list(REGIONS)
+    variant_regions = np.array([region_index[REGIONS[variant]] for variant in variants], dtype=np.int64)
+    variant_amino_acids = np.array([ord(variant[-1]) for variant in variants], dtype=np.uint8)
+
+    reference_codes, read_codes, mismatch, qualities, covered = gather(pending, regions)
+    deleted = covered & (read_codes == DELETED).any(axis=-1)
+    valid = covered & ~deleted
+    # count the NA cells like the per-sample calls do
+    count(config, "pileup_failed", int((~covered[:, variant_regions]).sum()))
+    count(config, "base_deleted", int(deleted[:, variant_regions].sum()))
+    unknown = ((reference_codes == UNKNOWN) | (read_codes == UNKNOWN)).any(axis=-1)
+    if (valid & unknown).any():
+        sample, region = np.argwhere(valid & unknown)[0]
+        err = TranslationError(f"Codon at {regions[region]} is invalid")
+        print(pending[sample].sample_id, err, file=sys.stderr)
+        raise err
+
+    before = translate_codes(reference_codes)
+    after = translate_codes(read_codes)
+    min_quality = qualities.min(axis=-1)
+    first_mismatch = np.take_along_axis(qualities, mismatch.argmax(axis=-1)[..., None], axis=-1)[..., 0]
+
+    valid = valid[:, variant_regions]
+    before = before[:, variant_regions]
+    after = after[:, variant_regions]
+    same = before == after
+    ref_call = valid & same
+    alt_call = valid & ~same & (after == variant_amino_acids)
+    other = valid & ~same & ~alt_call
+
+    cells = np.full(valid.shape, "NA", dtype=object)
+    cells[ref_call] = "0"
+    cells[alt_call] = "1"
+    if config.show_unexpected:
+        positions = np.array([variant[1:-1] for variant in variants], dtype=object)
+        unexpected = CHARACTERS[before] + positions + CHARACTERS[after]
+        cells[other] = unexpected[other]
+    else:
+        cells[other] = "0"
+
+    scores = np.where(ref_call, min_quality[:, variant_regions], first_mismatch[:, variant_regions])
+    has_ratio = ref_call | alt_call
+    ratios = np.where(has_ratio, RATIOS[np.clip(scores, 0, MAX_QUALITY)], "")
+    return cells, alt_call, ratios, has_ratio
+
+
+def build_rows(results, config):
+    """Build the results rows of a whole plate, calling all pending rows at once.
+
+    Rows of samples that already failed are passed through unchanged, the order is kept.
+    """
+    if config.scan:
+        raise ValueError("Batch calling only supports the tracked mutations, not --scan")
+    pending = [result for result in results if isinstance(result, PendingRow)]
+    if not pending:
+        return results
+
+    cells, alt_call, ratios, has_ratio = call_matrix(pending, config)
+    variants = list(REGIONS)
+    d614g = variants.index("D614G")
+    found = np.where(alt_call, np.array([f"{variant} found (" for variant in variants], dtype=object)
+                     + ratios + ")", None)
+    if config.silence_warnings:
+        warnings = np.full(len(pending), None, dtype=object)
+    else:
+        d614g_ratios = np.where(has_ratio[:, d614g], ratios[:, d614g], "failed to map")
+        warnings = np.where(alt_call[:, d614g], None,
+                            "D614G not found; low quality sequence (" + d614g_ratios + ")?")
+
+    rows = {}
+    for i, row in enumerate(pending):
+        comment_parts = [warnings[i]] if warnings[i] is not None else []
+        comment_parts.extend(part for part in found[i] if part is not None)
+        comment_parts.extend(row.comments)
+        parts = [row.sample_id]
+        parts.extend(cells[i])
+        parts.append("; ".join(comment_parts))
+        rows[id(row)] = parts
+    return [rows.get(id(result), result) for result in results]
@@ -0,0 +1,154 @@
+"""Content-addressed on-disk cache of per-sample results."""
+
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import threading
+
+CACHE_VERSION = 2
+TOOLS = ("tracy", "bowtie2", "samtools")
+
+
+class ResultCache:
+    """Cache sample results keyed by the hash of the input file and the run context.
+
+    Within a run, every distinct input is computed only once, even when the on-disk cache
+    is not used or refresh is requested. Long-lived users can bound the entries kept in memory
+    with max_entries, the oldest are dropped first. Entries marked "failed" are only kept in
+    memory, so samples that may have failed for reasons other than their input, like a crashed
+    tool, are computed again in the next run.
+    """
+
+    def __init__(self, cache_dir, context, max_size=None, refresh=False, use_disk=True, max_entries=None):
+        self.cache_dir = cache_dir
+        self.context = context
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.use_disk = use_disk and cache_dir is not None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._entries = {}
+
+    def key(self, input_file):
+        """Key of an input file, either a path or an archive.InputFile."""
+        digest = hashlib.sha256(self.context.encode("utf-8"))
+        if isinstance(input_file, str):
+            digest.update(hash_file(input_file).encode("utf-8"))
+        else:
+            digest.update(input_file.digest().encode("utf-8"))
+        return digest.hexdigest()
+
+    def fetch(self, input_file, compute):
+        """Return the cached entry for input_file, calling compute() to create it if needed."""
+        key = self.key(input_file)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            entry = self._entries.get(key)
+            if entry is None and self.use_disk and not self.refresh:
+                entry = self._load(key)
+            if entry is None:
+                self.misses += 1
+                entry = compute()
+                if self.use_disk and not entry.get("failed"):
+                    self._store(key, entry)
+            else:
+                self.hits += 1
+            with self._lock:
+                self._entries[key] = entry
+                if self.max_entries is not None and len(self._entries) > self.max_entries:
+                    oldest = next(iter(self._entries))
+                    del self._entries[oldest]
+                    self._key_locks.pop(oldest, None)
+        return entry
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into max_size bytes."""
+        if not self.use_disk or self.max_size is None:
+            return
+        entries = []
+        total = 0
+        for path in glob.glob(os.path.join(self.cache_dir, "*", "*.json")):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r") as handle:
+                entry = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        # mark the entry as recently used
+        os.utime(path)
+        return entry
+
+    def _store(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(handle, "w") as outfile:
+            json.dump(entry, outfile)
+        os.replace(tmp_path, path)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tool_version(tool):
+    try:
+        output = subprocess.run([tool, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                check=False).stdout
+    except OSError:
+        return "missing"
+    return output.decode("utf-8", "replace").strip().split("\n")[0]
+
+
+def run_context(config, regions):
+    """Describe everything apart from the input file that influences a sample's results."""
+    name, _ = os.path.splitext(config.reference)
+    reference_files = [config.reference] + sorted(glob.glob(f"{config.reference}.fai"))
+    reference_files += sorted(glob.glob(f"{name}.index*"))
+    context = {
+        "version": CACHE_VERSION,
+        "reference": {os.path.basename(path): hash_file(path) for path in reference_files},
+        "regions": regions,
+        "tools": {tool: tool_version(tool) for tool in TOOLS},
+        "options": {
+            "basecaller": config.basecaller if config.input_format == "ab1" else None,
+            "batch_calling": config.batch_calling,
+            "amplicon_margin": config.amplicon_margin if config.amplicon else None,
+            "direct_sam": config.direct_sam,
+            "fast_path": config.fast_path,
+            "group_pattern": config.group_pattern,
+            "input_format": config.input_format,
+            "pileup_engine": config.pileup_engine,
+            "scan": config.scan,
+            "show_unexpected": config.show_unexpected,
+            "silence_warnings": config.silence_warnings,
+            "triage": [config.triage_min_length, config.triage_min_quality, config.triage_max_n,
+                       config.triage_min_codons] if config.triage else None,
+        },
+    }
+    return json.dumps(context, sort_keys=True)
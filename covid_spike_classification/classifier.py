@@ -0,0 +1,366 @@
+"""Classify reads from Python, keeping the reference, its indices and the results of earlier calls warm."""
+
+import concurrent.futures
+import io
+import shutil
+import tempfile
+import threading
+
+from Bio import SeqIO
+from Bio.SeqRecord import SeqRecord
+
+from . import plates
+from .anchor import load_anchors
+from .archive import InputData, open_output
+from .config import CSCConfig
+from .core import (
+    CODONS,
+    REGIONS,
+    _call_chunks,
+    _fetch_entry,
+    call_variants,
+    list_substitutions,
+    load_reference,
+    parse_columns,
+    run_pipeline,
+    setup_cache,
+    setup_index,
+    setup_journal,
+    setup_metrics,
+    variant_comment,
+    write_metrics,
+    write_results,
+    write_shard_info,
+    write_triage,
+)
+from .index import default_index_dir
+from .lineage import setup_lineages
+from .metrics import track_run, track_sample
+from .store import setup_store
+
+INPUT_FORMATS = ("ab1", "fasta", "fastq")
+# results of earlier calls kept in memory by a Classifier
+MAX_CACHED_SAMPLES = 4096
+# samples classified between trimming the on-disk caches to their maximum size
+EVICT_INTERVAL = 1024
+
+# the defaults of the command line options, index_dir and threads are filled in by Classifier
+DEFAULT_OPTIONS = {
+    "amplicon": False,
+    "amplicon_margin": 1000,
+    "basecaller": "tracy",
+    "batch_calling": False,
+    "cache_dir": None,
+    "cache_size": 1024,
+    "debug": False,
+    "direct_sam": False,
+    "fast_path": False,
+    "group_pattern": None,
+    "index_dir": None,
+    "input_format": "ab1",
+    "jobs": 1,
+    "keep_bams": False,
+    "lineages": None,
+    "metrics": False,
+    "no_cache": False,
+    "no_fastqs": False,
+    "outdir": None,
+    "pileup_engine": "samtools",
+    "profile": False,
+    "prometheus": False,
+    "quiet": False,
+    "reads": None,
+    "refresh": False,
+    "resume": False,
+    "scan": False,
+    "shard": None,
+    "show_unexpected": False,
+    "silence_warnings": False,
+    "stdout": False,
+    "store": None,
+    "threads": None,
+    "triage": False,
+    "triage_max_n": 0.5,
+    "triage_min_codons": 1,
+    "triage_min_length": 100,
+    "triage_min_quality": 10,
+    "watch": None,
+    "zip_results": False,
+}
+
+
+class SampleResult:
+    """The results of one sample, the typed form of its row in results.csv.
+
+    calls maps every tracked variant to its results cell: "1" if found, "0" if not, "NA" if its
+    codon couldn't be called, or the unexpected substitution with show_unexpected. ratios maps
+    the variants whose codon was called to the quality ratio of the call, like "1:10 000".
+    substitutions lists all spike substitutions in scan mode, it's None otherwise.
+    """
+
+    __slots__ = (
+        'calls',
+        'comment',
+        'fastq',
+        'ratios',
+        'sample',
+        'substitutions',
+    )
+
+    def __init__(self, sample, calls, ratios, comment, substitutions=None, fastq=None):
+        self.sample = sample
+        self.calls = calls
+        self.ratios = ratios
+        self.comment = comment
+        self.substitutions = substitutions
+        # basecalled reads of ab1 input
+        self.fastq = fastq
+
+    def __repr__(self):
+        return f"SampleResult({self.sample!r}, found={self.found!r})"
+
+    @property
+    def found(self):
+        """The found mutations, in the order of the results columns."""
+        return [variant for variant, call in self.calls.items() if call == "1"]
+
+    @property
+    def failed(self):
+        """Whether no codon could be called at all."""
+        return all(call == "NA" for call in self.calls.values())
+
+    def as_dict(self):
+        """The results as a JSON-serializable dict, without the basecalled reads."""
+        result = {"sample": self.sample, "calls": dict(self.calls), "ratios": dict(self.ratios)}
+        if self.substitutions is not None:
+            result["substitutions"] = self.substitutions
+        result["comment"] = self.comment
+        return result
+
+    def row(self):
+        """The parts of the sample's row in results.csv."""
+        parts = [self.sample]
+        parts.extend(self.calls.values())
+        if self.substitutions is not None:
+            parts.append(self.substitutions)
+        parts.append(self.comment)
+        return parts
+
+    @classmethod
+    def from_row(cls, sample, parts, scan=False, fastq=None):
+        """Build the result of a sample from the parts of its results row, without quality ratios."""
+        calls = dict(zip(REGIONS, parts[1:len(REGIONS) + 1]))
+        substitutions = parts[-2] if scan else None
+        return cls(sample, calls, {}, parts[-1], substitutions, fastq)
+
+
+class Classifier:
+    """Classify reads in-process, for embedding the tool in other Python programs.
+
+    Set up once per reference, a Classifier holds the reference, its indices, the codon anchors
+    and the results of earlier calls across calls of classify. options are the command line
+    options as keyword arguments, like scan=True or jobs=4, with the same defaults. Fasta and fastq
+    reads are piped into the aligner and never written to disk, ab1 input only is for tracy, pass
+    basecaller="native" to decode it in memory. fast_path=True skips aligning reads whose codons
+    can be anchored, direct_sam=True skips writing bam files, like those command line options.
+
+    Use it as a context manager or call close() to remove its scratch directory, stop its workers,
+    trim the on-disk caches to their maximum size and close the results store. Long-lived
+    instances trim them every EVICT_INTERVAL samples as well.
+    """
+
+    def __init__(self, reference, **options):
+        unknown = sorted(set(options) - set(DEFAULT_OPTIONS))
+        if unknown:
+            raise TypeError(f"Unknown options: {', '.join(unknown)}")
+        kwargs = dict(DEFAULT_OPTIONS, reference=reference, **options)
+        if kwargs["index_dir"] is None:
+            kwargs["index_dir"] = default_index_dir()
+        if kwargs["threads"] is None:
+            kwargs["threads"] = kwargs["jobs"]
+        config = CSCConfig(**kwargs)
+        self._setup(config)
+        # warm up what every sample needs
+        setup_index(config)
+        if config.fast_path or config.pileup_engine == "native" or config.direct_sam:
+            load_reference(config.reference)
+        if config.fast_path:
+            load_anchors(config.reference, tuple(CODONS))
+
+    @classmethod
+    def from_config(cls, config):
+        """Set up a Classifier for a config built from the command line.
+
+        Unlike a Classifier set up from a reference, the indices are only set up once they are needed.
+        """
+        classifier = cls.__new__(cls)
+        classifier._setup(config)
+        return classifier
+
+    def _setup(self, config):
+        self.config = config
+        self._tmpdir = tempfile.mkdtemp(prefix="csc-")
+        self._configs = {}
+        self._executor = None
+        self._lock = threading.Lock()
+        # samples classified since the caches were last trimmed
+        self._unevicted = 0
+        setup_metrics(config)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._evict()
+        if self.config._store is not None:
+            self.config._store.close()
+            self.config._store = None
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def classify(self, inputs):
+        """Classify one input or a list of inputs, returning a SampleResult for each.
+
+        An input is a Bio.SeqRecord.SeqRecord, fastq if it has phred qualities and fasta
+        otherwise, or the content of an ab1, fasta or fastq file as bytes, optionally as
+        a (name, bytes) tuple. Without a name, samples are named after their first read.
+        A single input returns a single result, a list of inputs a list of results in the same order.
+        Samples are processed on a pool of config.jobs worker threads that is kept across calls.
+        """
+        single = isinstance(inputs, (SeqRecord, bytes, str, tuple))
+        jobs = [read_input(item) for item in ([inputs] if single else inputs)]
+        results = self._map(lambda job: self._classify_input(*job), jobs)
+        with self._lock:
+            self._unevicted += len(jobs)
+            evict = self._unevicted >= EVICT_INTERVAL
+            if evict:
+                self._unevicted = 0
+        if evict:
+            self._evict()
+        return results[0] if single else results
+
+    def _evict(self):
+        """Trim the on-disk caches of all configs to their maximum size."""
+        with self._lock:
+            caches = {id(config._cache): config._cache for config in [self.config, *self._configs.values()]
+                      if config._cache is not None}
+        for cache in caches.values():
+            cache.evict()
+
+    def _map(self, func, items):
+        if self.config.jobs <= 1:
+            return [func(item) for item in items]
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.jobs)
+        return list(self._executor.map(func, items))
+
+    def _format_config(self, input_format):
+        """The config to classify in-memory input of a format with, set up on first use."""
+        with self._lock:
+            if input_format not in self._configs:
+                setup_index(self.config)
+                # calling is deferred like with batch calling, so results keep the quality ratios of all calls
+                format_config = self.config.copy(input_format=input_format, batch_calling=True, no_fastqs=True)
+                setup_cache(format_config, max_entries=MAX_CACHED_SAMPLES)
+                self._configs[input_format] = format_config
+            return self._configs[input_format]
+
+    def _classify_input(self, name, input_data, input_format):
+        config = self._format_config(input_format)
+        with track_sample(config, input_data.name):
+            entry = _fetch_entry(input_data, self._tmpdir, config)
+            if "columns" not in entry:
+                # the sample failed before it was piled up
+                return SampleResult.from_row(name, [name] + entry["calls"], config.scan, entry["fastq"])
+            calls = _call_chunks(entry["columns"], parse_columns, input_data.name)
+            cells, found_mutations, probabilities = call_variants(calls, config, input_data.name)
+        comment_parts = [variant_comment(found_mutations, probabilities, config)] + entry["comments"]
+        return SampleResult(
+            name,
+            dict(zip(REGIONS, cells)),
+            probabilities,
+            "; ".join(part for part in comment_parts if part),
+            list_substitutions(calls) if config.scan else None,
+            entry["fastq"],
+        )
+
+    def write_results(self):
+        """Process the config's reads and write results.csv and the fastqs to its output, like the CLI.
+
+        Raises journal.JournalError if a resumed run was started with other settings,
+        store.StoreError or sqlite3.Error if the results store can't be opened or written,
+        and lineage.LineageError if the lineage table is invalid or can't be read.
+        """
+        config = self.config
+        setup_journal(config)
+        setup_store(config)
+        setup_lineages(config)
+        config._output = open_output(config)
+        try:
+            with track_run(config):
+                write_results(run_pipeline(self._tmpdir, config), config)
+            write_shard_info(config)
+            write_triage(config)
+            write_metrics(config)
+        finally:
+            config._output.close()
+
+    def write_plates(self, plate_list, combined=False):
+        """Process the plates set up by plates.setup_plates on one worker pool, like the CLI.
+
+        Each plate's results are written to <outdir>/<plate name>, and all rows to
+        <outdir>/results.csv as well with combined.
+        """
+        config = self.config
+        with track_run(config):
+            plates.write_plates(plates.run_plates(self._tmpdir, plate_list, config), plate_list, config, combined)
+        write_metrics(config)
+
+
+def read_input(item):
+    """Turn an input of Classifier.classify into a (name, archive.InputData, input format) tuple."""
+    name = None
+    if isinstance(item, SeqRecord):
+        input_format = "fastq" if "phred_quality" in item.letter_annotations else "fasta"
+        handle = io.StringIO()
+        SeqIO.write(item, handle, input_format)
+        name, data = item.id, handle.getvalue()
+    elif isinstance(item, tuple):
+        name, data = item
+    else:
+        data = item
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if not isinstance(data, bytes):
+        raise TypeError(f"Expected a SeqRecord, bytes or a (name, bytes) tuple, got {type(item).__name__}")
+
+    input_format = sniff_format(data)
+    if name is None:
+        name = _first_read_name(data, input_format)
+    # the file name of the sample, for naming its reads and bam file
+    file_name = f"{name.replace('/', '_')}.{input_format}"
+    return name, InputData(file_name, data), input_format
+
+
+def sniff_format(data):
+    """Tell ab1, fasta and fastq content apart by its first bytes."""
+    if data.startswith(b"ABIF"):
+        return "ab1"
+    start = data.lstrip()[:1]
+    if start == b">":
+        return "fasta"
+    if start == b"@":
+        return "fastq"
+    raise ValueError("Input is neither ab1, fasta nor fastq data")
+
+
+def _first_read_name(data, input_format):
+    if input_format == "ab1":
+        return SeqIO.read(io.BytesIO(data), "abi").id
+    header = data.lstrip().split(b"\n", 1)[0][1:].split()
+    return header[0].decode("utf-8", "replace") if header else "sample"
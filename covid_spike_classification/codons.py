@@ -0,0 +1,85 @@
+"""Translate codons with a precomputed lookup table and enumerate the codons of the spike gene."""
+
+import itertools
+
+BASES = "TCAG"
+# standard genetic code, in the order of BASES for all three codon positions
+AMINO_ACIDS = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+
+IUPAC_BASES = {
+    "A": "A",
+    "C": "C",
+    "G": "G",
+    "T": "T",
+    "U": "T",
+    "R": "AG",
+    "Y": "CT",
+    "S": "CG",
+    "W": "AT",
+    "K": "GT",
+    "M": "AC",
+    "B": "CGT",
+    "D": "AGT",
+    "H": "ACT",
+    "V": "ACG",
+    "N": "ACGT",
+}
+
+# IUPAC codes for pairs of amino acids that ambiguous codons can stand for
+AMBIGUOUS_AMINO_ACIDS = {
+    frozenset("DN"): "B",
+    frozenset("EQ"): "Z",
+    frozenset("IL"): "J",
+}
+
+# spike protein coding sequence on NC_045512, 1-based and inclusive, without the stop codon
+SPIKE_CHROM = "NC_045512"
+SPIKE_START = 21563
+SPIKE_END = 25381
+
+
+class TranslationError(ValueError):
+    pass
+
+
+def _build_codon_table():
+    """Translate all codons of IUPAC bases, like Biopython does for ambiguous codons.
+
+    Ambiguous codons translate to an amino acid if all codons they stand for do, to a stop if
+    they all are stop codons, to B, Z or J for the ambiguous amino acid pairs and to X otherwise.
+    """
+    unambiguous = {
+        "".join(codon): amino_acid
+        for codon, amino_acid in zip(itertools.product(BASES, repeat=3), AMINO_ACIDS)
+    }
+    table = {}
+    for codon in itertools.product(IUPAC_BASES, repeat=3):
+        amino_acids = {unambiguous["".join(bases)]
+                       for bases in itertools.product(*(IUPAC_BASES[base] for base in codon))}
+        if len(amino_acids) == 1:
+            table["".join(codon)] = amino_acids.pop()
+        else:
+            table["".join(codon)] = AMBIGUOUS_AMINO_ACIDS.get(frozenset(amino_acids), "X")
+    return table
+
+
+CODON_TABLE = _build_codon_table()
+
+
+def translate(sequence):
+    """Translate a nucleotide sequence, its length must be a multiple of three."""
+    if len(sequence) % 3:
+        raise TranslationError(f"Sequence length {len(sequence)} is not a multiple of three")
+    sequence = sequence.upper()
+    try:
+        return "".join(CODON_TABLE[sequence[i:i + 3]] for i in range(0, len(sequence), 3))
+    except KeyError as err:
+        raise TranslationError(f"Codon {err.args[0]!r} is invalid") from None
+
+
+def spike_codons():
+    """Map the region of each spike codon to its 1-based amino acid position."""
+    return {
+        f"{SPIKE_CHROM}:{start}-{start + 2}": (start - SPIKE_START) // 3 + 1
+        for start in range(SPIKE_START, SPIKE_END, 3)
+    }
@@ -1,18 +1,60 @@
 """Manage configuration options."""
 
+import collections
+
 
 class CSCConfig:
     __slots__ = (
+        'amplicon',
+        'amplicon_margin',
+        'basecaller',
+        'batch_calling',
+        '_cache',
+        'cache_dir',
+        'cache_size',
         'debug',
+        '_digests',
+        'direct_sam',
         '_failed',
+        'fast_path',
+        'group_pattern',
+        '_index',
+        'index_dir',
         'input_format',
+        'jobs',
+        '_journal',
+        'keep_bams',
+        'lineages',
+        '_lineages',
+        'metrics',
+        '_metrics',
+        'no_cache',
+        'no_fastqs',
         'outdir',
+        '_output',
+        'pileup_engine',
+        'profile',
+        'prometheus',
         'quiet',
         'reads',
         'reference',
+        'refresh',
+        'resume',
+        'scan',
+        'shard',
         'show_unexpected',
         'silence_warnings',
         'stdout',
+        'store',
+        '_store',
+        'threads',
+        'triage',
+        '_triage',
+        'triage_max_n',
+        'triage_min_codons',
+        'triage_min_length',
+        'triage_min_quality',
+        'watch',
         'zip_results',
     )
 
@@ -24,7 +66,39 @@ class CSCConfig:
             setattr(self, attr, kwargs[attr])
 
         # set up internal slots
+        self._cache = None
+        # input hashes of the rows still to be added to the results store, in row order
+        self._digests = collections.deque()
         self._failed = set()
+        self._index = None
+        self._journal = None
+        self._lineages = None
+        self._metrics = None
+        self._output = None
+        self._store = None
+        # triage statistics by input file name, written to triage.csv
+        self._triage = {}
+
+    def copy(self, **kwargs):
+        """Create a copy of the config with some options replaced, sharing the internal state."""
+        options = {attr: getattr(self, attr) for attr in self.__slots__ if not attr.startswith("_")}
+        options.update(kwargs)
+        new = type(self)(**options)
+        new._cache = self._cache
+        new._failed = self._failed
+        new._index = self._index
+        new._lineages = self._lineages
+        new._metrics = self._metrics
+        new._store = self._store
+        if new.outdir == self.outdir:
+            new._journal = self._journal
+            new._output = self._output
+        return new
+
+    @property
+    def tool_threads(self):
+        """Threads each external tool may use, splitting the thread budget across parallel jobs."""
+        return max(1, self.threads // self.jobs)
 
     @classmethod
     def from_args(cls, namespace):
@@ -1,16 +1,40 @@
 """Core functions for covid spike classification."""
 
-import glob
+import concurrent.futures
+import hashlib
+import io
+import itertools
+import json
 import os
+import re
 import shutil
 import subprocess
 import sys
-import zipfile
+import tempfile
+import threading
 
-import Bio
-from Bio.Seq import Seq
+from Bio import SeqIO
 
-from .config import CSCConfig
+from .anchor import (
+    FASTA_QUALITY,
+    anchored_columns,
+    load_anchors,
+)
+from .archive import InputGroup, OutputDirectory, group_inputs, list_inputs
+from .cache import ResultCache, run_context
+from .codons import TranslationError, spike_codons, translate
+from .index import ensure_index, lift_sam
+from .journal import Journal, journal_path
+from .metrics import RunMetrics, call_tool, check_call_tool, count, popen, stage, track_sample
+from .pileup import (
+    combined_evidence,
+    load_reference,
+    parse_sam,
+    pileup_columns,
+    read_alignments,
+)
+from .trace import decode_trace
+from .triage import STATS, TRIAGE_FILE, read_stats, triage_failure
 
 REGIONS = {
     "K417N": "NC_045512:22811-22813",
@@ -56,6 +80,36 @@ REGIONS = {
 }
 
 
+def _parse_region(region):
+    """Split a samtools-style region string into reference name, start and end."""
+    chrom, coords = region.rsplit(":", 1)
+    start, end = coords.split("-")
+    return chrom, int(start), int(end)
+
+
+def _build_codon_index(regions):
+    """Group the tracked mutations by the codon region they need to look at."""
+    codons = {}
+    for variant, region in regions.items():
+        codons.setdefault(region, []).append(variant)
+    return codons
+
+
+CODONS = _build_codon_index(REGIONS)
+SPIKE_CODONS = spike_codons()
+# all codons called in scan mode, the tracked codons included
+SCAN_REGIONS = tuple(sorted(set(CODONS) | set(SPIKE_CODONS)))
+# written next to results.csv by sharded runs
+SHARD_INFO = "shard.json"
+
+
+def codon_regions(config):
+    """The codon regions to pile up and call for a config."""
+    if config.scan:
+        return SCAN_REGIONS
+    return tuple(CODONS)
+
+
 class PileupFailedError(RuntimeError):
     pass
 
@@ -64,173 +118,873 @@ class BaseDeletedError(RuntimeError):
     pass
 
 
-def basecall(tmpdir, config):
-    if config.input_format != "ab1":
-        return
-    fastq_dir = os.path.join(tmpdir, "fastqs")
-    os.makedirs(fastq_dir)
+class PendingRow:
+    """The pileup columns of a sample, waiting to be called together with the rest of the plate."""
+
+    __slots__ = (
+        'columns',
+        'comments',
+        'sample_id',
+    )
+
+    def __init__(self, sample_id, columns, comments=None):
+        self.sample_id = sample_id
+        # dict of region: [(reference base, read base, quality), ...]
+        self.columns = columns
+        # extra comments to add after the calling comments
+        self.comments = comments or []
+
+
+def basecall_reads(sanger_file, scratch_dir, config):
+    """Basecall a single ab1 file, returning the fastq content without writing it to disk.
+
+    tracy writes its fastq output to a named pipe in scratch_dir that is read in-process.
+    The native basecaller reads the basecalls stored in the file instead.
+    """
+    base_name = os.path.basename(sanger_file)
+    if config.basecaller == "native":
+        with open(sanger_file, "rb") as handle:
+            return decode_trace(handle.read(), base_name)
+    fifo = os.path.join(scratch_dir, f"{base_name}.fastq")
+    cmd = ["tracy", "basecall", "-f", "fastq", "-o", fifo, sanger_file]
+    return read_through_pipe(cmd, fifo, config).decode("utf-8")
+
+
+def read_through_pipe(cmd, fifo, config):
+    """Run a tool that writes its output to the path fifo, returning that output.
+
+    The path is created as a named pipe, so the output never touches the filesystem.
+    Raises subprocess.CalledProcessError if the tool fails.
+    """
+    os.mkfifo(fifo)
+    try:
+        read_fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        # hold a write end open, so reading only hits EOF once the tool is done
+        write_fd = os.open(fifo, os.O_WRONLY)
+        os.set_blocking(read_fd, True)
+        chunks = []
+
+        def drain():
+            with os.fdopen(read_fd, "rb") as handle:
+                chunks.append(handle.read())
+
+        reader = threading.Thread(target=drain)
+        reader.start()
+        try:
+            kwargs = {}
+            if config.quiet:
+                kwargs["stdout"] = subprocess.DEVNULL
+                kwargs["stderr"] = subprocess.DEVNULL
+            returncode = call_tool(config, cmd, **kwargs)
+        finally:
+            os.close(write_fd)
+            reader.join()
+    finally:
+        os.remove(fifo)
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return b"".join(chunks)
+
+
+def map_file(fastq_file, bam_dir, config, reads=None):
+    """Map a single sequence file to the reference, returning the path of the sorted bam file.
+
+    If reads is given, that fastq content is piped into bowtie2 instead of reading fastq_file,
+    which is then only used to name the bam file.
+    Failed mappings are recorded in the config's list of failed files.
+    """
+    stderr = subprocess.DEVNULL if config.quiet else None
+
+    base_name = os.path.basename(fastq_file)
+    bam_file = os.path.join(bam_dir, f"{base_name}.bam")
+
+    if config._index is not None and config._index.is_amplicon:
+        # alignments need to be lifted back to reference coordinates before samtools sees them
+        sam = align_file(fastq_file, config, reads=reads)
+        if sam is None or not write_bam(sam, bam_file, config):
+            config._failed.add(bam_file)
+            count(config, "failed_alignments")
+        return bam_file
+
+    bowtie_cmd = _bowtie_cmd(fastq_file if reads is None else "-", config)
+    sam_view_cmd, sam_sort_cmd = _sam_to_bam_cmds(config)
+    sam_idx_cmd = ["samtools", "index", bam_file]
+
+    bowtie_stdin = None if reads is None else subprocess.PIPE
+    with open(bam_file, "w") as handle:
+        bowtie = popen(config, bowtie_cmd, stdin=bowtie_stdin, stdout=subprocess.PIPE, stderr=stderr)
+        sam_view = popen(config, sam_view_cmd, stdin=bowtie.stdout, stdout=subprocess.PIPE, stderr=stderr)
+        sam_sort = popen(config, sam_sort_cmd, stdin=sam_view.stdout, stdout=handle, stderr=stderr)
+    if reads is not None:
+        bowtie.stdin.write(reads.encode("utf-8"))
+        bowtie.stdin.close()
+    sam_sort.wait()
+    sam_view.wait()
+    bowtie.wait()
 
-    ab1_dir = _extract_if_zip(tmpdir, config)
+    if bowtie.returncode != 0 or sam_view.returncode != 0 or sam_sort.returncode != 0:
+        config._failed.add(bam_file)
+        count(config, "failed_alignments")
+        return bam_file
 
-    os.makedirs(config.outdir, exist_ok=True)
+    check_call_tool(config, sam_idx_cmd, stderr=stderr)
+    return bam_file
 
-    for sanger_file in glob.glob(os.path.join(ab1_dir, "**", "*.ab1"), recursive=True):
-        base_name = os.path.basename(sanger_file)
-        fastq_file = f"{base_name}.fastq"
-        cmd = ["tracy", "basecall", "-f", "fastq", "-o", os.path.join(fastq_dir, fastq_file), sanger_file]
-        kwargs = {}
-        if config.quiet:
-            kwargs["stdout"] = subprocess.DEVNULL
-            kwargs["stderr"] = subprocess.DEVNULL
-        subprocess.check_call(cmd, **kwargs)
 
-        shutil.copy2(os.path.join(fastq_dir, fastq_file), os.path.join(config.outdir, fastq_file))
+def align_file(fastq_file, config, reads=None):
+    """Map a single sequence file to the reference, returning bowtie2's SAM output.
+
+    If reads is given, that fastq content is piped into bowtie2 instead of reading fastq_file.
+    Failed mappings are recorded in the config's list of failed files and return None.
+    """
+    stderr = subprocess.DEVNULL if config.quiet else None
+    if reads is None:
+        bowtie = popen(config, _bowtie_cmd(fastq_file, config), stdout=subprocess.PIPE, stderr=stderr)
+        sam = bowtie.communicate()[0]
+    else:
+        bowtie = popen(config, _bowtie_cmd("-", config), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                       stderr=stderr)
+        sam = bowtie.communicate(reads.encode("utf-8"))[0]
+    if bowtie.returncode != 0:
+        config._failed.add(fastq_file)
+        count(config, "failed_alignments")
+        return None
+    if config._index is not None:
+        sam = lift_sam(sam, config._index)
+    return sam
 
 
-def map_reads(tmpdir, config):
+def write_bam(sam, bam_file, config):
+    """Write SAM output to a sorted and indexed bam file, returning whether that worked."""
+    stderr = subprocess.DEVNULL if config.quiet else None
+    sam_view_cmd, sam_sort_cmd = _sam_to_bam_cmds(config)
+    with open(bam_file, "w") as handle:
+        sam_view = popen(config, sam_view_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+        sam_sort = popen(config, sam_sort_cmd, stdin=sam_view.stdout, stdout=handle, stderr=stderr)
+        sam_view.communicate(sam)
+    sam_sort.wait()
+    if sam_view.returncode != 0 or sam_sort.returncode != 0:
+        return False
+    check_call_tool(config, ["samtools", "index", bam_file], stderr=stderr)
+    return True
+
 
-    if config.input_format == "ab1":
-        # fastqs live in the tmpdir
-        sequence_dir = os.path.join(tmpdir, "fastqs")
-        file_ending = "fastq"
+def _bowtie_cmd(fastq_file, config):
+    if config._index is not None:
+        ref = config._index.prefix
     else:
-        sequence_dir = _extract_if_zip(tmpdir, config)
-        file_ending = config.input_format
+        # ditch the .fasta file ending
+        name, _ = os.path.splitext(config.reference)
+        ref = f"{name}.index"
 
-    bam_dir = os.path.join(tmpdir, "bams")
-    os.makedirs(bam_dir)
+    bowtie_cmd = ["bowtie2", "-x", ref, "--very-sensitive-local", "-U", fastq_file, "--qc-filter",
+                  "-p", str(config.tool_threads)]
+    if config.input_format == "fasta":
+        bowtie_cmd.append("-f")
+    return bowtie_cmd
 
-    # ditch the .fasta file ending
-    name, _ = os.path.splitext(config.reference)
-    ref = f"{name}.index"
 
+def _sam_to_bam_cmds(config):
+    threads = config.tool_threads
     sam_view_cmd = ["samtools", "view", "-Sb", "-"]
     sam_sort_cmd = ["samtools", "sort", "-m", "64M", "-"]
+    if threads > 1:
+        # samtools counts additional threads on top of the main one
+        sam_sort_cmd[2:2] = ["-@", str(threads - 1)]
+    return sam_view_cmd, sam_sort_cmd
 
-    stderr = subprocess.DEVNULL if config.quiet else None
 
-    for fastq_file in glob.glob(os.path.join(sequence_dir, f"*.{file_ending}")):
-        base_name = os.path.basename(fastq_file)
-        bam_file = os.path.join(bam_dir, f"{base_name}.bam")
-        bowtie_cmd = ["bowtie2", "-x", ref, "--very-sensitive-local", "-U", fastq_file, "--qc-filter"]
-        if config.input_format == "fasta":
-            bowtie_cmd.append("-f")
-        sam_idx_cmd = ["samtools", "index", bam_file]
-
-        with open(bam_file, "w") as handle:
-            bowtie = subprocess.Popen(bowtie_cmd, stdout=subprocess.PIPE, stderr=stderr)
-            sam_view = subprocess.Popen(sam_view_cmd, stdin=bowtie.stdout, stdout=subprocess.PIPE, stderr=stderr)
-            sam_sort = subprocess.Popen(sam_sort_cmd, stdin=sam_view.stdout, stdout=handle, stderr=stderr)
-        sam_sort.wait()
-        sam_view.wait()
-        bowtie.wait()
-
-        if bowtie.returncode != 0 or sam_view.returncode != 0 or sam_sort.returncode != 0:
-            config._failed.add(bam_file)
-            continue
+def find_samples(tmpdir, config):
+    """Find all input files to process in the reads directory or zip file, sorted by file name.
+
+    With config.group_pattern set, the input files of each sample are grouped into one InputGroup.
+    With config.shard set, only the input files of that shard are returned.
+    """
+    samples = list_inputs(config.reads, config.input_format, recursive=config.input_format == "ab1")
+    if config.group_pattern is not None:
+        samples = group_inputs(samples, re.compile(config.group_pattern))
+    if config.shard is not None:
+        samples = [sample for sample in samples if in_shard(sample.name, config.shard)]
+    return samples
+
+
+def in_shard(name, shard):
+    """Check if the input file name belongs to the 1-based (index, count) shard.
+
+    Files are assigned by a hash of their name, so every process agrees on the split without
+    having to coordinate.
+    """
+    index, shards = shard
+    digest = hashlib.sha256(name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards == index - 1
 
-        subprocess.check_call(sam_idx_cmd, stderr=stderr)
+
+def write_shard_info(config):
+    """Record which shard an output holds, so merging can check that all shards are there.
+
+    The input file name of every sample is recorded as well, so merging can sort the rows
+    like a single run does.
+    """
+    if config.shard is None:
+        return
+    index, shards = config.shard
+    inputs = [[_sample_id(sample.name), sample.name] for sample in find_samples(None, config)]
+    info = json.dumps({"shard": index, "shards": shards, "inputs": inputs})
+    output_for(config).write(SHARD_INFO, f"{info}\n".encode("utf-8"))
+
+
+def write_triage(config):
+    """Write the triage statistics of the samples next to results.csv, in the order of the results rows."""
+    if not config.triage:
+        return
+    lines = [",".join(("sample",) + STATS + ("failure",))]
+    for input_name, stats in sorted(config._triage.items()):
+        reason = triage_failure(stats, config) or ""
+        lines.append(",".join([_sample_id(input_name)] + [str(stats[name]) for name in STATS] + [reason]))
+    output_for(config).write(TRIAGE_FILE, "".join(f"{line}\n" for line in lines).encode("utf-8"))
 
 
-def _extract_if_zip(tmpdir: str, config: CSCConfig) -> str:
-    """Extract the reads from a zipfile if input is indeed a zip file."""
-    if os.path.isdir(config.reads):
-        return config.reads
+def process_sample(input_file, tmpdir, config):
+    """Run a single input file through basecalling, mapping and variant calling.
+
+    If the config has a result cache, results for previously seen input files are
+    taken from the cache instead. In resumable runs, the stages the journal records as
+    done are skipped, and samples that fail get a failed row instead of aborting the run.
+    """
+    with track_sample(config, input_file.name):
+        if config._journal is not None:
+            return _resume_sample(input_file, tmpdir, config)
+        return _fetch_sample(input_file, tmpdir, config)
+
+
+def _resume_sample(input_file, tmpdir, config):
+    record = config._journal.lookup(input_file)
+    if record.entry is None:
+        try:
+            record.entry = _fetch_entry(input_file, tmpdir, config, record)
+        except Exception as err:
+            if config.debug:
+                raise
+            reason = f"{type(err).__name__}: {err}"
+            print(f"Failed to process {input_file.name}: {reason}", file=sys.stderr)
+            config._journal.record(record, "failed", reason)
+            count(config, "failed_samples")
+            # keep the results table parseable
+            comment = " ".join(reason.replace(",", ";").split())
+            return _failed_row(_sample_id(input_file.name), f"failed to process: {comment}", config)
+        config._journal.record(record, "done", record.entry)
+    else:
+        count(config, "resumed_samples")
+    return _entry_row(input_file, record.entry, config)
+
+
+def _fetch_sample(input_file, tmpdir, config):
+    return _entry_row(input_file, _fetch_entry(input_file, tmpdir, config), config)
+
+
+def _fetch_entry(input_file, tmpdir, config, record=None):
+    """Fetch the results entry of an input file from the cache, computing it if needed."""
+    if config._cache is None:
+        return _cache_entry(input_file, tmpdir, config, record)
+
+    computed = []
+
+    def compute():
+        computed.append(True)
+        return _cache_entry(input_file, tmpdir, config, record)
+
+    entry = config._cache.fetch(input_file, compute)
+    count(config, "cache_misses" if computed else "cache_hits")
+    return entry
+
+
+def _entry_row(input_file, entry, config):
+    """Turn a results entry back into the results row, writing its fastq to the output."""
+    if "columns" in entry:
+        parts = PendingRow(_sample_id(input_file.name), entry["columns"], entry["comments"])
+    else:
+        parts = [_sample_id(input_file.name)]
+        parts.extend(entry["calls"])
+    if "triage" in entry:
+        config._triage[input_file.name] = entry["triage"]
+    fastq = entry["fastq"]
+    if fastq is not None and not config.no_fastqs:
+        output_for(config).write(f"{input_file.name}.fastq", fastq.encode("utf-8"))
+    return parts
+
+
+def _cache_entry(input_file, tmpdir, config, record=None):
+    parts, fastq, triage = _process_sample(input_file, tmpdir, config, record)
+    if isinstance(parts, PendingRow):
+        entry = {"columns": parts.columns, "comments": parts.comments, "fastq": fastq}
+    else:
+        entry = {"calls": parts[1:], "fastq": fastq}
+    if triage is not None:
+        entry["triage"] = triage
+        rejected = triage_failure(triage, config) is not None
     else:
-        extracted_dir = os.path.join(tmpdir, f"{config.input_format}s")
-        os.makedirs(extracted_dir)
-        with zipfile.ZipFile(config.reads) as zip_file:
-            files = [finfo for finfo in zip_file.infolist() if finfo.filename.endswith(f".{config.input_format}")]
-            for extract_file in files:
-                zip_file.extract(extract_file, extracted_dir)
-        return extracted_dir
+        rejected = False
+    if "calls" in entry and not rejected and all(call == "NA" for call in entry["calls"][:len(REGIONS)]):
+        # may have failed for reasons other than the input, like a crashed tool, so the result
+        # cache keeps it in memory for this run but doesn't write it to disk. Samples triage
+        # skipped only fail because of their reads and are cached like any other result.
+        entry["failed"] = True
+    return entry
+
+
+def _process_sample(input_file, tmpdir, config, record=None):
+    """Process a single input file in a scratch directory that is removed as soon as the results row is ready.
+
+    Returns the results row, for ab1 input the basecalled fastq, and with triage the triage
+    statistics of the reads. Samples failing triage get a failed row without being aligned.
+    Basecalled reads and fasta or fastq input that isn't a file on disk, like zip members, grouped
+    or in-memory input, are piped into the aligner, they are never written to the scratch directory.
+    With a journal record, basecalled reads are taken from and recorded in the journal.
+    """
+    scratch_dir = tempfile.mkdtemp(dir=tmpdir)
+    fastq = None
+    reads = None
+    triage = None
+    try:
+        if config.input_format != "ab1" and getattr(input_file, "path", None) is None:
+            # the path only names the sample
+            sequence_file = os.path.join(scratch_dir, input_file.name)
+            reads = input_file.read().decode("utf-8")
+        elif config.input_format == "ab1" and (isinstance(input_file, InputGroup) or config.basecaller == "native"):
+            # chromatograms can't be concatenated and are decoded in memory, the path only names the sample
+            sequence_file = os.path.join(scratch_dir, input_file.name)
+        else:
+            sequence_file = input_file.materialize(scratch_dir)
+        if config.input_format == "ab1" and record is not None and record.fastq is not None:
+            fastq = reads = record.fastq
+        elif config.input_format == "ab1":
+            with stage(config, "basecall"):
+                fastq = reads = _basecall_input(input_file, sequence_file, scratch_dir, config)
+            if record is not None:
+                config._journal.record(record, "basecall", fastq)
+        if config.triage:
+            with stage(config, "triage"):
+                triage = triage_reads(input_file, reads, config)
+            reason = triage_failure(triage, config)
+            if reason is not None:
+                count(config, "triaged_samples")
+                parts = _failed_row(_sample_id(input_file.name), f"skipped by triage: {reason}", config)
+                return parts, fastq, triage
+        # anchors only exist for the tracked codons
+        if config.fast_path and not config.scan:
+            parts = classify_anchored(sequence_file, config, reads=reads)
+            if parts is not None:
+                return _add_comment(parts, "called via anchored fast path"), fastq, triage
+        if config.direct_sam:
+            parts = classify_sam(sequence_file, config, reads=reads)
+        else:
+            with stage(config, "map"):
+                bam_file = map_file(sequence_file, scratch_dir, config, reads=reads)
+            parts = classify_bam(bam_file, config)
+        if config.fast_path:
+            parts = _add_comment(parts, "called via alignment")
+        return parts, fastq, triage
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def triage_reads(input_file, reads, config):
+    """Compute the triage statistics of a sample, from its basecalled or in-memory reads if there are any."""
+    if reads is None:
+        reads = input_file.read().decode("utf-8")
+    sequence_format = "fastq" if config.input_format == "ab1" else config.input_format
+    return read_stats(reads, sequence_format, config.reference, tuple(CODONS))
+
+
+def _basecall_input(input_file, sequence_file, scratch_dir, config):
+    if config.basecaller == "native":
+        members = input_file.members if isinstance(input_file, InputGroup) else [input_file]
+        return "".join(decode_trace(member.read(), member.name) for member in members)
+    if not isinstance(input_file, InputGroup):
+        return basecall_reads(sequence_file, scratch_dir, config)
+    return "".join(basecall_reads(member.materialize(scratch_dir), scratch_dir, config)
+                   for member in input_file.members)
+
+
+def run_pipeline(tmpdir, config):
+    """Process all samples, yielding results rows in sorted order as soon as they are ready.
+
+    If the config has a cache directory, results are cached on disk and identical input files
+    are only processed once. With batch calling, all rows are yielded at the end, once the
+    whole plate has been called at once.
+    """
+    output_for(config)
+    samples = find_samples(tmpdir, config)
+
+    setup_index(config)
+    setup_cache(config)
+    setup_journal(config)
+    try:
+        rows = iter_samples(samples, tmpdir, config)
+        if config.batch_calling:
+            from .batch import build_rows
+            rows = list(rows)
+            with stage(config, "call"):
+                rows = build_rows(rows, config)
+        yield from rows
+    finally:
+        if config._cache is not None:
+            config._cache.evict()
+
+
+def output_for(config):
+    """The output files are written to, the config's output directory unless set up otherwise."""
+    if config._output is None:
+        config._output = OutputDirectory(config.outdir)
+    return config._output
+
+
+def setup_index(config):
+    """Find or build the bowtie2 and FASTA indices for the config's reference."""
+    if config._index is None:
+        margin = config.amplicon_margin if config.amplicon else None
+        config._index = ensure_index(config.reference, config.index_dir, codon_regions(config), margin,
+                                     threads=config.threads, quiet=config.quiet)
+    return config._index
+
+
+def setup_metrics(config):
+    """Set up collecting run metrics if any metrics output is requested."""
+    if config._metrics is None and (config.metrics or config.prometheus or config.profile):
+        config._metrics = RunMetrics(profile=config.profile)
+    return config._metrics
+
+
+def write_metrics(config):
+    """Write the collected run metrics to metrics.json next to results.csv, plus the requested extras."""
+    if config._metrics is None:
+        return
+    output = output_for(config)
+    output.write("metrics.json", config._metrics.to_json().encode("utf-8"))
+    if config.prometheus:
+        output.write("metrics.prom", config._metrics.to_prometheus().encode("utf-8"))
+    if config.profile:
+        stats = config._metrics.profile_stats()
+        if stats is not None:
+            output.write("profile.pstats", stats)
+
+
+def setup_journal(config, context=None):
+    """Set up the journal of a resumable run, picking up the work recorded by earlier attempts.
+
+    Raises journal.JournalError if the journal was written by a run with other settings.
+    """
+    if config.resume and config._journal is None:
+        if context is None:
+            context = run_context(config, REGIONS)
+        config._journal = Journal(journal_path(config.outdir, config.zip_results), context)
+    return config._journal
+
+
+def setup_cache(config, max_entries=None):
+    """Set up the result cache of a config, using the on-disk cache if configured.
 
+    max_entries bounds the results kept in memory, see cache.ResultCache. Without an on-disk
+    cache, only long-lived users passing max_entries get an in-memory cache, single runs don't
+    hash their inputs at all.
+    """
+    use_disk = config.cache_dir is not None and not config.no_cache
+    if not use_disk and max_entries is None:
+        config._cache = None
+        return None
+    context = run_context(config, REGIONS) if use_disk else ""
+    max_size = config.cache_size * 1024 * 1024 if config.cache_size else None
+    config._cache = ResultCache(config.cache_dir, context, max_size=max_size, refresh=config.refresh,
+                                use_disk=use_disk, max_entries=max_entries)
+    return config._cache
 
-def check_variants(tmpdir, config):
-    bam_dir = os.path.join(tmpdir, "bams")
-    outfile = open(os.path.join(config.outdir, "results.csv"), "w")
 
-    variants = REGIONS.keys()
+def write_results(rows, config):
+    """Write results rows to results.csv as they come in, and to stdout if requested."""
+    if config.batch_calling:
+        _write_results_bulk(rows, config)
+        return
+    with output_for(config).open_text("results.csv") as outfile:
+        columns = result_columns(config.scan, config._lineages is not None)
+        print(*columns, sep=",", file=outfile, flush=True)
+        if config.stdout:
+            print(*columns, sep=",", flush=True)
+        for parts in rows:
+            with stage(config, "report"):
+                line = lineage_row(parts, config)
+                print(*line, sep=",", file=outfile, flush=True)
+                if config.stdout:
+                    print(*line, sep=",", flush=True)
+                store_row(parts, config)
+
+
+def _write_results_bulk(rows, config):
+    """Write all results rows to results.csv with a single write, and to stdout if requested."""
+    rows = list(rows)
+    with stage(config, "report"):
+        lines = itertools.chain([result_columns(config.scan, config._lineages is not None)],
+                                (lineage_row(parts, config) for parts in rows))
+        text = "".join(f"{','.join(parts)}\n" for parts in lines)
+        with output_for(config).open_text("results.csv") as outfile:
+            outfile.write(text)
+        if config.stdout:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        for parts in rows:
+            store_row(parts, config)
+
+
+def store_row(parts, config):
+    """Add a results row to the config's results store, if it has one.
+
+    Rows need to be stored in the order iter_samples yielded them, which queued their input hashes.
+    """
+    if config._store is not None:
+        config._store.add(parts, config, config._digests.popleft())
+
+
+def iter_samples(samples, tmpdir, config, key=None):
+    """Process samples on the config's worker pool, yielding their results rows in the order of the samples.
+
+    key picks the input file and config of each sample, by default samples are input files processed
+    with config. With a results store, the hash of every input is queued in its config as its row is
+    yielded, so inputs sharing a sample id, like X.F.fasta and X.R.fasta, keep their own hash.
+    """
+    key = key or (lambda sample: (sample, config))
+
+    def process(sample):
+        input_file, sample_config = key(sample)
+        parts = process_sample(input_file, tmpdir, sample_config)
+        return parts, sample_config, input_file.digest() if sample_config._store is not None else None
+
+    for parts, sample_config, digest in _iter_jobs(process, samples, config):
+        if digest is not None:
+            sample_config._digests.append(digest)
+        yield parts
+
+
+def _iter_jobs(func, items, config):
+    """Run func on all items, using a pool of config.jobs worker threads.
+
+    Results are yielded in the order of the items, each as soon as it and all
+    results before it are done.
+    """
+    if config.jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.jobs) as executor:
+        yield from executor.map(func, items)
+
+
+def result_columns(scan=False, lineages=False):
     columns = ["sample"]
-    columns.extend(variants)
+    columns.extend(REGIONS.keys())
+    if scan:
+        columns.append("substitutions")
+    if lineages:
+        columns.extend(("lineage", "lineage_confidence"))
     columns.append("comment")
+    return columns
 
-    print(*columns, sep=",", file=outfile)
-    for bam_file in sorted(glob.glob(os.path.join(bam_dir, "*.bam"))):
-        base_name = os.path.basename(bam_file)
-        sample_id = base_name.split(".")[0]
-        parts = [sample_id]
-        found_mutations = set()
-        probabilities = {}
-
-        if bam_file in config._failed:
-            for variant in variants:
-                parts.append("NA")
-            parts.append("read failed to align")
-            print(*parts, sep=",", file=outfile)
-            continue
 
-        for variant in variants:
-            region = REGIONS[variant]
-            try:
-                before, after, quality = call_variant(config.reference, bam_file, region)
-                if before == after:
-                    score = min([q[0] for q in quality])
-                    probabilities[variant] = _score_to_ratio(score)
-                    parts.append("0")
-                elif after == variant[-1]:
-                    for q, mod in quality:
-                        if mod:
-                            probabilities[variant] = _score_to_ratio(q)
-                            break
-                    parts.append("1")
-                    found_mutations.add(variant)
+def lineage_row(parts, config):
+    """Add the lineage columns to a results row if the config has a lineage table."""
+    if config._lineages is None:
+        return parts
+    lineage, confidence = config._lineages.assign(parts[1:len(REGIONS) + 1])
+    return parts[:-1] + [lineage, confidence, parts[-1]]
+
+
+def classify_bam(bam_file, config):
+    """Call all tracked variants for a single bam file, returning the parts of its results row."""
+    sample_id = _sample_id(bam_file)
+
+    if bam_file in config._failed:
+        return _failed_row(sample_id, "read failed to align", config)
+
+    try:
+        with stage(config, "pileup"):
+            columns = codon_columns(bam_file, config)
+        return finish_row(sample_id, columns, config, bam_file)
+    except Exception:
+        if config.debug:
+            shutil.copy2(bam_file, "keep")
+        raise
+
+
+def classify_sam(sequence_file, config, reads=None):
+    """Map a single sequence file and call all tracked variants straight from the SAM output.
+
+    If reads is given, that fastq content is aligned instead of the content of sequence_file.
+    No bam file is created unless config.keep_bams is set, in which case a sorted and indexed
+    copy is written to the bams directory of the output directory.
+    """
+    sample_id = _sample_id(sequence_file)
+
+    with stage(config, "map"):
+        sam = align_file(sequence_file, config, reads=reads)
+    if sam is None:
+        return _failed_row(sample_id, "read failed to align", config)
+
+    if config.keep_bams:
+        bam_name = f"{os.path.basename(sequence_file)}.bam"
+        with tempfile.TemporaryDirectory() as bam_dir, stage(config, "map"):
+            bam_file = os.path.join(bam_dir, bam_name)
+            write_bam(sam, bam_file, config)
+            for name in (bam_name, f"{bam_name}.bai"):
+                if os.path.exists(os.path.join(bam_dir, name)):
+                    output_for(config).add_file(os.path.join(bam_dir, name), f"bams/{name}")
+
+    try:
+        with stage(config, "pileup"):
+            columns = alignment_columns(list(parse_sam(sam.splitlines())), config)
+        return finish_row(sample_id, columns, config, sequence_file)
+    except Exception:
+        if config.debug:
+            with open("keep", "wb") as handle:
+                handle.write(sam)
+        raise
+
+
+def classify_anchored(sequence_file, config, reads=None):
+    """Call all tracked variants by anchoring the codons in the read, without aligning it.
+
+    If reads is given, that fastq content is used instead of the content of sequence_file.
+    Returns None if the file doesn't contain exactly one read or if any codon can't be
+    anchored unambiguously, in which case the read needs to be aligned instead.
+    """
+    with stage(config, "pileup"):
+        columns = _anchored_columns(sequence_file, config, reads)
+    if columns is None:
+        return None
+
+    return finish_row(_sample_id(sequence_file), columns, config, sequence_file)
+
+
+def _anchored_columns(sequence_file, config, reads):
+    sequence_format = "fasta" if config.input_format == "fasta" else "fastq"
+    source = sequence_file if reads is None else io.StringIO(reads)
+    records = list(SeqIO.parse(source, sequence_format))
+    if len(records) != 1:
+        return None
+    record = records[0]
+    if sequence_format == "fasta":
+        qualities = [FASTA_QUALITY] * len(record)
+    else:
+        qualities = record.letter_annotations["phred_quality"]
+
+    anchors = load_anchors(config.reference, tuple(CODONS))
+    return anchored_columns(load_reference(config.reference), anchors, str(record.seq), qualities)
+
+
+def finish_row(sample_id, columns, config, source):
+    """Call the codons of a sample from its pileup columns and build its results row.
+
+    With batch calling, calling is left to batch.build_rows and a PendingRow is returned instead.
+    """
+    if config.batch_calling:
+        return PendingRow(sample_id, columns)
+    with stage(config, "call"):
+        return build_row(sample_id, _call_chunks(columns, parse_columns, source), config, source)
+
+
+def _add_comment(parts, comment):
+    if isinstance(parts, PendingRow):
+        parts.comments.append(comment)
+        return parts
+    parts[-1] = "; ".join(part for part in (parts[-1], comment) if part)
+    return parts
+
+
+def _sample_id(path):
+    base_name = os.path.basename(path)
+    return base_name.split(".")[0]
+
+
+def _failed_row(sample_id, reason, config):
+    parts = [sample_id]
+    parts.extend("NA" for _ in REGIONS)
+    if config.scan:
+        parts.append("NA")
+    parts.append(reason)
+    return parts
+
+
+def build_row(sample_id, calls, config, source):
+    """Build the parts of a results row from the codon calls of a sample."""
+    cells, found_mutations, probabilities = call_variants(calls, config, source)
+    parts = [sample_id]
+    parts.extend(cells)
+    if config.scan:
+        parts.append(list_substitutions(calls))
+    parts.append(variant_comment(found_mutations, probabilities, config))
+    return parts
+
+
+def call_variants(calls, config, source):
+    """Call every tracked variant from the codon calls of a sample.
+
+    Returns the results cells in the order of REGIONS, the set of found mutations and a dict
+    mapping each variant whose codon could be called to the quality ratio of that call.
+    """
+    cells = []
+    found_mutations = set()
+    probabilities = {}
+
+    for variant, region in REGIONS.items():
+        try:
+            call = calls[region]
+            if isinstance(call, Exception):
+                raise call
+            before, after, quality = call
+            if before == after:
+                score = min([q[0] for q in quality])
+                probabilities[variant] = _score_to_ratio(score)
+                cells.append("0")
+            elif after == variant[-1]:
+                for q, mod in quality:
+                    if mod:
+                        probabilities[variant] = _score_to_ratio(q)
+                        break
+                cells.append("1")
+                found_mutations.add(variant)
+            else:
+                if config.show_unexpected:
+                    cells.append(f"{before}{variant[1:-1]}{after}")
                 else:
-                    if config.show_unexpected:
-                        parts.append(f"{before}{variant[1:-1]}{after}")
-                    else:
-                        parts.append("0")
-            except PileupFailedError:
-                parts.append("NA")
-            except BaseDeletedError:
-                parts.append("NA")
-            except Exception:
-                if config.debug:
-                    shutil.copy2(bam_file, "keep")
-                    print(bam_file, variant)
-                raise
+                    cells.append("0")
+        except PileupFailedError:
+            count(config, "pileup_failed")
+            cells.append("NA")
+        except BaseDeletedError:
+            count(config, "base_deleted")
+            cells.append("NA")
+        except Exception:
+            if config.debug:
+                print(source, variant)
+            raise
+
+    return cells, found_mutations, probabilities
+
+
+def variant_comment(found_mutations, probabilities, config):
+    """Build the comment of a results row: the D614G warning and the found mutations with their quality ratios."""
+    comment_parts = []
+    if "D614G" not in found_mutations and not config.silence_warnings:
+        comment_parts.append(
+            f"D614G not found; low quality sequence ({probabilities.get('D614G', 'failed to map')})?")
+
+    for mut in REGIONS:
+        if mut not in found_mutations:
+            continue
+        comment_parts.append(f"{mut} found ({probabilities[mut]})")
+    return "; ".join(comment_parts)
+
+
+def list_substitutions(calls):
+    """List all amino acid substitutions in the spike codon calls in protein order, like 'D614G N501Y'."""
+    substitutions = []
+    for region, position in SPIKE_CODONS.items():
+        call = calls.get(region)
+        if call is None or isinstance(call, Exception):
+            continue
+        before, after, _ = call
+        if after in (before, "X"):
+            continue
+        substitutions.append(f"{before}{position}{after}")
+    return " ".join(substitutions)
+
+
+def codon_columns(bam_file, config):
+    """Pile up all tracked codons of a bam file using the configured pileup engine.
+
+    Returns a dict mapping each codon region to its (reference base, read base, quality) columns.
+    """
+    if config.pileup_engine == "native":
+        return alignment_columns(read_alignments(bam_file), config)
+
+    # samtools needs a .fai index next to the reference
+    reference = config._index.fasta if config._index is not None else config.reference
+    pileups = pileup_regions(reference, bam_file, codon_regions(config), config)
+    combine = config.group_pattern is not None
+    return {region: pileup_to_columns(pileup, combine) for region, pileup in pileups.items()}
+
 
-        comment_parts = []
-        if "D614G" not in found_mutations and not config.silence_warnings:
-            comment_parts.append(
-                f"D614G not found; low quality sequence ({probabilities.get('D614G', 'failed to map')})?")
+def alignment_columns(alignments, config):
+    """Pile up all tracked codons of in-memory alignments with the native engine.
 
-        for mut in variants:
-            if mut not in found_mutations:
-                continue
-            comment_parts.append(f"{mut} found ({probabilities[mut]})")
-        comment = "; ".join(comment_parts)
+    Returns the same dict as codon_columns.
+    """
+    reference = load_reference(config.reference)
+    return pileup_columns(reference, alignments, codon_regions(config), combine=config.group_pattern is not None)
 
-        parts.append(comment)
 
-        print(*parts, sep=",", file=outfile)
+def _call_chunks(chunks, parse, source):
+    calls = {}
+    for region, chunk in chunks.items():
+        try:
+            calls[region] = call_codon(*parse(chunk), source)
+        except Exception as err:
+            calls[region] = err
+    return calls
 
-    outfile.close()
 
+def pileup_regions(reference, bam_file, regions, config=None):
+    """Run one samtools mpileup per reference sequence covering all regions.
 
-def call_variant(reference, bam_file, region):
-    cmd = ["samtools", "mpileup", "-f", reference, "-r", region, bam_file]
-    mpileup = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    result = mpileup.communicate()[0].decode("utf-8")
-    before, after, quality = parse_pileup(result)
+    Returns a dict mapping each region to the pileup lines falling into it,
+    in the same format a `samtools mpileup -B -r <region>` call would produce.
+    BAQ is disabled, so quality ratios are based on the read's own base qualities
+    like with the native engine and the fast path.
+    If a config is given, the samtools runs are tracked in its metrics.
+    """
+    spans = {}
+    for region in regions:
+        chrom, start, end = _parse_region(region)
+        span_start, span_end = spans.get(chrom, (start, end))
+        spans[chrom] = (min(start, span_start), max(end, span_end))
 
+    output = []
+    for chrom, (start, end) in spans.items():
+        cmd = ["samtools", "mpileup", "-B", "-f", reference, "-r", f"{chrom}:{start}-{end}", bam_file]
+        if config is None:
+            mpileup = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        else:
+            mpileup = popen(config, cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output.append(mpileup.communicate()[0].decode("utf-8"))
+
+    return split_pileup("".join(output), regions)
+
+
+def split_pileup(pileup, regions):
+    """Distribute the lines of a multi-region pileup to the regions they cover."""
+    columns = {}
+    for line in pileup.split("\n"):
+        parts = line.split("\t", 2)
+        if len(parts) < 3 or not parts[1].isdigit():
+            continue
+        columns[(parts[0], int(parts[1]))] = line
+
+    pileups = {}
+    for region in regions:
+        chrom, start, end = _parse_region(region)
+        lines = [columns[(chrom, pos)] for pos in range(start, end + 1) if (chrom, pos) in columns]
+        pileups[region] = "".join(f"{line}\n" for line in lines)
+
+    return pileups
+
+
+def call_codon(before, after, quality, bam_file):
     if "*" in after:
         raise BaseDeletedError()
 
     try:
-        before_aa = Seq(before).translate()
-        after_aa = Seq(after).translate()
-    except Bio.Data.CodonTable.TranslationError as err:
+        before_aa = translate(before)
+        after_aa = translate(after)
+    except TranslationError as err:
         print(bam_file, err, file=sys.stderr)
         raise
 
@@ -238,22 +992,43 @@ def call_variant(reference, bam_file, region):
 
 
 def parse_pileup(pileup):
-    lines = pileup.split("\n")
-    if len(lines) < 3:
+    return parse_columns(pileup_to_columns(pileup))
+
+
+def pileup_to_columns(pileup, combine=False):
+    """Turn the lines of a codon's samtools pileup into (reference base, read base, quality) columns.
+
+    The read base and quality are taken from the first read, with combine from the read with the highest
+    quality like the native engine does. Parsing stops at the first incomplete line, so fewer
+    than three columns are returned for codons the pileup doesn't fully cover.
+    """
+    columns = []
+    for line in pileup.split("\n")[:3]:
+        parts = line.split("\t")
+        if len(parts) < 6:
+            break
+        if combine:
+            reads = _parse_read_bases(parts[2], parts[4], parts[5])
+            if not reads:
+                break
+            base, quality = max(reads, key=combined_evidence)
+            columns.append((parts[2], base, quality))
+        else:
+            columns.append((parts[2], _parse_after_base(parts[2], parts[4]), ord(parts[5][0]) - 33))
+    return columns
+
+
+def parse_columns(columns):
+    """Turn the (reference base, read base, quality) pileup columns of a codon into a call."""
+    if len(columns) < 3:
         raise PileupFailedError()
     before = ""
     after = ""
     quality = []
-    for line in lines[:3]:
-        parts = line.split("\t")
-        if len(parts) < 6:
-            raise PileupFailedError()
-
-        before += parts[2]
-        after_base = _parse_after_base(parts[2], parts[4])
+    for before_base, after_base, quality_score in columns[:3]:
+        before += before_base
         after += after_base
-        quality_score = ord(parts[5]) - 33
-        if parts[2] == after_base:
+        if before_base == after_base:
             quality.append((quality_score, False))
         else:
             quality.append((quality_score, True))
@@ -272,6 +1047,29 @@ def _parse_after_base(before_base, after_chunk):
     return after_chunk
 
 
+def _parse_read_bases(before_base, after_chunk, qualities):
+    """Split the read bases of a pileup line into one (base, quality) tuple per read."""
+    bases = []
+    i = 0
+    while i < len(after_chunk):
+        char = after_chunk[i]
+        if char == "^":
+            # read start, followed by its mapping quality
+            i += 2
+        elif char == "$":
+            i += 1
+        elif char in "+-":
+            # indel after this position: +2AT
+            digits = i + 1
+            while digits < len(after_chunk) and after_chunk[digits].isdigit():
+                digits += 1
+            i = digits + int(after_chunk[i + 1:digits])
+        else:
+            bases.append(before_base if char in {".", ","} else char)
+            i += 1
+    return [(base, ord(quality) - 33) for base, quality in zip(bases, qualities)]
+
+
 def _score_to_ratio(phredscore):
     p = 10**(phredscore / 10 * -1)
     exponent = 1
@@ -282,6 +1080,10 @@ def _score_to_ratio(phredscore):
     if base > 1:
         exponent -= 1
         base = round(p * 10**exponent, exponent)
+        if not base:
+            # scores of 4 to 9 would round down to zero
+            exponent += 1
+            base = p * 10**exponent
 
     r = round((1 / base) * 10**exponent)
     return f"1:{r:,}".replace(",", " ")
@@ -0,0 +1,183 @@
+"""Build and cache the bowtie2 indices and FASTA indices of reference files."""
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from .cache import hash_file
+from .pileup import FastaIndex
+
+INDEX_VERSION = 1
+
+
+class ReferenceIndex:
+    """The files to align and pile up against for a reference FASTA.
+
+    In amplicon mode, reads are aligned against a window of the reference sequence starting
+    after offset bases, and alignments are lifted back into full reference coordinates.
+    """
+
+    __slots__ = (
+        'chrom',
+        'fasta',
+        'length',
+        'offset',
+        'prefix',
+    )
+
+    def __init__(self, prefix, fasta, chrom=None, offset=0, length=None):
+        # bowtie2 index prefix
+        self.prefix = prefix
+        # full reference FASTA with a .fai index next to it
+        self.fasta = fasta
+        # sequence the amplicon window was cut from, if any
+        self.chrom = chrom
+        self.offset = offset
+        # full length of chrom
+        self.length = length
+
+    @property
+    def is_amplicon(self):
+        return self.chrom is not None
+
+
+def default_index_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "covid-spike-classification", "indices")
+
+
+def amplicon_window(regions, margin, entries):
+    """Find the 1-based, inclusive window covering all regions plus margin, clamped to the sequence.
+
+    entries are the FASTA index entries of the reference. Returns (chrom, start, end).
+    """
+    chrom, start, end = region_span(regions)
+    return chrom, max(1, start - margin), min(entries[chrom][0], end + margin)
+
+
+def region_span(regions):
+    """Find the 1-based, inclusive span covering all regions, which must be on one sequence.
+
+    Returns (chrom, start, end).
+    """
+    chroms = set()
+    starts = []
+    ends = []
+    for region in regions:
+        chrom, coords = region.rsplit(":", 1)
+        start, end = (int(coord) for coord in coords.split("-"))
+        chroms.add(chrom)
+        starts.append(start)
+        ends.append(end)
+    if len(chroms) != 1:
+        raise ValueError(f"Amplicon mode needs all regions on one sequence, got {sorted(chroms)}")
+    return chroms.pop(), min(starts), max(ends)
+
+
+def ensure_index(reference, index_dir, regions=None, amplicon_margin=None, threads=1, quiet=False):
+    """Find or build the indices for a reference.
+
+    Without amplicon_margin, the bowtie2 index and .fai built by ref/build_indices.sh next to the
+    reference are used if they exist. Everything else is built on first use and cached in
+    index_dir, keyed by a hash of the reference file and, for amplicon indices, the regions
+    and margin the window was cut with.
+    """
+    name, _ = os.path.splitext(reference)
+    legacy_prefix = f"{name}.index"
+    has_fai = os.path.exists(f"{reference}.fai")
+    if amplicon_margin is None and has_fai and _has_bowtie_index(legacy_prefix):
+        return ReferenceIndex(legacy_prefix, reference)
+
+    if amplicon_margin is None:
+        mode = "full"
+    else:
+        chrom, start, end = region_span(regions)
+        mode = f"amplicon{amplicon_margin}-{chrom}-{start}-{end}"
+    key = f"v{INDEX_VERSION}-{hash_file(reference)[:16]}-{mode}"
+    target = os.path.join(index_dir, key)
+    if not os.path.isdir(target):
+        _build(reference, index_dir, target, regions, amplicon_margin, threads, quiet)
+
+    fasta = reference if has_fai else os.path.join(target, "reference.fasta")
+    if amplicon_margin is None:
+        return ReferenceIndex(os.path.join(target, "reference.index"), fasta)
+
+    entries = FastaIndex(os.path.join(target, "reference.fasta")).entries
+    chrom, start, _ = amplicon_window(regions, amplicon_margin, entries)
+    return ReferenceIndex(os.path.join(target, "amplicon.index"), fasta, chrom, start - 1, entries[chrom][0])
+
+
+def _has_bowtie_index(prefix):
+    return os.path.exists(f"{prefix}.1.bt2") or os.path.exists(f"{prefix}.1.bt2l")
+
+
+def _build(reference, index_dir, target, regions, amplicon_margin, threads, quiet):
+    """Build all index files in a scratch directory, then move it into place in one step."""
+    os.makedirs(index_dir, exist_ok=True)
+    scratch = tempfile.mkdtemp(dir=index_dir)
+    try:
+        fasta = os.path.join(scratch, "reference.fasta")
+        shutil.copyfile(reference, fasta)
+        fasta_index = FastaIndex(fasta)
+        write_fai(fasta_index.entries, f"{fasta}.fai")
+
+        if amplicon_margin is None:
+            _bowtie2_build(fasta, os.path.join(scratch, "reference.index"), threads, quiet)
+        else:
+            chrom, start, end = amplicon_window(regions, amplicon_margin, fasta_index.entries)
+            amplicon = os.path.join(scratch, "amplicon.fasta")
+            with open(amplicon, "w") as handle:
+                # keep the sequence name, so lifted alignments match the full reference
+                handle.write(f">{chrom}\n")
+                sequence = fasta_index.fetch(chrom, start, end)
+                for i in range(0, len(sequence), 70):
+                    handle.write(f"{sequence[i:i + 70]}\n")
+            _bowtie2_build(amplicon, os.path.join(scratch, "amplicon.index"), threads, quiet)
+
+        try:
+            os.rename(scratch, target)
+        except OSError:
+            # built by a concurrent run in the meantime
+            if not os.path.isdir(target):
+                raise
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _bowtie2_build(fasta, prefix, threads, quiet):
+    cmd = ["bowtie2-build", "--threads", str(threads), fasta, prefix]
+    kwargs = {}
+    if quiet:
+        kwargs["stdout"] = subprocess.DEVNULL
+        kwargs["stderr"] = subprocess.DEVNULL
+    subprocess.check_call(cmd, **kwargs)
+
+
+def write_fai(entries, path):
+    """Write FASTA index entries in the format of samtools faidx."""
+    with open(path, "w") as handle:
+        for name, values in entries.items():
+            print(name, *values, sep="\t", file=handle)
+
+
+def lift_sam(sam, index):
+    """Lift SAM output aligned against an amplicon window back into full reference coordinates."""
+    if not index.is_amplicon:
+        return sam
+    chrom = index.chrom.encode("ascii")
+    lines = []
+    for line in sam.split(b"\n"):
+        parts = line.split(b"\t")
+        if line.startswith(b"@SQ") and f"SN:{index.chrom}".encode("ascii") in parts:
+            line = b"\t".join(f"LN:{index.length}".encode("ascii") if part.startswith(b"LN:") else part
+                              for part in parts)
+        elif not line.startswith(b"@") and len(parts) > 7:
+            if parts[2] == chrom and parts[3] != b"0":
+                parts[3] = str(int(parts[3]) + index.offset).encode("ascii")
+            mate_chrom = parts[2] if parts[6] == b"=" else parts[6]
+            if mate_chrom == chrom and parts[7] != b"0":
+                parts[7] = str(int(parts[7]) + index.offset).encode("ascii")
+            line = b"\t".join(parts)
+        lines.append(line)
+    return b"\n".join(lines)
@@ -0,0 +1,102 @@
+"""Journal the progress of a run, so an interrupted run can be resumed where it stopped."""
+
+import json
+import os
+import threading
+
+JOURNAL = "journal.jsonl"
+JOURNAL_VERSION = 1
+
+
+class JournalError(ValueError):
+    pass
+
+
+class SampleRecord:
+    """What the journal knows about one input file: its basecalled reads and its results entry once done."""
+
+    __slots__ = (
+        'digest',
+        'entry',
+        'fastq',
+        'name',
+    )
+
+    def __init__(self, name, digest):
+        self.name = name
+        self.digest = digest
+        self.fastq = None
+        self.entry = None
+
+
+class Journal:
+    """Append-only JSON lines file recording the stages each sample has completed.
+
+    The first line records the run context, a journal of a run with a different reference,
+    tools or options can't be resumed. Samples are identified by file name and content hash,
+    so changed input files are processed again. A line cut short by a crash is ignored.
+    """
+
+    def __init__(self, path, context):
+        self.path = path
+        self.context = context
+        self._lock = threading.Lock()
+        # (name, digest): {"basecall": fastq, "done": results entry}
+        self._stages = {}
+        if os.path.exists(path) and os.path.getsize(path):
+            self._load()
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._append({"version": JOURNAL_VERSION, "context": context})
+
+    def _load(self):
+        with open(self.path, "r") as handle:
+            lines = handle.read().splitlines()
+        header = _parse_line(lines[0]) if lines else None
+        if header is None or header.get("version") != JOURNAL_VERSION or header.get("context") != self.context:
+            raise JournalError(f"{self.path} was written by a run with a different reference, tools or options")
+        for line in lines[1:]:
+            item = _parse_line(line)
+            # failed samples are retried from their last completed stage
+            if item is None or item["stage"] == "failed":
+                continue
+            self._stages.setdefault((item["sample"], item["digest"]), {})[item["stage"]] = item["data"]
+
+    def lookup(self, input_file):
+        """Return the SampleRecord of an input file."""
+        record = SampleRecord(input_file.name, input_file.digest())
+        with self._lock:
+            stages = self._stages.get((record.name, record.digest), {})
+            record.fastq = stages.get("basecall")
+            record.entry = stages.get("done")
+        return record
+
+    def record(self, record, stage, data):
+        """Record that a sample completed a stage, "basecall" with its fastq or "done" with its results entry.
+
+        Failed samples are recorded as stage "failed" with the reason as data.
+        """
+        with self._lock:
+            if stage != "failed":
+                self._stages.setdefault((record.name, record.digest), {})[stage] = data
+            self._append({"sample": record.name, "digest": record.digest, "stage": stage, "data": data})
+
+    def _append(self, item):
+        with open(self.path, "a") as handle:
+            handle.write(json.dumps(item) + "\n")
+            handle.flush()
+            os.fsync(handle.fileno())
+
+
+def _parse_line(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def journal_path(outdir, zip_results=False):
+    """Path of the journal of an output, next to the zip file if results are zipped."""
+    if zip_results:
+        return f"{outdir}.{JOURNAL}"
+    return os.path.join(outdir, JOURNAL)
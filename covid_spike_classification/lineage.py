@@ -0,0 +1,157 @@
+"""Assign lineages to samples from their mutation profiles, using bitsets over the results columns."""
+
+import csv
+
+from .core import REGIONS
+
+
+class LineageError(ValueError):
+    pass
+
+
+def read_lineages(path, variants=tuple(REGIONS)):
+    """Read a lineage table, returning a list of (lineage, required mutations, optional mutations) tuples.
+
+    The table is a CSV file with the columns lineage, required and optional, the mutations
+    space-separated like 'N501Y D614G'. Lines starting with # are skipped. Raises LineageError
+    for mutations that aren't results columns and for lineages defined twice.
+    """
+    lineages = []
+    seen = set()
+    with open(path, "r", newline="") as handle:
+        rows = csv.DictReader(line for line in handle if not line.startswith("#"))
+        if rows.fieldnames is None or not {"lineage", "required"} <= set(rows.fieldnames):
+            raise LineageError(f"{path} needs a lineage and a required column")
+        for row in rows:
+            name = row["lineage"].strip()
+            if not name:
+                continue
+            if name in seen:
+                raise LineageError(f"Lineage {name} is defined twice in {path}")
+            seen.add(name)
+            required = (row["required"] or "").split()
+            optional = (row.get("optional") or "").split()
+            unknown = sorted(set(required + optional) - set(variants))
+            if unknown:
+                raise LineageError(f"Lineage {name} in {path} has mutations that aren't tracked: {' '.join(unknown)}")
+            lineages.append((name, required, optional))
+    return lineages
+
+
+class LineageIndex:
+    """Lineage definitions compiled into bitsets over the results columns.
+
+    Bit i of a mutation bitset stands for the i-th variant. A sample's profile is two such bitsets:
+    the mutations found, and the mutations whose codon was called at all, NA cells are unknown.
+    A lineage is compatible with a sample unless the sample lacks a required mutation, or has
+    one the lineage neither requires nor allows. Compatibility is filtered for all lineages at
+    once with a bitset over the lineages per column, only the compatible lineages are ranked.
+    """
+
+    def __init__(self, lineages, variants=tuple(REGIONS)):
+        self.variants = tuple(variants)
+        self.names = [name for name, _, _ in lineages]
+        bits = {variant: 1 << index for index, variant in enumerate(self.variants)}
+        self.required = [_mask(required, bits) for _, required, _ in lineages]
+        self.optional = [_mask(optional, bits) for _, _, optional in lineages]
+        # per column, the lineages that require or allow its mutation
+        self.requiring = [0] * len(self.variants)
+        self.allowing = [0] * len(self.variants)
+        for index, (required, optional) in enumerate(zip(self.required, self.optional)):
+            for column in range(len(self.variants)):
+                if required >> column & 1:
+                    self.requiring[column] |= 1 << index
+                if (required | optional) >> column & 1:
+                    self.allowing[column] |= 1 << index
+        self._all = (1 << len(self.names)) - 1
+        # samples share few distinct profiles
+        self._assigned = {}
+
+    @classmethod
+    def from_file(cls, path, variants=tuple(REGIONS)):
+        return cls(read_lineages(path, variants), variants)
+
+    def profile(self, cells):
+        """Turn the results cells of a sample into its (found, called) bitsets."""
+        found = called = 0
+        for column, cell in enumerate(cells):
+            if cell == "NA":
+                continue
+            called |= 1 << column
+            if cell == "1":
+                found |= 1 << column
+        return found, called
+
+    def compatible(self, found, called):
+        """Bitset of the lineages compatible with a profile."""
+        candidates = self._all
+        for column in range(len(self.variants)):
+            if not called >> column & 1:
+                continue
+            if found >> column & 1:
+                candidates &= self.allowing[column]
+            else:
+                candidates &= ~self.requiring[column]
+        return candidates
+
+    def assign(self, cells):
+        """Return the best lineages of a sample, space-separated, and the confidence of the match.
+
+        The best lineages are the compatible ones with the most required mutations found, then
+        the most optional mutations found, then the fewest required mutations unknown. The
+        confidence is the share of the columns a lineage is defined by, all but its optional
+        mutations, that were called. Samples without calls get NA, samples no lineage is
+        compatible with 'unassigned', both with a confidence of 0.
+        """
+        signature = self.profile(cells)
+        if signature not in self._assigned:
+            self._assigned[signature] = self._assign(*signature)
+        return self._assigned[signature]
+
+    def _assign(self, found, called):
+        if not called:
+            return "NA", "0"
+        candidates = self.compatible(found, called)
+        best = []
+        best_key = None
+        index = 0
+        while candidates:
+            if candidates & 1:
+                required = self.required[index]
+                optional = self.optional[index]
+                defining = len(self.variants) - _count(optional)
+                confidence = _count(called & ~optional) / defining if defining else 1.0
+                key = (_count(required & found), _count(optional & found), -_count(required & ~called), confidence)
+                if best_key is None or key > best_key:
+                    best, best_key = [self.names[index]], key
+                elif key == best_key:
+                    best.append(self.names[index])
+            candidates >>= 1
+            index += 1
+        if not best:
+            return "unassigned", "0"
+        return " ".join(best), f"{best_key[-1]:.2f}"
+
+
+def _mask(mutations, bits):
+    mask = 0
+    for mutation in mutations:
+        mask |= bits[mutation]
+    return mask
+
+
+def _count(bitset):
+    return bin(bitset).count("1")
+
+
+def setup_lineages(config):
+    """Load and compile the lineage table of a config, if it has one.
+
+    Raises LineageError if the table is invalid or can't be read.
+    """
+    if config.lineages is not None and config._lineages is None:
+        try:
+            config._lineages = LineageIndex.from_file(config.lineages)
+        except OSError as err:
+            raise LineageError(str(err)) from err
+    return config._lineages
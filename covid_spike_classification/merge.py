@@ -0,0 +1,148 @@
+"""Merge the outputs of sharded runs into the output a single run would have written."""
+
+import argparse
+import json
+import os
+import sys
+import zipfile
+
+from .archive import OutputDirectory, OutputZip
+from .core import SHARD_INFO
+from .journal import JOURNAL
+from .triage import TRIAGE_FILE
+
+RESULTS = "results.csv"
+# tables with one row per sample, merged like results.csv
+TABLES = (RESULTS, TRIAGE_FILE)
+# files describing a single shard's run, which don't carry over to the merged output
+RUN_FILES = {SHARD_INFO, JOURNAL, "metrics.json", "metrics.prom", "profile.pstats"}
+
+
+class MergeError(ValueError):
+    pass
+
+
+class ShardOutput:
+    """Read the files of a shard's output directory or zip file."""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.isdir(path):
+            self.names = sorted(
+                os.path.relpath(os.path.join(root, name), path).replace(os.sep, "/")
+                for root, _, files in os.walk(path) for name in files
+            )
+            self._zip_file = None
+        else:
+            self._zip_file = zipfile.ZipFile(path)
+            self.names = sorted(name for name in self._zip_file.namelist() if not name.endswith("/"))
+
+    def read(self, name):
+        if self._zip_file is not None:
+            return self._zip_file.read(name)
+        with open(os.path.join(self.path, name), "rb") as handle:
+            return handle.read()
+
+    def close(self):
+        if self._zip_file is not None:
+            self._zip_file.close()
+
+
+def check_shards(shards):
+    """Make sure the shards are a complete, non-overlapping set, if they recorded their shard."""
+    infos = []
+    for shard in shards:
+        if SHARD_INFO in shard.names:
+            info = json.loads(shard.read(SHARD_INFO))
+            infos.append((info["shard"], info["shards"]))
+    if not infos:
+        return
+
+    if len(infos) != len(shards):
+        raise MergeError("Only some outputs record their shard, are they from the same sharded run?")
+    counts = {count for _, count in infos}
+    if len(counts) != 1:
+        raise MergeError(f"Outputs come from runs with different shard counts: {sorted(counts)}")
+    found = sorted(index for index, _ in infos)
+    if len(found) != len(set(found)):
+        raise MergeError(f"Some shards are given more than once: {found}")
+    missing = sorted(set(range(1, counts.pop() + 1)) - set(found))
+    if missing:
+        raise MergeError(f"Missing shards: {', '.join(map(str, missing))}")
+
+
+def input_names(shards):
+    """Map the samples of all shards to their input file names, as far as the shards recorded them."""
+    names = {}
+    for shard in shards:
+        if SHARD_INFO in shard.names:
+            for sample, name in json.loads(shard.read(SHARD_INFO)).get("inputs", []):
+                names.setdefault(sample, name)
+    return names
+
+
+def merge_results(shards, name=RESULTS, sort_keys=None):
+    """Merge the results.csv files, or the name tables, of all shards, returning the text of the merged file.
+
+    Rows are sorted by sample, or by the key sort_keys maps their sample to, rows of the same sample
+    keep the order of the shards.
+    """
+    header = None
+    rows = []
+    for shard in shards:
+        if name not in shard.names:
+            raise MergeError(f"{shard.path} has no {name}")
+        lines = shard.read(name).decode("utf-8").splitlines()
+        if not lines:
+            raise MergeError(f"{name} of {shard.path} is empty")
+        if header is None:
+            header = lines[0]
+        elif lines[0] != header:
+            raise MergeError(f"{name} of {shard.path} has different columns, was it run with other options?")
+        rows.extend(line for line in lines[1:] if line)
+
+    sort_keys = sort_keys or {}
+    rows.sort(key=lambda line: sort_keys.get(line.split(",", 1)[0], line.split(",", 1)[0]))
+    return "".join(f"{line}\n" for line in [header] + rows)
+
+
+def merge(paths, outdir, zip_results=False):
+    """Merge the shard outputs at paths into outdir, or outdir.zip with zip_results."""
+    shards = [ShardOutput(path) for path in paths]
+    try:
+        check_shards(shards)
+        # a single run writes the results in the order of the input file names, triage.csv by sample
+        results = merge_results(shards, sort_keys=input_names(shards))
+        output = OutputZip(f"{outdir}.zip") if zip_results else OutputDirectory(outdir)
+        try:
+            output.write(RESULTS, results.encode("utf-8"))
+            if any(TRIAGE_FILE in shard.names for shard in shards):
+                output.write(TRIAGE_FILE, merge_results(shards, TRIAGE_FILE).encode("utf-8"))
+            # fastqs and bams of the samples, every sample is only in one shard
+            for shard in shards:
+                for name in shard.names:
+                    if name not in TABLES and name not in RUN_FILES:
+                        output.write(name, shard.read(name))
+        finally:
+            output.close()
+    finally:
+        for shard in shards:
+            shard.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="covid-spike-classification merge",
+                                     description="Merge the outputs of runs with --shard into one output.")
+    parser.add_argument("shards", nargs="+",
+                        help="Output directories or zip files of the shards.")
+    parser.add_argument("-o", "--outdir", required=True,
+                        help="Directory to write the merged results to.")
+    parser.add_argument("-z", "--zip-results", action="store_true", default=False,
+                        help="Create a zipfile from the output directory instead of the output directory.")
+    args = parser.parse_args(argv)
+
+    try:
+        merge(args.shards, args.outdir, args.zip_results)
+    except (MergeError, OSError, zipfile.BadZipFile) as err:
+        print(f"Failed to merge: {err}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,311 @@
+"""Collect timings of the pipeline stages and the external tools, counters and profiles of a run."""
+
+import contextlib
+import cProfile
+import json
+import marshal
+import os
+import pstats
+import subprocess
+import sys
+import threading
+import time
+
+STAGES = ("basecall", "triage", "map", "pileup", "call", "report")
+COUNTERS = ("cache_hits", "cache_misses", "failed_alignments", "pileup_failed", "base_deleted", "failed_samples",
+            "resumed_samples", "triaged_samples")
+# name, type, help text, section of the metrics, label and key of the per-label totals
+PROMETHEUS_TABLES = (
+    ("stage_calls_total", "counter", "Number of times each pipeline stage ran.", "stages", "stage", "calls"),
+    ("stage_wall_seconds_total", "counter", "Wall time spent in each pipeline stage.", "stages", "stage", "wall"),
+    ("stage_cpu_seconds_total", "counter", "Python CPU time spent in each pipeline stage.", "stages", "stage", "cpu"),
+    ("tool_calls_total", "counter", "Number of processes run of each external tool.", "tools", "tool", "calls"),
+    ("tool_failures_total", "counter", "Number of failed processes of each external tool.", "tools", "tool",
+     "failures"),
+    ("tool_wall_seconds_total", "counter", "Wall time of the processes of each external tool.", "tools", "tool",
+     "wall"),
+    ("tool_cpu_seconds_total", "counter", "CPU time of the processes of each external tool.", "tools", "tool", "cpu"),
+    ("tool_max_rss_bytes", "gauge", "Peak resident memory of any process of each external tool.", "tools", "tool",
+     "max_rss"),
+)
+# ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+class RunMetrics:
+    """Wall time, CPU time and calls per pipeline stage and external tool, overall and per sample.
+
+    Stage CPU time is the time spent in the Python thread running the stage, the CPU time of the
+    external tools is recorded separately for every process they run. If profile is set, the
+    Python side of the run and of every sample is profiled with cProfile. Long-lived processes
+    can turn off per_sample, so only the totals are kept.
+    """
+
+    def __init__(self, profile=False, per_sample=True):
+        self.profile = profile
+        self.per_sample = per_sample
+        self.stages = {}
+        self.tools = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.samples = {}
+        # samples processed without per_sample
+        self.sample_count = 0
+        self.wall = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = []
+
+    def add(self, name, wall, cpu):
+        """Add a stage timing, to the current sample as well if there is one."""
+        with self._lock:
+            _add_timing(self.stages, name, wall, cpu)
+            sample = self.current_sample()
+            if sample is not None:
+                _add_timing(self.samples[sample]["stages"], name, wall, cpu)
+
+    def add_process(self, sample, cmd, wall, cpu, max_rss, exit_status):
+        """Add the resource usage of an external tool's process that ran for sample."""
+        tool = tool_name(cmd)
+        with self._lock:
+            totals = _add_timing(self.tools, tool, wall, cpu)
+            totals.setdefault("max_rss", 0)
+            totals.setdefault("failures", 0)
+            totals["max_rss"] = max(totals["max_rss"], max_rss)
+            totals["failures"] += exit_status != 0
+            if sample is not None:
+                self.samples[sample]["processes"].append({
+                    "tool": tool,
+                    "wall": wall,
+                    "cpu": cpu,
+                    "max_rss": max_rss,
+                    "exit_status": exit_status,
+                })
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def current_sample(self):
+        """Name of the sample the current thread is working on, or None."""
+        return getattr(self._local, "sample", None)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    @contextlib.contextmanager
+    def sample(self, name):
+        """Attribute the stages and processes run by the current thread to the sample name."""
+        if not self.per_sample:
+            with self._lock:
+                self.sample_count += 1
+            with self._profiling():
+                yield
+            return
+        with self._lock:
+            self.samples.setdefault(name, {"stages": {}, "processes": []})
+        previous = self.current_sample()
+        self._local.sample = name
+        try:
+            with self._profiling():
+                yield
+        finally:
+            self._local.sample = previous
+
+    @contextlib.contextmanager
+    def run(self):
+        """Time the whole run, profiling the current thread if requested."""
+        start = time.perf_counter()
+        try:
+            with self._profiling():
+                yield
+        finally:
+            self.wall += time.perf_counter() - start
+
+    @contextlib.contextmanager
+    def _profiling(self):
+        # only one profiler can be active per thread, nested contexts are covered by the outer one
+        if not self.profile or getattr(self._local, "profiler", None) is not None:
+            yield
+            return
+        profiler = cProfile.Profile()
+        self._local.profiler = profiler
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._local.profiler = None
+            with self._lock:
+                self._profiles.append(profiler)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "wall": self.wall,
+                "stages": {name: dict(totals) for name, totals in self.stages.items()},
+                "tools": {name: dict(totals) for name, totals in self.tools.items()},
+                "counters": dict(self.counters),
+                "samples": {
+                    name: {
+                        "stages": {stage: dict(totals) for stage, totals in sample["stages"].items()},
+                        "processes": [dict(process) for process in sample["processes"]],
+                    }
+                    for name, sample in sorted(self.samples.items())
+                },
+            }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_prometheus(self):
+        """Render the run totals in the Prometheus text format, for node_exporter's textfile collector."""
+        metrics = self.as_dict()
+        lines = []
+        for name, kind, help_text, values in (
+                ("run_duration_seconds", "gauge", "Wall time of the run.", {"": metrics["wall"]}),
+                ("samples", "gauge", "Number of samples processed.",
+                 {"": len(metrics["samples"]) if self.per_sample else self.sample_count}),
+        ):
+            lines.extend(_prometheus_metric(name, kind, help_text, None, values))
+        for name, kind, help_text, section, label, key in PROMETHEUS_TABLES:
+            values = {value: totals[key] for value, totals in metrics[section].items()}
+            lines.extend(_prometheus_metric(name, kind, help_text, label, values))
+        for counter, value in metrics["counters"].items():
+            help_text = f"Number of {counter.replace('_', ' ')}."
+            lines.extend(_prometheus_metric(f"{counter}_total", "counter", help_text, None, {"": value}))
+        return "".join(f"{line}\n" for line in lines)
+
+    def profile_stats(self):
+        """Return the merged profiles as the content of a pstats file, or None if nothing was profiled."""
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return marshal.dumps(stats.stats)
+
+
+def _prometheus_metric(name, kind, help_text, label, values):
+    yield f"# HELP csc_{name} {help_text}"
+    yield f"# TYPE csc_{name} {kind}"
+    for label_value, value in values.items():
+        if label is None:
+            yield f"csc_{name} {value}"
+        else:
+            yield f'csc_{name}{{{label}="{_escape_label(label_value)}"}} {value}'
+
+
+def _add_timing(table, name, wall, cpu):
+    totals = table.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+    totals["calls"] += 1
+    totals["wall"] += wall
+    totals["cpu"] += cpu
+    return totals
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def tool_name(cmd):
+    """Name a tool by its executable and subcommand, like 'samtools sort' or 'bowtie2'."""
+    parts = [os.path.basename(str(cmd[0]))]
+    if len(cmd) > 1 and str(cmd[1]).isalpha():
+        parts.append(str(cmd[1]))
+    return " ".join(parts)
+
+
+class TrackedPopen(subprocess.Popen):
+    """A Popen that records the wall time, CPU time, peak memory and exit status of its process.
+
+    The process is recorded when it is reaped by wait() without a timeout, which communicate()
+    and leaving the with block use as well.
+    """
+
+    def __init__(self, run_metrics, args, **kwargs):
+        self._run_metrics = run_metrics
+        self._sample = run_metrics.current_sample()
+        self._started = time.perf_counter()
+        super().__init__(args, **kwargs)
+
+    def wait(self, timeout=None):
+        if self.returncode is None and timeout is None:
+            # reap the process with wait4 before Popen does, it also reports the resource usage
+            try:
+                _, status, usage = os.wait4(self.pid, 0)
+            except ChildProcessError:
+                # reaped elsewhere, Popen's own wait deals with that
+                return super().wait()
+            self.returncode = exit_code(status)
+            self._run_metrics.add_process(self._sample, self.args, time.perf_counter() - self._started,
+                                          usage.ru_utime + usage.ru_stime, usage.ru_maxrss * RSS_UNIT,
+                                          self.returncode)
+        return super().wait(timeout)
+
+
+def exit_code(status):
+    """Turn a wait status into a returncode like Popen's, negative for the signal that ended the process."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return status
+
+
+def stage(config, name):
+    """Time a pipeline stage if the config collects metrics."""
+    if config._metrics is None:
+        return contextlib.nullcontext()
+    return config._metrics.stage(name)
+
+
+def track_run(config):
+    """Time the whole run if the config collects metrics."""
+    if config._metrics is None:
+        return contextlib.nullcontext()
+    return config._metrics.run()
+
+
+def track_sample(config, name):
+    """Attribute the work of the current thread to a sample if the config collects metrics."""
+    if config._metrics is None:
+        return contextlib.nullcontext()
+    return config._metrics.sample(name)
+
+
+def count(config, name, amount=1):
+    """Increase a counter if the config collects metrics."""
+    if config._metrics is not None:
+        config._metrics.count(name, amount)
+
+
+def popen(config, cmd, **kwargs):
+    """Start an external tool like subprocess.Popen, tracking its resource usage if the config collects metrics."""
+    if config._metrics is None:
+        return subprocess.Popen(cmd, **kwargs)
+    return TrackedPopen(config._metrics, cmd, **kwargs)
+
+
+def call_tool(config, cmd, **kwargs):
+    """Run an external tool like subprocess.call, tracking its resource usage if the config collects metrics."""
+    with popen(config, cmd, **kwargs) as process:
+        try:
+            return process.wait()
+        except BaseException:
+            process.kill()
+            raise
+
+
+def check_call_tool(config, cmd, **kwargs):
+    """Run an external tool like subprocess.check_call, tracking its resource usage if the config collects metrics."""
+    returncode = call_tool(config, cmd, **kwargs)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
@@ -0,0 +1,302 @@
+"""In-process pileup engine reading SAM/BAM alignments without samtools."""
+
+import bisect
+import functools
+import gzip
+import mmap
+import os
+import struct
+
+CIGAR_OPS = "MIDNSHP=X"
+BAM_SEQ_CODES = "=ACMGRSVTWYHKDBN"
+
+# reads samtools mpileup skips by default: unmapped, secondary, QC failed, duplicates
+SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_REVERSE = 0x10
+
+# samtools mpileup defaults
+MIN_BASE_QUALITY = 13
+MISSING_QUALITY = 0xff
+MAX_PRINTED_QUALITY = 93
+
+
+class Alignment:
+    __slots__ = (
+        'cigar',
+        'flag',
+        'position',
+        'qualities',
+        'reference_name',
+        'sequence',
+    )
+
+    def __init__(self, reference_name, position, flag, cigar, sequence, qualities):
+        self.reference_name = reference_name
+        # 1-based leftmost mapping position
+        self.position = position
+        self.flag = flag
+        # list of (operation, length) tuples
+        self.cigar = cigar
+        self.sequence = sequence
+        # list of phred scores, one per base of the sequence
+        self.qualities = qualities
+
+    @property
+    def is_reverse(self):
+        return bool(self.flag & FLAG_REVERSE)
+
+    @property
+    def is_pileup_candidate(self):
+        """Whether samtools mpileup would consider this read with its default filters."""
+        if self.flag & SKIP_FLAGS or not self.cigar:
+            return False
+        # anomalous read pairs are skipped by default
+        if self.flag & FLAG_PAIRED and not self.flag & FLAG_PROPER_PAIR:
+            return False
+        return True
+
+
+class FastaIndex:
+    """Random access to a FASTA file via its .fai index and a memory map."""
+
+    def __init__(self, fasta_path):
+        self.path = fasta_path
+        with open(fasta_path, "rb") as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fai_path = f"{fasta_path}.fai"
+        if os.path.exists(fai_path):
+            with open(fai_path, "r") as handle:
+                self.entries = parse_fai(handle)
+        else:
+            self.entries = build_fai(self._map)
+
+    def fetch(self, name, start, end):
+        """Fetch the bases from start to end (1-based, inclusive) of sequence name."""
+        length, offset, line_bases, line_width = self.entries[name]
+        start = max(start, 1)
+        end = min(end, length)
+        if start > end:
+            return ""
+        first = offset + ((start - 1) // line_bases) * line_width + (start - 1) % line_bases
+        last = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases
+        return self._map[first:last + 1].decode("ascii").replace("\n", "").replace("\r", "")
+
+
+def parse_fai(handle):
+    """Parse a samtools faidx index into a dict of name: (length, offset, line bases, line width)."""
+    entries = {}
+    for line in handle:
+        parts = line.rstrip("\n").split("\t")
+        if len(parts) < 5:
+            continue
+        entries[parts[0]] = tuple(int(part) for part in parts[1:5])
+    return entries
+
+
+def build_fai(data):
+    """Build the equivalent of a samtools faidx index for an in-memory FASTA file."""
+    entries = {}
+    name = None
+    offset = length = line_bases = line_width = 0
+    pos = 0
+    size = len(data)
+    while pos < size:
+        newline = data.find(b"\n", pos)
+        if newline == -1:
+            newline = size
+        line = data[pos:newline]
+        if line.startswith(b">"):
+            if name is not None:
+                entries[name] = (length, offset, line_bases, line_width)
+            name = line[1:].split()[0].decode("ascii")
+            offset = newline + 1
+            length = line_bases = line_width = 0
+        elif name is not None:
+            bases = len(line.rstrip(b"\r"))
+            if not line_bases:
+                line_bases = bases
+                line_width = newline + 1 - pos
+            length += bases
+        pos = newline + 1
+    if name is not None:
+        entries[name] = (length, offset, line_bases, line_width)
+    return entries
+
+
+@functools.lru_cache(maxsize=None)
+def load_reference(fasta_path):
+    """Load a reference FASTA, shared between all callers using the same path."""
+    return FastaIndex(fasta_path)
+
+
+def parse_cigar(cigar_string):
+    if cigar_string == "*":
+        return []
+    cigar = []
+    number = ""
+    for char in cigar_string:
+        if char.isdigit():
+            number += char
+        else:
+            cigar.append((char, int(number)))
+            number = ""
+    return cigar
+
+
+def parse_sam(lines):
+    """Parse alignments from the lines of a SAM file, skipping the header."""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.rstrip("\r\n")
+        if not line or line.startswith("@"):
+            continue
+        parts = line.split("\t")
+        sequence = parts[9]
+        if parts[10] == "*":
+            qualities = [MISSING_QUALITY] * len(sequence)
+        else:
+            qualities = [ord(char) - 33 for char in parts[10]]
+        yield Alignment(parts[2], int(parts[3]), int(parts[1]), parse_cigar(parts[5]), sequence, qualities)
+
+
+def parse_bam(handle):
+    """Parse alignments from a (BGZF compressed) BAM file handle."""
+    data = gzip.GzipFile(fileobj=handle)
+    if data.read(4) != b"BAM\1":
+        raise ValueError("Not a BAM file")
+    l_text, = struct.unpack("<i", data.read(4))
+    data.read(l_text)
+    n_ref, = struct.unpack("<i", data.read(4))
+    references = []
+    for _ in range(n_ref):
+        l_name, = struct.unpack("<i", data.read(4))
+        references.append(data.read(l_name).rstrip(b"\0").decode("ascii"))
+        data.read(4)
+
+    while True:
+        size_bytes = data.read(4)
+        if len(size_bytes) < 4:
+            break
+        block_size, = struct.unpack("<i", size_bytes)
+        block = data.read(block_size)
+        (ref_id, pos, l_read_name, _, _, n_cigar_op, flag, l_seq,
+         _, _, _) = struct.unpack_from("<iiBBHHHiiii", block)
+        offset = 32 + l_read_name
+        cigar = []
+        for value in struct.unpack_from(f"<{n_cigar_op}I", block, offset):
+            cigar.append((CIGAR_OPS[value & 0xf], value >> 4))
+        offset += 4 * n_cigar_op
+        packed = block[offset:offset + (l_seq + 1) // 2]
+        sequence = "".join(BAM_SEQ_CODES[byte >> 4] + BAM_SEQ_CODES[byte & 0xf] for byte in packed)[:l_seq]
+        offset += (l_seq + 1) // 2
+        qualities = list(block[offset:offset + l_seq])
+        reference_name = references[ref_id] if ref_id >= 0 else "*"
+        yield Alignment(reference_name, pos + 1, flag, cigar, sequence, qualities)
+
+
+def read_alignments(path):
+    """Read all alignments from a SAM or BAM file."""
+    with open(path, "rb") as handle:
+        if handle.read(2) == b"\x1f\x8b":
+            handle.seek(0)
+            return list(parse_bam(handle))
+        handle.seek(0)
+        return list(parse_sam(handle))
+
+
+def _aligned_bases(alignment, positions):
+    """Find the read base and quality at each of the sorted target positions the alignment covers.
+
+    Deleted positions are reported with a '*' base and the quality of the next read base,
+    like samtools does.
+    """
+    bases = {}
+    ref_pos = alignment.position
+    query_pos = 0
+    for operation, length in alignment.cigar:
+        if operation in "M=X":
+            first = bisect.bisect_left(positions, ref_pos)
+            last = bisect.bisect_left(positions, ref_pos + length)
+            for target in positions[first:last]:
+                offset = query_pos + target - ref_pos
+                bases[target] = (alignment.sequence[offset], alignment.qualities[offset])
+            ref_pos += length
+            query_pos += length
+        elif operation == "D":
+            first = bisect.bisect_left(positions, ref_pos)
+            last = bisect.bisect_left(positions, ref_pos + length)
+            quality = alignment.qualities[query_pos] if query_pos < len(alignment.qualities) else 0
+            for target in positions[first:last]:
+                bases[target] = ("*", quality)
+            ref_pos += length
+        elif operation == "N":
+            ref_pos += length
+        elif operation in "IS":
+            query_pos += length
+    return bases
+
+
+def pileup_columns(reference, alignments, regions, combine=False):
+    """Pile up the alignments over the regions, like samtools mpileup would.
+
+    Returns a dict mapping each region to a list of (reference base, read base, quality)
+    tuples, one per covered position, where the read base is taken from the first read
+    passing the base quality filter. With combine, the evidence of all reads is combined
+    instead, taking the base of the read with the highest quality, preferring bases over
+    deletions. Read bases matching the reference are reported as the reference base,
+    mismatches are lower case on the reverse strand.
+    Base qualities are not recalculated with BAQ, like core.pileup_regions runs `samtools mpileup -B`.
+    """
+    targets = {}
+    spans = []
+    for region in regions:
+        chrom, coords = region.rsplit(":", 1)
+        start, end = (int(coord) for coord in coords.split("-"))
+        targets.setdefault(chrom, set()).update(range(start, end + 1))
+        spans.append((region, chrom, start, end))
+    targets = {chrom: sorted(positions) for chrom, positions in targets.items()}
+
+    covered = {}
+    for alignment in sorted(alignments, key=lambda aln: aln.position):
+        if not alignment.is_pileup_candidate or alignment.reference_name not in targets:
+            continue
+        chrom = alignment.reference_name
+        for position, base_and_quality in _aligned_bases(alignment, targets[chrom]).items():
+            covered.setdefault((chrom, position), []).append((alignment, base_and_quality))
+
+    columns = {}
+    for region, chrom, start, end in spans:
+        ref_bases = reference.fetch(chrom, start, end)
+        region_columns = []
+        for position in range(start, end + 1):
+            reads = covered.get((chrom, position))
+            if not reads:
+                continue
+            ref_base = ref_bases[position - start] if position - start < len(ref_bases) else "N"
+            column = (ref_base, "*", ord("*") - 33)
+            passing = [(alignment, base, quality) for alignment, (base, quality) in reads
+                       if quality >= MIN_BASE_QUALITY]
+            if passing:
+                alignment, base, quality = max(passing, key=combined_evidence) if combine else passing[0]
+                if base.upper() == ref_base.upper():
+                    base = ref_base
+                elif alignment.is_reverse:
+                    base = base.lower()
+                column = (ref_base, base, min(quality, MAX_PRINTED_QUALITY))
+            region_columns.append(column)
+        columns[region] = region_columns
+
+    return columns
+
+
+def combined_evidence(read):
+    """Sort key picking the best of several reads' (..., base, quality) at a position.
+
+    Bases beat deletions, then higher qualities win. Ties keep the first read.
+    """
+    base, quality = read[-2:]
+    return base != "*", quality
@@ -0,0 +1,208 @@
+"""Process several plates in one invocation, sharing one worker pool between all of them."""
+
+import itertools
+import os
+import sqlite3
+import sys
+
+from .archive import OutputDirectory, open_output
+from .cache import run_context
+from .core import (
+    REGIONS,
+    find_samples,
+    iter_samples,
+    lineage_row,
+    result_columns,
+    setup_cache,
+    setup_index,
+    setup_journal,
+    store_row,
+    write_shard_info,
+    write_triage,
+)
+from .lineage import setup_lineages
+from .metrics import stage
+from .store import setup_store
+
+COMBINED_RESULTS = "results.csv"
+
+
+class Plate:
+    """A zip file or directory of reads, with the config writing its results to its own output."""
+
+    __slots__ = (
+        'config',
+        'name',
+        'samples',
+    )
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.samples = []
+
+    def __repr__(self):
+        return f"Plate({self.name!r})"
+
+
+def read_manifest(path):
+    """Read a manifest of plates, returning a list of (reads, name) tuples.
+
+    Every line holds the path of a zip file or directory of reads, optionally followed by a tab
+    and the name of its output. Relative paths are relative to the manifest, blank lines and
+    lines starting with # are skipped.
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    plates = []
+    with open(path, "r") as handle:
+        for line in handle:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            reads, _, name = line.partition("\t")
+            plates.append((os.path.join(base_dir, reads.strip()), name.strip() or None))
+    return plates
+
+
+def plate_name(reads):
+    """Default name of a plate's output: its zip file or directory name."""
+    name = os.path.basename(os.path.normpath(reads))
+    if name.endswith(".zip"):
+        name = name[:-4]
+    return name
+
+
+def setup_plates(plates, config):
+    """Set up a Plate for each (reads, name) tuple, writing to <outdir>/<name>.
+
+    Raises ValueError if two plates would write to the same output, if a plate's journal
+    can't be resumed, if the results store can't be opened or if the lineage table is invalid.
+    """
+    setup_index(config)
+    setup_cache(config)
+    setup_store(config)
+    setup_lineages(config)
+    context = run_context(config, REGIONS) if config.resume else None
+    result = []
+    seen = set()
+    for reads, name in plates:
+        name = name or plate_name(reads)
+        if name in seen:
+            raise ValueError(f"Two plates would write to {os.path.join(config.outdir, name)}, "
+                             "name them in a manifest")
+        seen.add(name)
+        plate_config = config.copy(reads=reads, outdir=os.path.join(config.outdir, name))
+        setup_journal(plate_config, context)
+        result.append(Plate(name, plate_config))
+    return result
+
+
+def interleave(plates):
+    """Order the samples of all plates round-robin, so every plate makes progress from the start."""
+    columns = itertools.zip_longest(*([(plate, sample) for sample in plate.samples] for plate in plates))
+    return [job for column in columns for job in column if job is not None]
+
+
+def run_plates(tmpdir, plates, config):
+    """Process all samples of all plates on one worker pool.
+
+    Yields (plate, results row) tuples as soon as they are ready. The rows of each plate are yielded
+    in sorted order, the plates are interleaved.
+    """
+    for plate in plates:
+        plate.samples = find_samples(tmpdir, plate.config)
+    jobs = interleave(plates)
+    try:
+        rows = iter_samples(jobs, tmpdir, config, key=lambda job: (job[1], job[0].config))
+        for (plate, _), parts in zip(jobs, rows):
+            yield plate, parts
+    finally:
+        if config._cache is not None:
+            config._cache.evict()
+
+
+def write_plates(results, plates, config, combined=False):
+    """Write the results of each plate to its own output, and all rows to one combined table if requested.
+
+    The combined table is written to <outdir>/results.csv, with the plate name as an extra first column.
+    With batch calling, each plate is called at once when all samples are done, then the rows are
+    written the same way.
+    """
+    outputs = {}
+    combined_file = None
+    os.makedirs(config.outdir, exist_ok=True)
+    try:
+        for plate in plates:
+            plate.config._output = outputs[plate.name] = open_output(plate.config)
+        if config.batch_calling:
+            results = _call_plates(results, plates)
+        if combined:
+            combined_file = OutputDirectory(config.outdir).open_text(COMBINED_RESULTS)
+            print("plate", *result_columns(config.scan, config._lineages is not None), sep=",", file=combined_file)
+        _write_rows(results, plates, config, combined_file)
+        for plate in plates:
+            write_shard_info(plate.config)
+            write_triage(plate.config)
+    finally:
+        if combined_file is not None:
+            combined_file.close()
+        for output in outputs.values():
+            output.close()
+
+
+def _write_rows(results, plates, config, combined_file):
+    handles = {}
+    try:
+        for plate in plates:
+            handles[plate.name] = plate.config._output.open_text("results.csv")
+            print(*result_columns(config.scan, config._lineages is not None), sep=",", file=handles[plate.name],
+                  flush=True)
+        for plate, parts in results:
+            with stage(config, "report"):
+                line = lineage_row(parts, plate.config)
+                print(*line, sep=",", file=handles[plate.name], flush=True)
+                _write_combined(combined_file, plate, line)
+                if config.stdout:
+                    print(plate.name, *line, sep=",", flush=True)
+                store_row(parts, plate.config)
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+
+def _write_combined(combined_file, plate, parts):
+    if combined_file is not None:
+        print(plate.name, *parts, sep=",", file=combined_file, flush=True)
+
+
+def _call_plates(results, plates):
+    """Collect the rows of each plate and batch call them.
+
+    Returns a list of (plate, results row) tuples in the order the rows came in, so they are
+    written like without batch calling.
+    """
+    from .batch import build_rows
+
+    rows = {plate.name: [] for plate in plates}
+    order = []
+    for plate, parts in results:
+        rows[plate.name].append(parts)
+        order.append(plate)
+    called = {}
+    for plate in plates:
+        with stage(plate.config, "call"):
+            called[plate.name] = iter(build_rows(rows[plate.name], plate.config))
+    return [(plate, next(called[plate.name])) for plate in order]
+
+
+def main(config, plates, combined=False):
+    # the classifier builds on this module
+    from .classifier import Classifier
+
+    with Classifier.from_config(config) as classifier:
+        try:
+            plates = setup_plates(plates, config)
+        except (ValueError, OSError, sqlite3.Error) as err:
+            print(err, file=sys.stderr)
+            sys.exit(1)
+        classifier.write_plates(plates, combined)
@@ -0,0 +1,351 @@
+"""Classify uploaded reads over HTTP, collecting concurrent requests into micro-batches on one warm Classifier."""
+
+import argparse
+import gzip
+import http.server
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.parse
+import zipfile
+from email.parser import BytesParser
+from email.policy import HTTP
+
+from .classifier import Classifier
+from .core import _sample_id, result_columns
+from .index import default_index_dir
+from .metrics import RunMetrics, _prometheus_metric, count
+
+SUFFIXES = (".ab1", ".fasta", ".fastq")
+SUFFIXES += tuple(f"{suffix}.gz" for suffix in SUFFIXES)
+# seconds clients are asked to wait when the queue is full
+RETRY_AFTER = 1
+
+
+class ServerBusy(RuntimeError):
+    pass
+
+
+class UploadError(ValueError):
+    pass
+
+
+class Job:
+    """The inputs of one request, waiting for their results."""
+
+    __slots__ = (
+        'done',
+        'error',
+        'inputs',
+        'results',
+    )
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """Classify the inputs of concurrent requests together in micro-batches.
+
+    Requests wait in a queue of at most queue_size requests, requests that don't fit are rejected
+    with ServerBusy. A batch is classified as soon as it holds batch_size samples or batch_wait
+    seconds passed since its first request, whichever comes first.
+    """
+
+    def __init__(self, classifier, batch_size=16, batch_wait=0.05, queue_size=64):
+        self.classifier = classifier
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+
+    @property
+    def queued(self):
+        """Number of requests waiting for a batch."""
+        return self._queue.qsize()
+
+    @property
+    def queue_size(self):
+        return self._queue.maxsize
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def submit(self, inputs):
+        """Classify the inputs of a request, returning their SampleResults once their batch is done.
+
+        Raises ServerBusy if the queue is full, and the error of the request's inputs if they failed.
+        """
+        job = Job(inputs)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise ServerBusy(f"{self.queue_size} requests are already waiting") from None
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.results
+
+    def _next_batch(self):
+        """Wait for the next batch of jobs, or return None once stopped."""
+        job = self._queue.get()
+        if job is None:
+            return None
+        batch = [job]
+        samples = len(job.inputs)
+        deadline = time.monotonic() + self.batch_wait
+        while samples < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if job is None:
+                # finish this batch before stopping
+                self._queue.put(None)
+                break
+            batch.append(job)
+            samples += len(job.inputs)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._classify(batch)
+
+    def _classify(self, batch):
+        config = self.classifier.config
+        count(config, "batches")
+        try:
+            results = self.classifier.classify([item for job in batch for item in job.inputs])
+        except Exception:
+            if len(batch) == 1:
+                batch[0].error = sys.exc_info()[1]
+                batch[0].done.set()
+                return
+            # find the request that failed, without failing the others
+            for job in batch:
+                self._classify([job])
+            return
+        start = 0
+        for job in batch:
+            job.results = results[start:start + len(job.inputs)]
+            start += len(job.inputs)
+            job.done.set()
+
+
+def read_upload(body, content_type="", name=None):
+    """Turn a request body into a list of Classifier inputs.
+
+    The body is either a single ab1, fasta or fastq file, optionally gzip compressed, a zip file
+    of them, or a multipart/form-data upload of several such files. Files are named after their
+    file names like on the command line, an unnamed single file after its first read.
+    Raises UploadError if the body holds no input.
+    """
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body)
+        inputs = []
+        for part in message.iter_parts():
+            inputs.extend(_read_file(part.get_payload(decode=True), part.get_filename()))
+    else:
+        inputs = _read_file(body, name)
+    if not inputs:
+        raise UploadError("No ab1, fasta or fastq files in the upload")
+    return inputs
+
+
+def _read_file(data, file_name):
+    """Read an uploaded file into Classifier inputs, unpacking zip files and gzip compression."""
+    if data.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+                # sorted by file name like on the command line
+                members = sorted((member for member in zip_file.namelist() if member.endswith(SUFFIXES)),
+                                 key=os.path.basename)
+                return [item for member in members
+                        for item in _read_file(zip_file.read(member), os.path.basename(member))]
+        except zipfile.BadZipFile as err:
+            raise UploadError(f"Invalid zip file: {err}") from None
+    if data.startswith(b"\x1f\x8b"):
+        try:
+            data = gzip.decompress(data)
+        except (OSError, EOFError) as err:
+            raise UploadError(f"Invalid gzip file: {err}") from None
+    if file_name is None:
+        return [data]
+    return [(_sample_id(file_name), data)]
+
+
+class ClassifyServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, batcher, max_upload=64 * 1024 * 1024, verbose=False):
+        self.batcher = batcher
+        self.max_upload = max_upload
+        self.verbose = verbose
+        super().__init__(address, ClassifyHandler)
+
+
+class ClassifyHandler(http.server.BaseHTTPRequestHandler):
+    """POST /classify classifies the uploaded reads, GET /health and GET /metrics report on the server."""
+
+    server_version = "covid-spike-classification"
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/health":
+            batcher = self.server.batcher
+            self._send_json(200, {"status": "ok", "queued": batcher.queued, "queue_size": batcher.queue_size,
+                                  "jobs": batcher.classifier.config.jobs})
+        elif path == "/metrics":
+            self._send(200, "text/plain; version=0.0.4", self._prometheus().encode("utf-8"))
+        else:
+            self._send_json(404, {"error": f"Unknown path {path}"})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/classify":
+            self._send_json(404, {"error": f"Unknown path {url.path}"})
+            return
+        query = urllib.parse.parse_qs(url.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > self.server.max_upload:
+            self.close_connection = True
+            self._send_json(413, {"error": f"Uploads are limited to {self.server.max_upload} bytes"})
+            return
+
+        batcher = self.server.batcher
+        config = batcher.classifier.config
+        count(config, "requests")
+        try:
+            inputs = read_upload(self.rfile.read(length), self.headers.get("Content-Type", ""),
+                                 query.get("name", [None])[0])
+            results = batcher.submit(inputs)
+        except ServerBusy as err:
+            count(config, "rejected_requests")
+            self._send_json(503, {"error": str(err)}, {"Retry-After": str(RETRY_AFTER)})
+            return
+        except (UploadError, ValueError, TypeError) as err:
+            # inputs that aren't reads
+            self._send_json(400, {"error": str(err)})
+            return
+        except Exception as err:
+            self._send_json(500, {"error": f"{type(err).__name__}: {err}"})
+            return
+
+        if query.get("format", ["json"])[0] == "csv":
+            lines = [result_columns(config.scan)] + [result.row() for result in results]
+            self._send(200, "text/csv", "".join(f"{','.join(parts)}\n" for parts in lines).encode("utf-8"))
+        else:
+            self._send_json(200, {"results": [result.as_dict() for result in results]})
+
+    def _prometheus(self):
+        batcher = self.server.batcher
+        metrics = batcher.classifier.config._metrics
+        text = metrics.to_prometheus() if metrics is not None else ""
+        lines = _prometheus_metric("queued_requests", "gauge", "Number of requests waiting for a batch.", None,
+                                   {"": batcher.queued})
+        return text + "".join(f"{line}\n" for line in lines)
+
+    def _send_json(self, status, data, headers=None):
+        self._send(status, "application/json", json.dumps(data).encode("utf-8"), headers)
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="covid-spike-classification serve",
+                                     description="Classify uploaded reads over HTTP. POST ab1, fasta or fastq "
+                                                 "files or zip files of them to /classify, as the request body "
+                                                 "or as a multipart/form-data upload. Add ?format=csv for "
+                                                 "results.csv rows instead of JSON. GET /health and /metrics "
+                                                 "report on the server.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Address to listen on (default: %(default)s).")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="Port to listen on (default: %(default)s).")
+    parser.add_argument("-r", "--reference", default=os.path.join(os.getcwd(), "ref", "NC_045512.fasta"),
+                        help="Reference FASTA file to use (default: %(default)s).")
+    parser.add_argument("--index-dir", default=os.environ.get("CSC_INDEX_DIR", default_index_dir()),
+                        help="Directory to build and cache reference indices in (default: %(default)s).")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of samples to process in parallel (default: %(default)s).")
+    parser.add_argument("-t", "--threads", type=int, default=None,
+                        help="Total number of threads to use (default: one thread per job).")
+    parser.add_argument("--batch-size", type=int, default=16,
+                        help="Maximum number of samples per micro-batch (default: %(default)s).")
+    parser.add_argument("--batch-wait", type=float, default=0.05,
+                        help="Seconds to wait for more requests to batch with the first one (default: %(default)s).")
+    parser.add_argument("--queue-size", type=int, default=64,
+                        help="Maximum number of waiting requests, more are rejected with 503 "
+                             "(default: %(default)s).")
+    parser.add_argument("--max-upload", type=int, default=64,
+                        help="Maximum upload size in MB (default: %(default)s).")
+    parser.add_argument("--basecaller", choices=["tracy", "native"], default="tracy",
+                        help="How to basecall ab1 uploads, see the --basecaller option of a run "
+                             "(default: %(default)s).")
+    parser.add_argument("--fast-path", action="store_true", default=False,
+                        help="Read the tracked codons straight from single-read uploads by anchoring flanking "
+                             "reference k-mers, only aligning reads where that fails.")
+    parser.add_argument("--direct-sam", action="store_true", default=False,
+                        help="Call variants straight from bowtie2's SAM output using the native pileup engine.")
+    parser.add_argument("--pileup-engine", choices=["samtools", "native"], default="samtools",
+                        help="Engine to pile up reads at the tracked codons with (default: %(default)s).")
+    parser.add_argument("--scan", action="store_true", default=False,
+                        help="Call every spike codon the reads cover and list all substitutions.")
+    parser.add_argument("--show-unexpected", action="store_true", default=False,
+                        help="Show unexpected mutations instead of reporting 'no known mutation'")
+    parser.add_argument("--silence-warnings", action="store_true", default=False,
+                        help="Silence D614G warnings.")
+    parser.add_argument("--cache-dir", default=os.environ.get("CSC_CACHE_DIR"),
+                        help="Cache per-sample results in this directory (default: $CSC_CACHE_DIR if set).")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False,
+                        help="Log every request.")
+    args = parser.parse_args(argv)
+    if args.jobs < 1 or args.batch_size < 1 or args.queue_size < 1:
+        parser.error("--jobs, --batch-size and --queue-size must be at least 1")
+
+    with Classifier(args.reference, index_dir=args.index_dir, jobs=args.jobs, threads=args.threads,
+                    basecaller=args.basecaller, fast_path=args.fast_path, direct_sam=args.direct_sam,
+                    pileup_engine=args.pileup_engine, scan=args.scan, show_unexpected=args.show_unexpected,
+                    silence_warnings=args.silence_warnings, cache_dir=args.cache_dir, quiet=True) as classifier:
+        # only the totals, a long-running server would pile up per-sample metrics
+        classifier.config._metrics = RunMetrics(per_sample=False)
+        batcher = MicroBatcher(classifier, args.batch_size, args.batch_wait, args.queue_size)
+        batcher.start()
+        server = ClassifyServer((args.host, args.port), batcher, args.max_upload * 1024 * 1024, args.verbose)
+        print(f"Serving on http://{args.host}:{server.server_address[1]}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            batcher.stop()
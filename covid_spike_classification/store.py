@@ -0,0 +1,238 @@
+"""Append the results of every run to one SQLite store, and query them back in the results.csv layout."""
+
+import argparse
+import datetime
+import hashlib
+import re
+import sqlite3
+import sys
+
+from .cache import run_context
+from .core import REGIONS, result_columns
+from .lineage import LineageError, LineageIndex
+
+STORE_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    reads TEXT,
+    outdir TEXT,
+    reference TEXT NOT NULL,
+    context_digest TEXT NOT NULL,
+    context TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY,
+    run INTEGER NOT NULL REFERENCES runs (id),
+    sample TEXT NOT NULL,
+    input_digest TEXT NOT NULL,
+    context_digest TEXT NOT NULL,
+    substitutions TEXT,
+    comment TEXT NOT NULL,
+    UNIQUE (sample, input_digest, context_digest)
+);
+CREATE INDEX IF NOT EXISTS samples_run ON samples (run);
+CREATE TABLE IF NOT EXISTS calls (
+    sample INTEGER NOT NULL REFERENCES samples (id),
+    mutation TEXT NOT NULL,
+    call TEXT NOT NULL,
+    ratio TEXT,
+    PRIMARY KEY (sample, mutation)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS calls_mutation ON calls (mutation, call);
+"""
+
+# the quality ratios of the found mutations, as written into the comment by core.variant_comment
+FOUND_RATIO = re.compile(r"(?:^|; )(\w+) found \(([^)]*)\)")
+
+
+class StoreError(ValueError):
+    pass
+
+
+class ResultStore:
+    """Append-only SQLite store of the results rows of all runs.
+
+    Every sample is stored with its calls, the quality ratios of its found mutations, its
+    comment, the hash of its input file and the run it was first seen in. Samples are
+    identified by name, input hash and run context, so storing a sample again, e.g. when a
+    plate is rerun, is a no-op. Calls are indexed by mutation, samples by name and run.
+    Every sample is committed on its own, so an interrupted run keeps the samples stored so far.
+    Not thread-safe, rows are added by the thread writing results.csv.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA foreign_keys = ON")
+        with self._db:
+            self._db.executescript(SCHEMA)
+            self._db.execute("INSERT OR IGNORE INTO info VALUES ('version', ?)", (str(STORE_VERSION),))
+        version = self._db.execute("SELECT value FROM info WHERE key = 'version'").fetchone()[0]
+        if version != str(STORE_VERSION):
+            self._db.close()
+            raise StoreError(f"{path} is a version {version} store, expected version {STORE_VERSION}")
+        # (context, context digest, run id) by output, runs are only added once they store a new sample
+        self._runs = {}
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def add(self, parts, config, input_digest):
+        """Store a results row of a run with config, unless the same sample was stored before.
+
+        Returns whether the row was new.
+        """
+        context, context_digest, run = self._run_context(config)
+        sample = parts[0]
+        known = self._db.execute(
+            "SELECT 1 FROM samples WHERE sample = ? AND input_digest = ? AND context_digest = ?",
+            (sample, input_digest, context_digest)).fetchone()
+        if known is not None:
+            return False
+        with self._db:
+            if run is None:
+                started = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+                run = self._db.execute(
+                    "INSERT INTO runs (started, reads, outdir, reference, context_digest, context) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (started, config.reads, config.outdir, config.reference, context_digest, context)).lastrowid
+
+            ratios = dict(FOUND_RATIO.findall(parts[-1]))
+            sample_id = self._db.execute(
+                "INSERT INTO samples (run, sample, input_digest, context_digest, substitutions, comment) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (run, sample, input_digest, context_digest, parts[-2] if config.scan else None,
+                 parts[-1])).lastrowid
+            self._db.executemany(
+                "INSERT INTO calls VALUES (?, ?, ?, ?)",
+                [(sample_id, mutation, call, ratios.get(mutation))
+                 for mutation, call in zip(REGIONS, parts[1:len(REGIONS) + 1])])
+        # only once the run is committed, a failed insert rolls it back
+        self._runs[config.outdir] = (context, context_digest, run)
+        return True
+
+    def _run_context(self, config):
+        if config.outdir not in self._runs:
+            context = run_context(config, REGIONS)
+            self._runs[config.outdir] = (context, hashlib.sha256(context.encode("utf-8")).hexdigest(), None)
+        return self._runs[config.outdir]
+
+    def query(self, found=(), samples=(), since=None, until=None, runs=()):
+        """Yield (run id, run start, sample, calls, substitutions, comment) of the stored samples.
+
+        Samples are filtered to those with all mutations in found, with the given names, from runs
+        started on or after since and before until, ISO dates or times, and from the given run ids.
+        calls maps each stored mutation to its results cell. Samples come in run and row order.
+        """
+        conditions = []
+        params = []
+        for mutation in found:
+            conditions.append("samples.id IN (SELECT sample FROM calls WHERE mutation = ? AND call = '1')")
+            params.append(mutation)
+        if samples:
+            conditions.append(f"samples.sample IN ({', '.join('?' * len(samples))})")
+            params.extend(samples)
+        if runs:
+            conditions.append(f"samples.run IN ({', '.join('?' * len(runs))})")
+            params.extend(runs)
+        if since is not None:
+            conditions.append("runs.started >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("runs.started < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._db.execute(
+            "SELECT samples.id, runs.id, runs.started, samples.sample, samples.substitutions, samples.comment "
+            f"FROM samples JOIN runs ON samples.run = runs.id {where} ORDER BY samples.id", params)
+        for sample_id, run, started, sample, substitutions, comment in rows:
+            calls = dict(self._db.execute("SELECT mutation, call FROM calls WHERE sample = ?", (sample_id,)))
+            yield run, started, sample, calls, substitutions, comment
+
+
+def export_rows(results, scan=False, with_run=False, lineages=None):
+    """Turn the results of ResultStore.query into results.csv rows, with the current columns.
+
+    Mutations that weren't tracked yet when a sample was stored are NA. Without scan, the
+    substitutions column is left out, with scan it's NA for samples stored without it. With
+    a lineage.LineageIndex, the lineage columns are added.
+    """
+    for run, started, sample, calls, substitutions, comment in results:
+        parts = [str(run), started] if with_run else []
+        parts.append(sample)
+        cells = [calls.get(mutation, "NA") for mutation in REGIONS]
+        parts.extend(cells)
+        if scan:
+            parts.append(substitutions if substitutions is not None else "NA")
+        if lineages is not None:
+            parts.extend(lineages.assign(cells))
+        parts.append(comment)
+        yield parts
+
+
+def setup_store(config):
+    """Open the results store of a config, if it has one.
+
+    Raises StoreError if the store was written by an incompatible version.
+    """
+    if config.store is not None and config._store is None:
+        config._store = ResultStore(config.store)
+    return config._store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="covid-spike-classification query",
+                                     description="Export the samples of a results store written with --store "
+                                                 "as results.csv, optionally filtered.")
+    parser.add_argument("store",
+                        help="SQLite results store.")
+    parser.add_argument("--found", action="append", default=[], metavar="MUTATION",
+                        help="Only samples in which this mutation was found, can be given several times.")
+    parser.add_argument("--sample", action="append", default=[],
+                        help="Only samples with this name, can be given several times.")
+    parser.add_argument("--run", action="append", default=[], type=int,
+                        help="Only samples first stored by the run with this id, can be given several times.")
+    parser.add_argument("--since",
+                        help="Only samples from runs started on or after this date, like 2021-03-01.")
+    parser.add_argument("--until",
+                        help="Only samples from runs started before this date.")
+    parser.add_argument("--scan", action="store_true", default=False,
+                        help="Add the substitutions column of --scan runs.")
+    parser.add_argument("--lineages", metavar="CSV",
+                        help="Add the best matching lineages of this lineage table, like the --lineages option "
+                             "of a run.")
+    parser.add_argument("--with-run", action="store_true", default=False,
+                        help="Add the run id and start time of each sample as the first columns.")
+    parser.add_argument("-o", "--output",
+                        help="File to write the results to (default: stdout).")
+    args = parser.parse_args(argv)
+
+    try:
+        lineages = LineageIndex.from_file(args.lineages) if args.lineages else None
+    except (LineageError, OSError) as err:
+        print(f"Can't read the lineage table: {err}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        store = ResultStore(args.store)
+    except (StoreError, sqlite3.Error) as err:
+        print(f"Can't open the store: {err}", file=sys.stderr)
+        sys.exit(1)
+    header = (["run", "started"] if args.with_run else []) + result_columns(args.scan, lineages is not None)
+    outfile = open(args.output, "w") if args.output else sys.stdout
+    try:
+        print(*header, sep=",", file=outfile)
+        results = store.query(args.found, args.sample, args.since, args.until, args.run)
+        for parts in export_rows(results, args.scan, args.with_run, lineages):
+            print(*parts, sep=",", file=outfile)
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+        store.close()
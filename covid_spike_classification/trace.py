@@ -0,0 +1,48 @@
+"""Basecall ab1 traces in-process, from the basecalls and qualities the sequencer stored in them."""
+
+import io
+
+from Bio import SeqIO
+
+# error probability above which bases are trimmed, like Biopython's abi-trim
+MOTT_CUTOFF = 0.05
+
+
+def decode_trace(data, name, trim=True):
+    """Read the basecalls of an ab1 file's content as fastq text, without starting tracy.
+
+    The bases and Phred qualities are the PBAS2 and PCON2 records of the ABIF container, the
+    read is named after the file like tracy's output. With trim, low quality ends are trimmed
+    with Mott's algorithm. Raises ValueError if data isn't an ab1 file with basecalls.
+    """
+    if not data.startswith(b"ABIF"):
+        raise ValueError(f"{name} is not an ab1 file")
+    record = SeqIO.read(io.BytesIO(data), "abi")
+    sequence = str(record.seq)
+    qualities = record.letter_annotations.get("phred_quality")
+    if not sequence or qualities is None:
+        raise ValueError(f"{name} holds no basecalls")
+    if trim:
+        start, end = mott_trim(qualities)
+        sequence = sequence[start:end]
+        qualities = qualities[start:end]
+    return f"@{name}\n{sequence}\n+\n{''.join(chr(min(q, 93) + 33) for q in qualities)}\n"
+
+
+def mott_trim(qualities, cutoff=MOTT_CUTOFF):
+    """Return the 0-based start and end of the best part of a read by Mott's algorithm.
+
+    Every base scores cutoff minus its error probability, the part kept is the stretch with
+    the highest total score. Reads without any base better than the cutoff are trimmed away.
+    """
+    best_start = best_end = 0
+    best = total = 0.0
+    start = 0
+    for position, quality in enumerate(qualities):
+        total += cutoff - 10 ** (quality / -10)
+        if total <= 0:
+            total = 0.0
+            start = position + 1
+        elif total > best:
+            best, best_start, best_end = total, start, position + 1
+    return best_start, best_end
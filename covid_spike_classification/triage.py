@@ -0,0 +1,80 @@
+"""Triage reads before aligning them, so samples that can't be called don't cost an alignment."""
+
+import io
+
+from Bio import SeqIO
+from Bio.Seq import reverse_complement
+
+from .anchor import FASTA_QUALITY, load_anchors
+
+TRIAGE_FILE = "triage.csv"
+# read ends below this quality are trimmed before the trimmed statistics are taken
+TRIM_QUALITY = 20
+STATS = ("reads", "length", "trimmed_length", "mean_quality", "trimmed_quality", "n_fraction", "anchored_codons")
+
+
+def read_stats(reads, sequence_format, reference, regions):
+    """Compute the triage statistics of the reads of a sample, fasta or fastq text.
+
+    length is the length of the longest read, trimmed_length the longest read after trimming
+    its ends below TRIM_QUALITY. The qualities are the mean base quality of all bases before
+    and after trimming, FASTA reads count as FASTA_QUALITY like in the fast path. n_fraction is
+    the fraction of bases that aren't A, C, G or T. anchored_codons counts the codons of regions
+    whose flanking anchors are found on either strand of any read, i.e. the tracked codons the
+    reads span.
+    """
+    anchors = load_anchors(reference, tuple(regions))
+    records = list(SeqIO.parse(io.StringIO(reads), sequence_format))
+    stats = dict.fromkeys(STATS, 0)
+    stats["reads"] = len(records)
+    quality_sum = trimmed_sum = bases = trimmed_bases = called = 0
+    anchored = set()
+    for record in records:
+        sequence = str(record.seq).upper()
+        if sequence_format == "fasta":
+            qualities = [FASTA_QUALITY] * len(sequence)
+        else:
+            qualities = record.letter_annotations["phred_quality"]
+        start, end = trim_ends(qualities)
+        stats["length"] = max(stats["length"], len(sequence))
+        stats["trimmed_length"] = max(stats["trimmed_length"], end - start)
+        bases += len(sequence)
+        quality_sum += sum(qualities)
+        trimmed_bases += end - start
+        trimmed_sum += sum(qualities[start:end])
+        called += sum(sequence.count(base) for base in "ACGT")
+        for strand in (sequence, reverse_complement(sequence)):
+            anchored.update(region for region, anchor in anchors.items()
+                            if anchor is not None and anchor.locate(strand) is not None)
+
+    stats["mean_quality"] = round(quality_sum / bases, 1) if bases else 0
+    stats["trimmed_quality"] = round(trimmed_sum / trimmed_bases, 1) if trimmed_bases else 0
+    stats["n_fraction"] = round((bases - called) / bases, 4) if bases else 1
+    stats["anchored_codons"] = len(anchored)
+    return stats
+
+
+def trim_ends(qualities, threshold=TRIM_QUALITY):
+    """Return the 0-based start and end of the read left after trimming both ends below threshold."""
+    start = 0
+    while start < len(qualities) and qualities[start] < threshold:
+        start += 1
+    end = len(qualities)
+    while end > start and qualities[end - 1] < threshold:
+        end -= 1
+    return start, end
+
+
+def triage_failure(stats, config):
+    """Return why a sample fails the triage thresholds of the config, or None if it passes."""
+    if stats["reads"] == 0:
+        return "no reads"
+    if stats["trimmed_length"] < config.triage_min_length:
+        return f"trimmed read length {stats['trimmed_length']} < {config.triage_min_length}"
+    if stats["trimmed_quality"] < config.triage_min_quality:
+        return f"trimmed mean quality {stats['trimmed_quality']} < {config.triage_min_quality}"
+    if stats["n_fraction"] > config.triage_max_n:
+        return f"N fraction {stats['n_fraction']} > {config.triage_max_n}"
+    if stats["anchored_codons"] < config.triage_min_codons:
+        return f"reads span {stats['anchored_codons']} tracked codons < {config.triage_min_codons}"
+    return None
@@ -0,0 +1,190 @@
+"""Watch an instrument drop folder and classify new files as they arrive."""
+
+import concurrent.futures
+import datetime
+import os
+import sys
+import tempfile
+import threading
+import zipfile
+
+from .archive import InputFile, OutputDirectory, list_inputs
+from .core import (
+    process_sample,
+    result_columns,
+    setup_cache,
+    setup_index,
+)
+
+LEDGER = "processed.txt"
+# results kept in memory by the daemon, the on-disk cache holds the rest
+MAX_CACHED_SAMPLES = 4096
+
+
+class RunWriter:
+    """Append results rows to the rolling results file of each run in the output directory."""
+
+    def __init__(self, outdir, stdout=False, scan=False):
+        self.outdir = outdir
+        self.stdout = stdout
+        self.scan = scan
+        self._lock = threading.Lock()
+
+    def run_dir(self, run):
+        run_dir = os.path.join(self.outdir, run)
+        os.makedirs(run_dir, exist_ok=True)
+        return run_dir
+
+    def append(self, run, parts):
+        with self._lock:
+            results_file = os.path.join(self.run_dir(run), "results.csv")
+            new_file = not os.path.exists(results_file)
+            with open(results_file, "a") as outfile:
+                if new_file:
+                    print(*result_columns(self.scan), sep=",", file=outfile)
+                print(*parts, sep=",", file=outfile)
+            if self.stdout:
+                print(run, *parts, sep=",", flush=True)
+
+
+class Ledger:
+    """Keep track of the files already processed, so restarts don't process them again."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # files that have been handed to a worker
+        self.seen = set()
+        # files that have been fully processed
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, "r") as handle:
+                for line in handle:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) == 3:
+                        self.done.add((parts[0], int(parts[1]), float(parts[2])))
+        self.seen.update(self.done)
+
+    def __contains__(self, entry):
+        return entry in self.seen
+
+    def add(self, entry):
+        with self._lock:
+            self.seen.add(entry)
+            self.done.add(entry)
+            with open(self.path, "a") as handle:
+                print(*entry, sep="\t", file=handle)
+
+
+def scan(watch_dir, suffixes):
+    """Find all candidate files in the watch directory, returning a dict of relative path: (size, mtime)."""
+    found = {}
+    for root, _, files in os.walk(watch_dir):
+        for name in files:
+            if not name.endswith(suffixes):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found[os.path.relpath(path, watch_dir)] = (stat.st_size, stat.st_mtime)
+    return found
+
+
+def ready_files(previous, current):
+    """Find the files that didn't change between two scans, i.e. have finished writing."""
+    return sorted(path for path, stat in current.items() if previous.get(path) == stat)
+
+
+def run_name(relative_path):
+    """Name of the run a file belongs to: its top level folder, its zip file or today's date."""
+    parts = relative_path.split(os.sep)
+    if len(parts) > 1:
+        return parts[0]
+    if relative_path.endswith(".zip"):
+        return os.path.splitext(relative_path)[0]
+    return datetime.date.today().strftime("%Y-%m-%d")
+
+
+def watch(config, poll_interval=2.0, stop_event=None):
+    """Watch config.watch for new input files and zips, processing them on a persistent worker pool.
+
+    Runs until stop_event is set, or forever if no stop event is given. The on-disk cache is
+    trimmed to its maximum size after every poll in which samples were processed.
+    """
+    suffixes = (f".{config.input_format}", f".{config.input_format}.gz", ".zip")
+    os.makedirs(config.outdir, exist_ok=True)
+    writer = RunWriter(config.outdir, config.stdout, config.scan)
+    ledger = Ledger(os.path.join(config.outdir, LEDGER))
+    setup_index(config)
+    setup_cache(config, max_entries=MAX_CACHED_SAMPLES)
+    stop_event = stop_event or threading.Event()
+    run_configs = {}
+    # set when samples were processed since the cache was last trimmed
+    processed = threading.Event()
+
+    def process(input_file, tmpdir, run, entry=None):
+        try:
+            parts = process_sample(input_file, tmpdir, run_configs[run])
+        except Exception as err:
+            print(f"Failed to process {input_file.name}: {err}", file=sys.stderr)
+            return
+        processed.set()
+        writer.append(run, parts)
+        if entry is not None:
+            ledger.add(entry)
+
+    try:
+        previous = {}
+        pending_zips = []
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=config.jobs) as executor:
+            while not stop_event.is_set():
+                current = scan(config.watch, suffixes)
+                for relative_path in ready_files(previous, current):
+                    size, mtime = current[relative_path]
+                    entry = (relative_path, size, mtime)
+                    if entry in ledger:
+                        continue
+                    # make sure a file is only submitted once, even before it is done
+                    ledger.seen.add(entry)
+                    path = os.path.join(config.watch, relative_path)
+                    run = run_name(relative_path)
+                    if run not in run_configs:
+                        run_configs[run] = config.copy(outdir=writer.run_dir(run))
+                        run_configs[run]._output = OutputDirectory(run_configs[run].outdir)
+
+                    if not relative_path.endswith(".zip"):
+                        executor.submit(process, InputFile.from_path(path), tmpdir, run, entry)
+                        continue
+
+                    try:
+                        members = list_inputs(path, config.input_format)
+                    except zipfile.BadZipFile as err:
+                        print(f"Failed to read {path}: {err}", file=sys.stderr)
+                        ledger.add(entry)
+                        continue
+                    futures = [executor.submit(process, member, tmpdir, run) for member in members]
+                    pending_zips.append((entry, futures))
+
+                # zips only count as processed once all their members are
+                for entry, futures in pending_zips:
+                    if all(future.done() for future in futures):
+                        ledger.add(entry)
+                pending_zips = [pending for pending in pending_zips if pending[0] not in ledger.done]
+
+                if processed.is_set():
+                    processed.clear()
+                    config._cache.evict()
+                previous = current
+                stop_event.wait(poll_interval)
+    finally:
+        config._cache.evict()
+
+
+def main(config, poll_interval):
+    try:
+        watch(config, poll_interval)
+    except KeyboardInterrupt:
+        pass
@@ -16,6 +16,7 @@ install_requires = [
 
 tests_require = [
     'flake8',
+    'numpy',
     'pytest',
 ]
 
@@ -67,6 +68,7 @@ setup(
         'Operating System :: OS Independent',
     ],
     extras_require={
+        'batch': ['numpy'],
         'testing': tests_require,
     },
 )
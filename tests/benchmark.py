@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""Benchmark the pipeline on generated plates, reporting throughput and time per stage as JSON.
+
+Options after '--' are passed on to covid-spike-classification, e.g. to compare calling backends:
+
+    python tests/benchmark.py -n 1000 -- --fast-path --batch-calling
+
+ab1 plates hold synthetic traces and are run once per basecaller, on the same traces:
+
+    python tests/benchmark.py -f ab1 --basecallers tracy native -- --fast-path
+"""
+
+import argparse
+import csv
+import json
+import os
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent / "data"))
+
+from generate_plate import FORMATS, generate_plate  # noqa: E402
+
+from covid_spike_classification import __version__  # noqa: E402
+from covid_spike_classification.__main__ import parse_args  # noqa: E402
+from covid_spike_classification.archive import open_output  # noqa: E402
+from covid_spike_classification.config import CSCConfig  # noqa: E402
+from covid_spike_classification.core import REGIONS, run_pipeline, write_results  # noqa: E402
+from covid_spike_classification.metrics import STAGES, RunMetrics, track_run  # noqa: E402
+
+REFERENCE = pathlib.Path(__file__).resolve().parent.parent / "ref" / "NC_045512.fasta"
+
+
+def main():
+    argv = sys.argv[1:]
+    extra = []
+    if "--" in argv:
+        extra = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--samples", type=int, nargs="+", default=[96, 960],
+                        help="Plate sizes to benchmark (default: %(default)s).")
+    parser.add_argument("-f", "--formats", nargs="+", choices=FORMATS, default=["fasta", "fastq"],
+                        help="Plate formats to benchmark. Choices: %(choices)s. default: %(default)s")
+    parser.add_argument("--basecallers", nargs="+", choices=["tracy", "native"], default=["tracy"],
+                        help="Basecallers to run ab1 plates with (default: %(default)s).")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for the generated plates (default: %(default)s).")
+    parser.add_argument("--mutation-rate", type=float, default=0.1,
+                        help="Chance of each tracked codon to carry a panel mutation (default: %(default)s).")
+    parser.add_argument("--n-rate", type=float, default=0.002,
+                        help="Chance of each base to be an N (default: %(default)s).")
+    parser.add_argument("--deletion-rate", type=float, default=0.0005,
+                        help="Chance of each base to be deleted (default: %(default)s).")
+    parser.add_argument("--max-low-quality-end", type=int, default=40,
+                        help="Maximum length of the noisy, low quality read ends (default: %(default)s).")
+    parser.add_argument("-o", "--output",
+                        help="File to write the JSON report to (default: stdout).")
+    parser.add_argument("--workdir",
+                        help="Keep generated plates and results in this directory (default: a temporary one).")
+    args = parser.parse_args(argv)
+
+    plate_options = {
+        "seed": args.seed,
+        "mutation_rate": args.mutation_rate,
+        "n_rate": args.n_rate,
+        "deletion_rate": args.deletion_rate,
+        "max_low_quality_end": args.max_low_quality_end,
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        runs = []
+        for plate_format in args.formats:
+            basecallers = args.basecallers if plate_format.startswith("ab1") else [None]
+            for samples in args.samples:
+                run_dir = os.path.join(workdir, f"{plate_format}-{samples}")
+                plate = generate_plate(REFERENCE, run_dir, samples, plate_format, **plate_options)
+                for basecaller in basecallers:
+                    options = extra if basecaller is None else extra + ["--basecaller", basecaller]
+                    outdir = os.path.join(run_dir, f"results-{basecaller}" if basecaller else "results")
+                    runs.append(benchmark(plate, outdir, samples, plate_format, options))
+                    runs[-1]["basecaller"] = basecaller
+                    label = f"{plate_format} x {samples}" + (f" ({basecaller})" if basecaller else "")
+                    print(f"{label}: {runs[-1]['samples_per_second']:.1f} samples/s", file=sys.stderr)
+
+    report = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "plate": plate_options,
+        "options": extra,
+        "runs": runs,
+    }
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def benchmark(plate, outdir, samples, plate_format, extra):
+    """Run the pipeline on a generated plate, returning the measurements."""
+    input_format = plate_format.split(".")[0]
+    config = CSCConfig.from_args(parse_args([plate, "-i", input_format, "-o", outdir, "-q", *extra]))
+    config._metrics = RunMetrics()
+
+    start_times = os.times()
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config._output = open_output(config)
+        try:
+            with track_run(config):
+                write_results(run_pipeline(tmpdir, config), config)
+        finally:
+            config._output.close()
+    wall = time.perf_counter() - start
+    end_times = os.times()
+
+    metrics = config._metrics.as_dict()
+    stages = metrics["stages"]
+    for name in STAGES:
+        totals = stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+        totals["samples_per_second"] = totals["calls"] / totals["wall"] if totals["wall"] else None
+
+    return {
+        "format": plate_format,
+        "samples": samples,
+        "wall": wall,
+        "cpu": {
+            "python": (end_times.user - start_times.user) + (end_times.system - start_times.system),
+            "tools": ((end_times.children_user - start_times.children_user)
+                      + (end_times.children_system - start_times.children_system)),
+        },
+        "samples_per_second": samples / wall,
+        "stages": stages,
+        "tools": metrics["tools"],
+        "counters": metrics["counters"],
+        "concordant_samples": concordance(os.path.join(os.path.dirname(outdir), "truth.csv"), config),
+    }
+
+
+def concordance(truth_file, config):
+    """Count the samples whose found panel mutations are exactly the generated ones."""
+    results_file = f"{config.outdir}.zip" if config.zip_results else os.path.join(config.outdir, "results.csv")
+    if not os.path.exists(results_file) or config.zip_results:
+        return None
+    with open(truth_file, "r") as handle:
+        truth = {row["sample"]: set(row["mutations"].split()) for row in csv.DictReader(handle)}
+    concordant = 0
+    with open(results_file, "r") as handle:
+        for row in csv.DictReader(handle):
+            found = {variant for variant in REGIONS if row[variant] == "1"}
+            concordant += found == truth.get(row["sample"])
+    return concordant
+
+
+if __name__ == "__main__":
+    main()
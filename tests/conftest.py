@@ -0,0 +1,60 @@
+"""Shared test fixtures."""
+
+import argparse
+
+import pytest
+
+from covid_spike_classification.config import CSCConfig
+
+
+def _make_config(**kwargs):
+    defaults = dict(
+        amplicon=False,
+        amplicon_margin=1000,
+        basecaller="tracy",
+        batch_calling=False,
+        cache_dir=None,
+        cache_size=1024,
+        debug=False,
+        direct_sam=False,
+        fast_path=False,
+        group_pattern=None,
+        index_dir="indices",
+        input_format="fasta",
+        jobs=1,
+        keep_bams=False,
+        lineages=None,
+        metrics=False,
+        no_cache=False,
+        no_fastqs=False,
+        outdir="out",
+        pileup_engine="samtools",
+        profile=False,
+        prometheus=False,
+        quiet=True,
+        reads="reads",
+        reference="ref.fasta",
+        refresh=False,
+        resume=False,
+        scan=False,
+        shard=None,
+        show_unexpected=False,
+        silence_warnings=False,
+        stdout=False,
+        store=None,
+        threads=1,
+        triage=False,
+        triage_max_n=0.5,
+        triage_min_codons=1,
+        triage_min_length=100,
+        triage_min_quality=10,
+        watch=None,
+        zip_results=False,
+    )
+    defaults.update(kwargs)
+    return CSCConfig.from_args(argparse.Namespace(**defaults))
+
+
+@pytest.fixture
+def make_config():
+    return _make_config
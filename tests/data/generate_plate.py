@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""Generate a randomised plate of amplicons with panel mutations, Ns, deletions and low quality ends.
+
+ab1 plates hold synthetic traces, see generate_trace.
+"""
+
+
+import argparse
+import itertools
+import os
+import pathlib
+import random
+import shutil
+import zipfile
+
+from Bio import SeqIO
+from Bio.Seq import reverse_complement
+
+from generate_mutations import Mutation, mutate
+from generate_trace import write_abif
+
+from covid_spike_classification.codons import translate
+from covid_spike_classification.core import CODONS, _parse_region
+
+AMPLICON_START = 22799
+AMPLICON_END = 23847
+FORMATS = ("fasta", "fastq", "ab1", "fasta.zip", "fastq.zip", "ab1.zip")
+
+
+def main():
+    reference_path = pathlib.Path(__file__).resolve().parent.parent.parent / 'ref' / 'NC_045512.fasta'
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--reference", type=pathlib.Path, default=reference_path,
+                        help="Reference sequence to extract amplicons from (default: %(default)s).")
+    parser.add_argument("-n", "--samples", type=int, default=96,
+                        help="Number of samples on the plate (default: %(default)s).")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="fasta",
+                        help="Format of the plate. Choices: %(choices)s. default: %(default)s")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed (default: %(default)s).")
+    parser.add_argument("--mutation-rate", type=float, default=0.1,
+                        help="Chance of each tracked codon to carry a panel mutation (default: %(default)s).")
+    parser.add_argument("--n-rate", type=float, default=0.002,
+                        help="Chance of each base to be an N (default: %(default)s).")
+    parser.add_argument("--deletion-rate", type=float, default=0.0005,
+                        help="Chance of each base to be deleted (default: %(default)s).")
+    parser.add_argument("--max-low-quality-end", type=int, default=40,
+                        help="Maximum length of the noisy, low quality read ends (default: %(default)s).")
+    parser.add_argument("outdir", type=pathlib.Path,
+                        help="Directory to write the plate and its truth.csv to.")
+
+    args = parser.parse_args()
+    plate = generate_plate(args.reference, args.outdir, args.samples, args.format, seed=args.seed,
+                           mutation_rate=args.mutation_rate, n_rate=args.n_rate, deletion_rate=args.deletion_rate,
+                           max_low_quality_end=args.max_low_quality_end)
+    print(plate)
+
+
+def mutation_codons(reference_sequence):
+    """Pick the nucleotide change closest to the reference codon for each panel mutation.
+
+    Returns a dict of region: [(variant, [Mutation, ...]), ...].
+    """
+    codons = ["".join(bases) for bases in itertools.product("ACGT", repeat=3)]
+    choices = {}
+    for region, variants in CODONS.items():
+        _, start, _ = _parse_region(region)
+        ref_codon = reference_sequence[start - 1:start + 2]
+        for variant in variants:
+            candidates = [codon for codon in codons if translate(codon) == variant[-1]]
+            best = min(candidates, key=lambda codon: sum(a != b for a, b in zip(codon, ref_codon)))
+            mutations = [Mutation(start - 1 + i, base) for i, base in enumerate(best) if base != ref_codon[i]]
+            choices.setdefault(region, []).append((variant, mutations))
+    return choices
+
+
+def random_sample(rng, reference_sequence, choices, mutation_rate, n_rate, deletion_rate, max_low_quality_end):
+    """Generate a single amplicon read, returning its sequence, qualities and panel mutations."""
+    sequence = reference_sequence
+    found = []
+    for region_choices in choices.values():
+        if rng.random() >= mutation_rate:
+            continue
+        variant, mutations = rng.choice(region_choices)
+        for mutation in mutations:
+            sequence = mutate(sequence, mutation)
+        found.append(variant)
+
+    bases = []
+    qualities = []
+    for base in sequence[AMPLICON_START - 1:AMPLICON_END]:
+        if rng.random() < deletion_rate:
+            continue
+        if rng.random() < n_rate:
+            base = "N"
+        bases.append(base)
+        qualities.append(rng.randint(30, 60))
+
+    for end in (rng.randint(0, max_low_quality_end), -rng.randint(0, max_low_quality_end)):
+        positions = range(end) if end >= 0 else range(len(bases) + end, len(bases))
+        for position in positions:
+            bases[position] = rng.choice("ACGTN")
+            qualities[position] = rng.randint(2, 12)
+
+    read = "".join(bases)
+    if rng.random() < 0.5:
+        read = reverse_complement(read)
+        qualities.reverse()
+    return read, qualities, found
+
+
+def generate_plate(reference, outdir, samples, plate_format="fasta", seed=0, mutation_rate=0.1, n_rate=0.002,
+                   deletion_rate=0.0005, max_low_quality_end=40):
+    """Write a plate of random samples to outdir, returning the path of the plate.
+
+    The plate is a directory of fasta, fastq or ab1 files, or a zip file of them. The panel mutations
+    of each sample are written to truth.csv in outdir.
+    """
+    rng = random.Random(seed)
+    reference_sequence = str(SeqIO.read(reference, "fasta").seq)
+    choices = mutation_codons(reference_sequence)
+    sequence_format = plate_format.split(".")[0]
+
+    os.makedirs(outdir, exist_ok=True)
+    plate_dir = os.path.join(outdir, "plate")
+    os.makedirs(plate_dir, exist_ok=True)
+    width = len(str(samples))
+    with open(os.path.join(outdir, "truth.csv"), "w") as truth:
+        print("sample", "mutations", sep=",", file=truth)
+        for i in range(samples):
+            name = f"sample{i:0{width}d}"
+            read, qualities, found = random_sample(rng, reference_sequence, choices, mutation_rate, n_rate,
+                                                   deletion_rate, max_low_quality_end)
+            path = os.path.join(plate_dir, f"{name}.{sequence_format}")
+            if sequence_format == "ab1":
+                write_abif(path, name, read, qualities)
+                print(name, " ".join(found), sep=",", file=truth)
+                continue
+            with open(path, "w") as handle:
+                if sequence_format == "fasta":
+                    handle.write(f">{name}\n{read}\n")
+                else:
+                    handle.write(f"@{name}\n{read}\n+\n{''.join(chr(q + 33) for q in qualities)}\n")
+            print(name, " ".join(found), sep=",", file=truth)
+
+    if not plate_format.endswith(".zip"):
+        return plate_dir
+
+    zip_path = os.path.join(outdir, "plate.zip")
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for name in sorted(os.listdir(plate_dir)):
+            zip_file.write(os.path.join(plate_dir, name), name)
+    shutil.rmtree(plate_dir)
+    return zip_path
+
+
+if __name__ == "__main__":
+    main()
@@ -90,3 +90,7 @@ generate S704L 23673:T
 generate T716I 23709:T
 #T732A
 generate T732A 23756:G
+
+# a synthetic trace, to compare the native basecaller with tracy
+mkdir -p traces
+"$(dirname "$0")/generate_trace.py" N501Y.fasta traces/N501Y.ab1
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""Write synthetic ab1 traces: four channels of Gaussian peaks with the basecalls and qualities stored alongside."""
+
+import argparse
+import math
+import os
+import random
+import struct
+
+from Bio import SeqIO
+
+# samples between two peaks
+PEAK_SPACING = 12
+CHANNEL_ORDER = "GATC"
+# ABIF element types
+CHAR = 2
+SHORT = 4
+LONG = 5
+PSTRING = 18
+DIR_ENTRY = struct.Struct(">4sihhiiii")
+
+
+def trace_channels(read, qualities, rng):
+    """Draw the four dye channels of a read, returning them and the peak positions.
+
+    Every base is a peak in its channel, as high as its quality makes it stand out above the
+    noise. Ns are equal peaks in all channels.
+    """
+    length = (len(read) + 2) * PEAK_SPACING
+    channels = {base: [0.0] * length for base in CHANNEL_ORDER}
+    peaks = []
+    for index, (base, quality) in enumerate(zip(read, qualities)):
+        center = (index + 1) * PEAK_SPACING
+        peaks.append(center)
+        height = 200 + 30 * quality
+        for channel in CHANNEL_ORDER if base not in CHANNEL_ORDER else base:
+            scale = height if base in CHANNEL_ORDER else height / 2
+            for offset in range(-PEAK_SPACING, PEAK_SPACING + 1):
+                channels[channel][center + offset] += scale * math.exp(-(offset / 2.5) ** 2 / 2)
+    signal = {channel: [min(32767, int(value + rng.randint(0, 40))) for value in values]
+              for channel, values in channels.items()}
+    return [signal[channel] for channel in CHANNEL_ORDER], peaks
+
+
+def write_abif(path, name, read, qualities):
+    """Write a read as an ab1 file with its trace, basecalls (PBAS2), qualities (PCON2) and peaks (PLOC2).
+
+    The noise of the trace only depends on the name, so plates of other formats get the same reads.
+    """
+    channels, peaks = trace_channels(read, qualities, random.Random(name))
+    elements = [(b"DATA", 9 + index, SHORT, 2, len(data), struct.pack(f">{len(data)}h", *data))
+                for index, data in enumerate(channels)]
+    elements.append((b"FWO_", 1, CHAR, 1, 4, CHANNEL_ORDER.encode("ascii")))
+    elements.append((b"PBAS", 2, CHAR, 1, len(read), read.encode("ascii")))
+    elements.append((b"PCON", 2, CHAR, 1, len(qualities), bytes(qualities)))
+    elements.append((b"PLOC", 2, SHORT, 2, len(peaks), struct.pack(f">{len(peaks)}h", *peaks)))
+    sample_name = name.encode("ascii")
+    elements.append((b"SMPL", 1, PSTRING, 1, len(sample_name) + 1, bytes([len(sample_name)]) + sample_name))
+
+    # header, then the data of all elements that don't fit into their directory entry, then the directory
+    header_size = 128
+    data = bytearray()
+    entries = []
+    for tag, number, element_type, element_size, count, payload in elements:
+        if len(payload) <= 4:
+            offset = int.from_bytes(payload.ljust(4, b"\0"), "big")
+        else:
+            offset = header_size + len(data)
+            data.extend(payload)
+        entries.append(DIR_ENTRY.pack(tag, number, element_type, element_size, count, len(payload), offset, 0))
+    directory_offset = header_size + len(data)
+    root = DIR_ENTRY.pack(b"tdir", 1, 1023, DIR_ENTRY.size, len(entries), DIR_ENTRY.size * len(entries),
+                          directory_offset, 0)
+    header = (b"ABIF" + struct.pack(">h", 101) + root).ljust(header_size, b"\0")
+    with open(path, "wb") as handle:
+        handle.write(header + bytes(data) + b"".join(entries))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quality", type=int, default=40,
+                        help="Quality of the bases (default: %(default)s).")
+    parser.add_argument("--low-quality-end", type=int, default=20,
+                        help="Length of the low quality ends on both sides of the read (default: %(default)s).")
+    parser.add_argument("fasta",
+                        help="FASTA file holding the read.")
+    parser.add_argument("ab1",
+                        help="ab1 file to write, the read is named after it.")
+
+    args = parser.parse_args()
+    read = str(SeqIO.read(args.fasta, "fasta").seq)
+    end = min(args.low_quality_end, len(read) // 2)
+    qualities = [5] * end + [args.quality] * (len(read) - 2 * end) + [5] * end
+    write_abif(args.ab1, os.path.basename(args.ab1), read, qualities)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+#!/bin/bash
+# Pile up sample.sam with samtools, to compare the native pileup engine with.
+# mpileup.txt was generated with samtools 1.24
+
+set -e
+cd "$(dirname "$0")"
+
+# the span of all tracked codons, with the options of core.pileup_regions
+samtools sort -o sample.bam sample.sam
+samtools index sample.bam
+samtools mpileup -B -f ../../../ref/NC_045512.fasta -r NC_045512:22811-23758 sample.bam > mpileup.txt
+rm sample.bam sample.bam.bai
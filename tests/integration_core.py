@@ -51,6 +51,32 @@ def integration_run(tmp_path):
     assert len(missed_mutatations) == 0, f"No tests for mutations: {missed_mutatations}"
 
 
+def _results(outdir, *options):
+    datadir = pathlib.Path(__file__).parent / "data"
+    cmd = ["covid-spike-classification", "--input-format", "fasta", "--outdir", outdir, "--quiet", *options, datadir]
+    subprocess.run(cmd, check=True, timeout=60)
+    with open(outdir / "results.csv", "r", newline="") as handle:
+        return list(csv.DictReader(handle))
+
+
+def integration_native_engine_matches_samtools(tmp_path):
+    samtools_rows = _results(tmp_path / "samtools")
+    native_rows = _results(tmp_path / "native", "--pileup-engine", "native")
+    # the same calls and, without BAQ on either side, the same quality ratios in the comments
+    assert samtools_rows == native_rows
+
+
+def integration_fast_path_matches_alignment(tmp_path):
+    aligned_rows = _results(tmp_path / "aligned")
+    fast_rows = _results(tmp_path / "fast", "--fast-path")
+    for row in fast_rows:
+        # every single-read sample is anchored, apart from the path the rows are the same
+        *comment, path = row["comment"].split("; ")
+        assert path == "called via anchored fast path", row
+        row["comment"] = "; ".join(comment)
+    assert aligned_rows == fast_rows
+
+
 if __name__ == "__main__":
     tmpdir = pathlib.Path(tempfile.mkdtemp())
     try:
@@ -0,0 +1,43 @@
+"""Integration tests of the native ab1 basecaller against tracy"""
+
+import csv
+import pathlib
+import subprocess
+
+
+def _run(outdir, basecaller):
+    datadir = pathlib.Path(__file__).parent / "data" / "traces"
+    cmd = [
+        "covid-spike-classification",
+        "--input-format", "ab1",
+        "--basecaller", basecaller,
+        "--outdir", outdir,
+        "--silence-warnings",
+        "--quiet",
+        datadir,
+    ]
+    subprocess.run(cmd, check=True, timeout=60)
+    with open(outdir / "results.csv", "r", newline="") as handle:
+        rows = list(csv.DictReader(handle))
+    with open(outdir / "N501Y.ab1.fastq", "r") as handle:
+        fastq = handle.read().splitlines()
+    return rows, fastq
+
+
+def integration_native_matches_tracy(tmp_path):
+    tracy_rows, tracy_fastq = _run(tmp_path / "tracy", "tracy")
+    native_rows, native_fastq = _run(tmp_path / "native", "native")
+
+    # one record named after the file, the same calls
+    assert len(tracy_fastq) == len(native_fastq) == 4
+    assert tracy_fastq[0] == native_fastq[0]
+    for tracy_row, native_row in zip(tracy_rows, native_rows):
+        del tracy_row["comment"], native_row["comment"]
+        assert tracy_row == native_row
+    assert native_rows[0]["N501Y"] == "1"
+
+    # on the clean trace, tracy's read differs at most in where the low quality ends are trimmed
+    tracy_read, native_read = tracy_fastq[1], native_fastq[1]
+    shorter, longer = sorted((tracy_read, native_read), key=len)
+    core = shorter[20:-20]
+    assert core in longer
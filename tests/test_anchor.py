@@ -0,0 +1,82 @@
+"""Test the anchored-codon fast path."""
+
+import pathlib
+
+import pytest
+
+from Bio import SeqIO
+from Bio.Seq import reverse_complement
+
+from covid_spike_classification import anchor, core, pileup
+
+DATA_DIR = pathlib.Path(__file__).parent / "data"
+REFERENCE = str(pathlib.Path(__file__).parent.parent / "ref" / "NC_045512.fasta")
+AMPLICON_START = 22799
+
+
+def _anchors():
+    return anchor.load_anchors(REFERENCE, tuple(core.CODONS))
+
+
+def _amplicon(name):
+    return str(SeqIO.read(DATA_DIR / f"{name}.fasta", "fasta").seq)
+
+
+def test_all_codons_have_anchors():
+    anchors = _anchors()
+    assert sorted(anchors) == sorted(core.CODONS)
+    assert all(value is not None for value in anchors.values())
+
+
+def test_anchor_locate():
+    region = "NC_045512:23012-23014"
+    sequence = _amplicon("E484K")
+    offset = _anchors()[region].locate(sequence)
+    assert offset == 23012 - AMPLICON_START
+    # an insertion between the anchors breaks the anchoring
+    assert _anchors()[region].locate(sequence[:offset] + "A" + sequence[offset:]) is None
+    # so does a repeated anchor
+    assert _anchors()[region].locate(sequence + sequence) is None
+
+
+@pytest.mark.parametrize("fasta", sorted(DATA_DIR.glob("*.fasta")), ids=lambda path: path.stem)
+def test_fast_path_agrees_with_pileup(fasta, tmp_path, make_config):
+    # piling up the amplicon aligned end to end, see integration_core.py for bowtie2's alignments
+    config = make_config(reference=REFERENCE, pileup_engine="native")
+    sequence = _amplicon(fasta.stem)
+
+    parts = core.classify_anchored(str(fasta), config)
+    assert parts is not None
+
+    alignment = pileup.Alignment("NC_045512", AMPLICON_START, 0, [("M", len(sequence))], sequence,
+                                 [anchor.FASTA_QUALITY] * len(sequence))
+    assert core.finish_row(fasta.stem, core.alignment_columns([alignment], config), config, str(fasta)) == parts
+
+
+def test_fast_path_reverse_read(tmp_path, make_config):
+    config = make_config(reference=REFERENCE, show_unexpected=True, input_format="fastq")
+    sequence = _amplicon("N501Y")
+    qualities = [30] * len(sequence)
+    qualities[23063 - AMPLICON_START] = 50
+    fastq = tmp_path / "N501Y.fastq"
+    reversed_qualities = "".join(chr(q + 33) for q in qualities[::-1])
+    fastq.write_text(f"@N501Y\n{reverse_complement(sequence)}\n+\n{reversed_qualities}\n")
+
+    parts = core.classify_anchored(str(fastq), config)
+    alignment = pileup.Alignment("NC_045512", AMPLICON_START, pileup.FLAG_REVERSE, [("M", len(sequence))],
+                                 sequence, qualities)
+    assert core.finish_row("N501Y", core.alignment_columns([alignment], config), config, str(fastq)) == parts
+    assert parts[list(core.REGIONS).index("N501Y") + 1] == "1"
+
+
+def test_fast_path_falls_back(tmp_path, make_config):
+    config = make_config(reference=REFERENCE)
+    sequence = _amplicon("D614G")
+
+    short = tmp_path / "short.fasta"
+    short.write_text(f">short\n{sequence[:400]}\n")
+    assert core.classify_anchored(str(short), config) is None
+
+    two_reads = tmp_path / "two.fasta"
+    two_reads.write_text(f">a\n{sequence}\n>b\n{sequence}\n")
+    assert core.classify_anchored(str(two_reads), config) is None
@@ -0,0 +1,79 @@
+"""Test reading inputs from and writing outputs to directories and zip files."""
+
+import gzip
+import re
+import zipfile
+
+from covid_spike_classification import archive
+
+
+def test_list_inputs_zip(tmp_path):
+    zip_path = tmp_path / "reads.zip"
+    with zipfile.ZipFile(zip_path, "w") as zip_file:
+        zip_file.writestr("b.fasta", ">b\nACGT\n")
+        zip_file.writestr("plate/nested/a.fasta.gz", gzip.compress(b">a\nGGGG\n"))
+        zip_file.writestr("plate/c.fastq", "@c\nA\n+\nI\n")
+
+    inputs = archive.list_inputs(str(zip_path), "fasta")
+    assert ["a.fasta", "b.fasta"] == [input_file.name for input_file in inputs]
+    assert b">a\nGGGG\n" == inputs[0].read()
+    assert inputs[0].path is None
+
+    spooled = inputs[1].materialize(str(tmp_path))
+    assert spooled == str(tmp_path / "b.fasta")
+    assert (tmp_path / "b.fasta").read_bytes() == b">b\nACGT\n"
+
+
+def test_list_inputs_dir(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.ab1").write_bytes(b"a")
+    (tmp_path / "sub" / "b.ab1").write_bytes(b"b")
+    with gzip.open(tmp_path / "c.ab1.gz", "wb") as handle:
+        handle.write(b"c")
+
+    assert ["a.ab1", "c.ab1"] == [input_file.name for input_file in archive.list_inputs(str(tmp_path), "ab1")]
+    inputs = archive.list_inputs(str(tmp_path), "ab1", recursive=True)
+    assert ["a.ab1", "b.ab1", "c.ab1"] == [input_file.name for input_file in inputs]
+    assert inputs[0].materialize(str(tmp_path / "sub")) == str(tmp_path / "a.ab1")
+    assert inputs[2].read() == b"c"
+
+
+def test_output_zip(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("source")
+    output = archive.OutputZip(str(tmp_path / "out.zip"))
+    with output.open_text("results.csv") as handle:
+        print("sample,comment", file=handle)
+        # other files can be added while the results are being written
+        output.write("a.fastq", b"@a\n")
+        output.add_file(str(source), "bams/source.txt")
+        print("a,", file=handle)
+    output.close()
+
+    with zipfile.ZipFile(tmp_path / "out.zip") as zip_file:
+        assert sorted(zip_file.namelist()) == ["a.fastq", "bams/source.txt", "results.csv"]
+        assert zip_file.read("results.csv") == b"sample,comment\na,\n"
+        assert zip_file.read("bams/source.txt") == b"source"
+
+
+def test_group_inputs(tmp_path):
+    for name, content in (("S1_F.fasta", b">f\nACGT"), ("S1_R.fasta", b">r\nTTTT\n"), ("S2_F.fasta", b">f\nGG\n"),
+                          ("control.fasta", b">c\nAAAA\n")):
+        (tmp_path / name).write_bytes(content)
+    inputs = archive.list_inputs(str(tmp_path), "fasta")
+
+    grouped = archive.group_inputs(inputs, re.compile(r"^(?P<sample>.+)_[FR]\."))
+    assert ["S1.fasta", "S2.fasta", "control.fasta"] == [input_file.name for input_file in grouped]
+    group = grouped[0]
+    assert ["S1_F.fasta", "S1_R.fasta"] == [member.name for member in group.members]
+    assert b">f\nACGT\n>r\nTTTT\n" == group.read()
+    (tmp_path / "scratch").mkdir()
+    spooled = group.materialize(str(tmp_path / "scratch"))
+    assert spooled == str(tmp_path / "scratch" / "S1.fasta")
+    assert group.read() == (tmp_path / "scratch" / "S1.fasta").read_bytes()
+    assert isinstance(grouped[2], archive.InputFile)
+
+    # the digest changes with the content of any member
+    digest = group.digest()
+    (tmp_path / "S1_R.fasta").write_bytes(b">r\nTTTA\n")
+    assert digest != group.digest()
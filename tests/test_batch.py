@@ -0,0 +1,76 @@
+"""Test batched calling of a whole plate."""
+
+import pathlib
+import random
+
+import pytest
+
+from Bio import SeqIO
+
+from covid_spike_classification import batch, core, pileup
+
+DATA_DIR = pathlib.Path(__file__).parent / "data"
+REFERENCE = pathlib.Path(__file__).parent.parent / "ref" / "NC_045512.fasta"
+AMPLICON_START = 22799
+
+
+def _amplicon_columns(name, config):
+    sequence = str(SeqIO.read(DATA_DIR / f"{name}.fasta", "fasta").seq)
+    alignment = pileup.Alignment("NC_045512", AMPLICON_START, 0, [("M", len(sequence))], sequence,
+                                 [40] * len(sequence))
+    return core.alignment_columns([alignment], config)
+
+
+def _random_columns(rng, reference):
+    columns = {}
+    for region in core.CODONS:
+        chrom, start, end = core._parse_region(region)
+        ref_bases = reference.fetch(chrom, start, end)
+        region_columns = []
+        for ref_base in ref_bases[:rng.choice([1, 3, 3, 3, 3])]:
+            base = rng.choice([ref_base] * 6 + ["A", "C", "G", "T", "a", "t", "N", "R", "*"])
+            region_columns.append((ref_base, base, rng.randint(0, 60)))
+        columns[region] = region_columns
+    return columns
+
+
+def _scalar_rows(results, config):
+    rows = []
+    for result in results:
+        if isinstance(result, core.PendingRow):
+            parts = core.finish_row(result.sample_id, result.columns, config.copy(batch_calling=False), "test")
+            for comment in result.comments:
+                core._add_comment(parts, comment)
+            result = parts
+        rows.append(result)
+    return rows
+
+
+@pytest.mark.parametrize("show_unexpected", [False, True])
+@pytest.mark.parametrize("silence_warnings", [False, True])
+def test_batch_matches_scalar_calls(make_config, show_unexpected, silence_warnings):
+    config = make_config(batch_calling=True, reference=str(REFERENCE), pileup_engine="native",
+                         show_unexpected=show_unexpected, silence_warnings=silence_warnings)
+    reference = pileup.load_reference(str(REFERENCE))
+    rng = random.Random(42)
+
+    results = [core.PendingRow(path.stem, _amplicon_columns(path.stem, config))
+               for path in sorted(DATA_DIR.glob("*.fasta"))]
+    results.extend(core.PendingRow(f"random{i}", _random_columns(rng, reference)) for i in range(200))
+    results.append(core._failed_row("failed", "read failed to align", config))
+    results.append(core.PendingRow("fast", _amplicon_columns("N501Y", config), ["called via anchored fast path"]))
+
+    expected = _scalar_rows(results, config)
+    assert expected == batch.build_rows(results, config)
+
+
+def test_batch_rejects_scan(make_config):
+    with pytest.raises(ValueError):
+        batch.build_rows([], make_config(batch_calling=True, scan=True))
+
+
+def test_batch_invalid_codon(make_config):
+    config = make_config(batch_calling=True)
+    columns = {region: [("A", "A", 30), ("C", "?", 30), ("G", "G", 30)] for region in core.CODONS}
+    with pytest.raises(core.TranslationError):
+        batch.build_rows([core.PendingRow("invalid", columns)], config)
@@ -0,0 +1,100 @@
+"""Test the result cache."""
+
+import os
+import threading
+
+from covid_spike_classification.cache import ResultCache
+
+
+class Counter:
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+        return {"calls": ["1", "0", ""], "fastq": None}
+
+
+def _write(path, content):
+    path.write_text(content)
+    return str(path)
+
+
+def test_duplicates_computed_once(tmp_path):
+    first = _write(tmp_path / "a.fasta", ">a\nACGT\n")
+    second = _write(tmp_path / "b.fasta", ">a\nACGT\n")
+    other = _write(tmp_path / "c.fasta", ">c\nACGA\n")
+    counter = Counter()
+    cache = ResultCache(None, "", use_disk=False)
+
+    threads = [threading.Thread(target=cache.fetch, args=(path, counter)) for path in (first, second, first)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.calls == 1
+
+    cache.fetch(other, counter)
+    assert counter.calls == 2
+    assert cache.hits == 2
+    assert cache.misses == 2
+
+
+def test_disk_cache_and_refresh(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    sample = _write(tmp_path / "a.fasta", ">a\nACGT\n")
+    counter = Counter()
+
+    ResultCache(cache_dir, "ctx").fetch(sample, counter)
+    assert counter.calls == 1
+
+    entry = ResultCache(cache_dir, "ctx").fetch(sample, counter)
+    assert counter.calls == 1
+    assert entry == {"calls": ["1", "0", ""], "fastq": None}
+
+    # a different run context doesn't share results
+    ResultCache(cache_dir, "other ctx").fetch(sample, counter)
+    assert counter.calls == 2
+
+    ResultCache(cache_dir, "ctx", refresh=True).fetch(sample, counter)
+    assert counter.calls == 3
+
+
+def test_failed_entries_not_stored(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    sample = _write(tmp_path / "a.fasta", ">a\nACGT\n")
+    counter = Counter()
+
+    def fail():
+        counter()
+        return {"calls": ["NA", "NA", "read failed to align"], "fastq": None, "failed": True}
+
+    cache = ResultCache(cache_dir, "ctx")
+    cache.fetch(sample, fail)
+    cache.fetch(sample, fail)
+    assert counter.calls == 1
+    # a new run tries again
+    ResultCache(cache_dir, "ctx").fetch(sample, fail)
+    assert counter.calls == 2
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cache = ResultCache(cache_dir, "ctx")
+    paths = [_write(tmp_path / f"{i}.fasta", f">{i}\nACGT\n") for i in range(3)]
+    for i, path in enumerate(paths):
+        cache.fetch(path, Counter())
+        entry = cache._path(cache.key(path))
+        os.utime(entry, (1000 + i, 1000 + i))
+    size = os.path.getsize(cache._path(cache.key(paths[0])))
+
+    # use the oldest entry again
+    ResultCache(cache_dir, "ctx").fetch(paths[0], Counter())
+
+    cache.max_size = 2 * size
+    cache.evict()
+    assert os.path.exists(cache._path(cache.key(paths[0])))
+    assert not os.path.exists(cache._path(cache.key(paths[1])))
+    assert os.path.exists(cache._path(cache.key(paths[2])))
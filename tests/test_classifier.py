@@ -0,0 +1,97 @@
+"""Test classifying reads through the Python API."""
+
+import pathlib
+
+import pytest
+
+from Bio import SeqIO
+
+from covid_spike_classification import cache, classifier, core, index
+from covid_spike_classification.__main__ import parse_args
+
+DATA_DIR = pathlib.Path(__file__).parent / "data"
+REFERENCE = str(pathlib.Path(__file__).parent.parent / "ref" / "NC_045512.fasta")
+
+
+def _fake_build(fasta, prefix, threads, quiet):
+    pathlib.Path(f"{prefix}.1.bt2").write_text("")
+
+
+@pytest.fixture
+def csc(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, "_bowtie2_build", _fake_build)
+    with classifier.Classifier(REFERENCE, index_dir=str(tmp_path / "indices"), fast_path=True) as csc:
+        yield csc
+
+
+def test_classify_matches_cli_row(csc, make_config):
+    fasta = DATA_DIR / "N501Y.fasta"
+    result = csc.classify(fasta.read_bytes())
+
+    assert result.sample == "N501Y"
+    assert result.found == ["N501Y"]
+    assert set(result.ratios) == set(core.REGIONS)
+    assert f"N501Y found ({result.ratios['N501Y']})" in result.comment
+
+    config = make_config(reference=REFERENCE, fast_path=True)
+    parts = core._add_comment(core.classify_anchored(str(fasta), config), "called via anchored fast path")
+    assert parts == result.row()
+
+
+def test_classify_batch(csc):
+    records = [SeqIO.read(DATA_DIR / f"{name}.fasta", "fasta") for name in ("E484K", "D614G")]
+    fastq = "".join(f"@read\n{record.seq}\n+\n{'I' * len(record)}\n" for record in records[:1])
+    inputs = records + [("named", (DATA_DIR / "K417N.fasta").read_bytes()), ("fastq", fastq.encode("utf-8"))]
+
+    results = csc.classify(inputs)
+    assert ["E484K", "D614G", "named", "fastq"] == [result.sample for result in results]
+    assert [["E484K"], ["D614G"], ["K417N"], ["E484K"]] == [result.found for result in results]
+    # the D614G warning is part of the comment
+    assert results[1].comment == f"D614G found ({results[1].ratios['D614G']}); called via anchored fast path"
+    assert not any(result.failed for result in results)
+
+
+def test_read_input():
+    name, input_data, input_format = classifier.read_input(b">S1 some read\nACGT\n")
+    assert ("S1", "S1.fasta", "fasta") == (name, input_data.name, input_format)
+    assert "fastq" == classifier.read_input(("a/b", "@r\nA\n+\nI\n"))[2]
+    assert "a_b.fastq" == classifier.read_input(("a/b", "@r\nA\n+\nI\n"))[1].name
+
+    with pytest.raises(ValueError):
+        classifier.read_input(b"ACGT")
+    with pytest.raises(TypeError):
+        classifier.read_input(42)
+    with pytest.raises(TypeError):
+        classifier.Classifier(REFERENCE, no_such_option=True)
+
+
+def test_result_from_failed_row(make_config):
+    config = make_config()
+    parts = core._failed_row("S1", "read failed to align", config)
+    result = classifier.SampleResult.from_row("S1", parts)
+    assert result.failed
+    assert result.comment == "read failed to align"
+    assert result.row() == parts
+
+
+def test_defaults_match_cli():
+    args = vars(parse_args(["plate.zip"]))
+    # locations and the thread count, filled in when a Classifier is set up
+    differing = {"index_dir", "outdir", "reads", "threads"}
+    assert {option: args[option] for option in set(classifier.DEFAULT_OPTIONS) - differing} \
+        == {option: value for option, value in classifier.DEFAULT_OPTIONS.items() if option not in differing}
+
+
+def test_caches_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, "_bowtie2_build", _fake_build)
+    monkeypatch.setattr(classifier, "EVICT_INTERVAL", 2)
+    evicted = []
+    monkeypatch.setattr(cache.ResultCache, "evict", lambda self: evicted.append(self))
+    fasta = (DATA_DIR / "N501Y.fasta").read_bytes()
+    with classifier.Classifier(REFERENCE, index_dir=str(tmp_path / "indices"), fast_path=True,
+                               cache_dir=str(tmp_path / "cache")) as csc:
+        csc.classify(fasta)
+        assert not evicted
+        csc.classify([fasta, fasta])
+        assert len(evicted) == 1
+    assert len(evicted) == 2
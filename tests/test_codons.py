@@ -0,0 +1,34 @@
+"""Test codon translation and the spike codon index."""
+
+import pytest
+
+from covid_spike_classification import codons, core
+
+
+def test_translate():
+    assert "MFVFLVLLPLVSSQ*" == codons.translate("ATGTTTGTTTTTCTTGTTTTATTGCCACTAGTCTCTAGTCAGTAA")
+    assert "K" == codons.translate("aag")
+
+
+def test_translate_ambiguous():
+    assert "A" == codons.translate("GCN")
+    assert "*" == codons.translate("TRA")
+    assert "B" == codons.translate("RAT")
+    assert "X" == codons.translate("NNN")
+
+
+def test_translate_invalid():
+    with pytest.raises(codons.TranslationError):
+        codons.translate("A*G")
+    with pytest.raises(codons.TranslationError):
+        codons.translate("AC")
+
+
+def test_spike_codons_match_tracked_regions():
+    spike_codons = codons.spike_codons()
+    assert len(spike_codons) == 1273
+    for variant, region in core.REGIONS.items():
+        # the A626S region spans four bases
+        if variant == "A626S":
+            continue
+        assert spike_codons[region] == int(variant[1:-1]), variant
@@ -0,0 +1,18 @@
+"""Test covid-spike-classification configuration handling."""
+
+
+def test_tool_threads(make_config):
+    assert make_config(jobs=1, threads=1).tool_threads == 1
+    assert make_config(jobs=4, threads=32).tool_threads == 8
+    assert make_config(jobs=5, threads=32).tool_threads == 6
+    assert make_config(jobs=8, threads=4).tool_threads == 1
+
+
+def test_copy(make_config):
+    config = make_config(outdir="first")
+    config._failed.add("sample")
+    copy = config.copy(outdir="second")
+    assert copy.outdir == "second"
+    assert copy.reads == config.reads
+    assert copy._failed is config._failed
+    assert config.outdir == "first"
@@ -1,5 +1,10 @@
 """Test covid-spike-classification core functions."""
 
+import os
+import subprocess
+import sys
+import zipfile
+
 import pytest
 
 from covid_spike_classification import core
@@ -47,3 +52,158 @@ NC_045512	22920	A	1	.	E
 """
     with pytest.raises(core.PileupFailedError):
         _ = core.parse_pileup(pileup)
+
+
+def test_build_codon_index():
+    regions = {
+        "E484A": "NC_045512:23012-23014",
+        "E484K": "NC_045512:23012-23014",
+        "N501Y": "NC_045512:23063-23065",
+    }
+    expected = {
+        "NC_045512:23012-23014": ["E484A", "E484K"],
+        "NC_045512:23063-23065": ["N501Y"],
+    }
+    assert expected == core._build_codon_index(regions)
+
+
+def test_codon_index_covers_all_regions():
+    assert sorted(core.REGIONS) == sorted(v for variants in core.CODONS.values() for v in variants)
+
+
+def test_split_pileup():
+    pileup = """NC_045512	22918	T	1	.	G
+NC_045512	22919	T	1	.	G
+NC_045512	22920	A	1	G	E
+NC_045512	22921	T	1	.	O
+NC_045512	23012	G	1	.	O
+"""
+    regions = ["NC_045512:22919-22921", "NC_045512:23012-23014", "NC_045512:23063-23065"]
+    expected = {
+        "NC_045512:22919-22921": """NC_045512	22919	T	1	.	G
+NC_045512	22920	A	1	G	E
+NC_045512	22921	T	1	.	O
+""",
+        "NC_045512:23012-23014": "NC_045512	23012	G	1	.	O\n",
+        "NC_045512:23063-23065": "",
+    }
+    result = core.split_pileup(pileup, regions)
+    assert expected == result
+    assert core.parse_pileup(result["NC_045512:22919-22921"]) == ("TAT", "TGT", [(38, False), (36, True), (46, False)])
+    with pytest.raises(core.PileupFailedError):
+        core.parse_pileup(result["NC_045512:23012-23014"])
+
+
+def test_iter_jobs_keeps_order(make_config):
+    items = list(range(20))
+    for jobs in (1, 4):
+        assert [i * 2 for i in items] == list(core._iter_jobs(lambda i: i * 2, items, make_config(jobs=jobs)))
+
+
+def test_find_samples(tmp_path, make_config):
+    for name in ("b.fasta", "a.fasta", "c.fastq"):
+        (tmp_path / name).write_text(">x\nACGT\n")
+
+    samples = core.find_samples(str(tmp_path), make_config(reads=str(tmp_path), input_format="fasta"))
+    assert ["a.fasta", "b.fasta"] == [sample.name for sample in samples]
+    assert [str(tmp_path / "a.fasta"), str(tmp_path / "b.fasta")] == [sample.path for sample in samples]
+
+
+def test_zip_members_piped(tmp_path, monkeypatch, make_config):
+    with zipfile.ZipFile(tmp_path / "plate.zip", "w") as zip_file:
+        zip_file.writestr("A1.fasta", ">A1\nACGT\n")
+    config = make_config(reads=str(tmp_path / "plate.zip"), input_format="fasta", direct_sam=True)
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    aligned = []
+
+    def fake_classify_sam(sequence_file, config, reads=None):
+        spooled = [path.name for path in scratch.rglob("*") if path.is_file()]
+        aligned.append((os.path.basename(sequence_file), reads, spooled))
+        return ["A1"] + ["0"] * len(core.REGIONS) + [""]
+
+    monkeypatch.setattr(core, "classify_sam", fake_classify_sam)
+    input_file, = core.find_samples(str(scratch), config)
+    core._process_sample(input_file, str(scratch), config)
+    # the member's reads are handed over in memory, nothing is spooled to the scratch directory
+    assert aligned == [("A1.fasta", ">A1\nACGT\n", [])]
+
+
+def test_failed_entries_marked(tmp_path, monkeypatch, make_config):
+    config = make_config(triage=True)
+    stats = {"reads": 1, "length": 300, "trimmed_length": 300, "mean_quality": 40, "trimmed_quality": 40,
+             "n_fraction": 1.0, "anchored_codons": 0}
+    passing = dict(stats, n_fraction=0.0, anchored_codons=5)
+    results = {
+        "A1": (core._failed_row("A1", "read failed to align", config), None, passing),
+        "A2": (core._failed_row("A2", "skipped by triage: N fraction 1.0 > 0.5", config), None, stats),
+    }
+    monkeypatch.setattr(core, "_process_sample", lambda input_file, tmpdir, config, record: results[input_file])
+    # a failed alignment may be the tool's fault, samples skipped by triage fail because of their reads
+    assert core._cache_entry("A1", str(tmp_path), config)["failed"]
+    assert "failed" not in core._cache_entry("A2", str(tmp_path), config)
+
+
+def test_cache_only_when_needed(tmp_path, make_config):
+    # single runs without a cache directory don't hash their inputs
+    assert core.setup_cache(make_config()) is None
+    assert core.setup_cache(make_config(cache_dir=str(tmp_path), no_cache=True)) is None
+    reference = tmp_path / "ref.fasta"
+    reference.write_text(">ref\nACGT\n")
+    assert core.setup_cache(make_config(cache_dir=str(tmp_path), reference=str(reference))).use_disk
+    assert not core.setup_cache(make_config(), max_entries=10).use_disk
+
+
+def test_find_samples_shard(tmp_path, make_config):
+    names = [f"A{i}.fasta" for i in range(50)]
+    for name in names:
+        (tmp_path / name).write_text(">x\nACGT\n")
+
+    shards = []
+    for index in range(1, 4):
+        config = make_config(reads=str(tmp_path), shard=(index, 3))
+        shards.append([sample.name for sample in core.find_samples(str(tmp_path), config)])
+    assert all(shards)
+    assert sorted(names) == sorted(name for shard in shards for name in shard)
+    # the split only depends on the file names
+    assert shards[0] == [name for name in sorted(names) if core.in_shard(name, (1, 3))]
+
+
+def test_find_samples_grouped(tmp_path, make_config):
+    for name in ("S1_F.fasta", "S1_R.fasta", "S2_F.fasta", "S3.fasta"):
+        (tmp_path / name).write_text(">x\nACGT\n")
+
+    config = make_config(reads=str(tmp_path), group_pattern=r"^(.+)_[FR]\.")
+    samples = core.find_samples(str(tmp_path), config)
+    assert ["S1.fasta", "S2.fasta", "S3.fasta"] == [sample.name for sample in samples]
+    assert 2 == len(samples[0].members)
+
+    # shards split the grouped samples, keeping the reads of a sample together
+    config = make_config(reads=str(tmp_path), group_pattern=r"^(.+)_[FR]\.", shard=(1, 2))
+    shard = core.find_samples(str(tmp_path), config)
+    assert [name for name in ("S1.fasta", "S2.fasta", "S3.fasta") if core.in_shard(name, (1, 2))] == \
+        [sample.name for sample in shard]
+
+
+def test_read_through_pipe(tmp_path, make_config):
+    fifo = tmp_path / "reads.fastq"
+    cmd = [sys.executable, "-c", "import sys; open(sys.argv[1], 'w').write('@r\\nACGT\\n+\\nIIII\\n')", str(fifo)]
+    assert b"@r\nACGT\n+\nIIII\n" == core.read_through_pipe(cmd, str(fifo), make_config())
+    assert not fifo.exists()
+
+
+def test_read_through_pipe_failure(tmp_path, make_config):
+    fifo = tmp_path / "reads.fastq"
+    # the tool fails without ever opening its output
+    with pytest.raises(subprocess.CalledProcessError):
+        core.read_through_pipe([sys.executable, "-c", "raise SystemExit(1)"], str(fifo), make_config())
+    assert not fifo.exists()
+
+
+def test_score_to_ratio():
+    assert "1:1" == core._score_to_ratio(0)
+    assert "1:3" == core._score_to_ratio(4)
+    assert "1:8" == core._score_to_ratio(9)
+    assert "1:10" == core._score_to_ratio(10)
+    assert "1:20" == core._score_to_ratio(13)
+    assert "1:10 000" == core._score_to_ratio(40)
@@ -0,0 +1,98 @@
+"""Test building and caching reference indices."""
+
+import pathlib
+
+from Bio import SeqIO
+
+from covid_spike_classification import core, index, pileup
+
+REFERENCE = pathlib.Path(__file__).parent.parent / "ref" / "NC_045512.fasta"
+
+
+def _fake_build(fasta, prefix, threads, quiet):
+    pathlib.Path(f"{prefix}.1.bt2").write_text(pathlib.Path(fasta).read_text())
+
+
+def test_amplicon_window():
+    entries = {"NC_045512": (29903, 11, 70, 71)}
+    assert ("NC_045512", 21811, 24758) == index.amplicon_window(core.CODONS, 1000, entries)
+    assert ("NC_045512", 1, 29903) == index.amplicon_window(core.CODONS, 30000, entries)
+
+
+def test_legacy_index_used(tmp_path, monkeypatch):
+    reference = tmp_path / "ref.fasta"
+    reference.write_text(">chr\nACGT\n")
+    (tmp_path / "ref.fasta.fai").write_text("chr\t4\t5\t4\t5\n")
+    (tmp_path / "ref.index.1.bt2").write_text("")
+    monkeypatch.setattr(index, "_bowtie2_build", None)
+
+    ref_index = index.ensure_index(str(reference), str(tmp_path / "cache"))
+    assert ref_index.prefix == str(tmp_path / "ref.index")
+    assert ref_index.fasta == str(reference)
+    assert not ref_index.is_amplicon
+
+
+def test_index_built_once(tmp_path, monkeypatch):
+    reference = tmp_path / "ref.fasta"
+    reference.write_text(">chr\nACGT\n")
+    builds = []
+
+    def fake_build(*args):
+        builds.append(args)
+        _fake_build(*args)
+
+    monkeypatch.setattr(index, "_bowtie2_build", fake_build)
+    cache_dir = tmp_path / "cache"
+    first = index.ensure_index(str(reference), str(cache_dir))
+    second = index.ensure_index(str(reference), str(cache_dir))
+    assert len(builds) == 1
+    assert first.prefix == second.prefix
+    assert pathlib.Path(f"{first.prefix}.1.bt2").exists()
+    # no .fai next to the reference, so a copy with one is used for pileups
+    assert first.fasta != str(reference)
+    assert "chr\t4\t5\t4\t5\n" == pathlib.Path(f"{first.fasta}.fai").read_text()
+
+
+def test_amplicon_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, "_bowtie2_build", _fake_build)
+    ref_index = index.ensure_index(str(REFERENCE), str(tmp_path), core.CODONS, amplicon_margin=100)
+    assert ref_index.is_amplicon
+    assert ref_index.chrom == "NC_045512"
+    assert ref_index.offset == 22710
+    assert ref_index.length == 29903
+
+    amplicon = SeqIO.read(f"{ref_index.prefix}.1.bt2", "fasta")
+    genome = SeqIO.read(REFERENCE, "fasta")
+    assert amplicon.id == "NC_045512"
+    assert str(amplicon.seq) == str(genome.seq[22710:23858])
+
+
+def test_lift_sam():
+    ref_index = index.ReferenceIndex("amplicon.index", "ref.fasta", "NC_045512", 22710, 29903)
+    sam = (b"@HD\tVN:1.0\tSO:unsorted\n"
+           b"@SQ\tSN:NC_045512\tLN:1148\n"
+           b"read\t0\tNC_045512\t90\t42\t4M\t=\t95\t0\tACGT\tIIII\n"
+           b"unmapped\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII\n")
+    expected = (b"@HD\tVN:1.0\tSO:unsorted\n"
+                b"@SQ\tSN:NC_045512\tLN:29903\n"
+                b"read\t0\tNC_045512\t22800\t42\t4M\t=\t22805\t0\tACGT\tIIII\n"
+                b"unmapped\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII\n")
+    assert expected == index.lift_sam(sam, ref_index)
+
+    alignment, = pileup.parse_sam(index.lift_sam(sam, ref_index).splitlines()[2:3])
+    assert alignment.position == 22800
+
+    assert sam == index.lift_sam(sam, index.ReferenceIndex("ref.index", "ref.fasta"))
+
+
+def test_amplicon_index_per_regions(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, "_bowtie2_build", _fake_build)
+    codons = index.ensure_index(str(REFERENCE), str(tmp_path), core.CODONS, amplicon_margin=100)
+    scan = index.ensure_index(str(REFERENCE), str(tmp_path), core.SCAN_REGIONS, amplicon_margin=100)
+    # a wider window is a separate index, not the cached one with another offset
+    assert scan.prefix != codons.prefix
+    assert scan.offset < codons.offset
+    amplicon = SeqIO.read(f"{scan.prefix}.1.bt2", "fasta")
+    assert len(amplicon.seq) > 23858 - 22710
+    genome = SeqIO.read(REFERENCE, "fasta")
+    assert str(amplicon.seq) == str(genome.seq[scan.offset:scan.offset + len(amplicon.seq)])
@@ -0,0 +1,90 @@
+"""Test resuming runs from their journal."""
+
+import pytest
+
+from covid_spike_classification import core, journal
+from covid_spike_classification.archive import InputFile, OutputDirectory
+
+
+def _row(input_file):
+    return [core._sample_id(input_file.name)] + ["0"] * len(core.REGIONS) + [""]
+
+
+def _input(tmp_path, name, content=">x\nACGT\n"):
+    path = tmp_path / name
+    path.write_text(content)
+    return InputFile.from_path(str(path))
+
+
+def test_journal(tmp_path):
+    path = tmp_path / "out" / journal.JOURNAL
+    input_file = _input(tmp_path, "A1.ab1")
+    run_journal = journal.Journal(str(path), "context")
+    record = run_journal.lookup(input_file)
+    assert record.fastq is None and record.entry is None
+    run_journal.record(record, "basecall", "@A1\n")
+    run_journal.record(record, "failed", "tracy crashed")
+
+    # a line cut short by a crash is ignored
+    with open(path, "a") as handle:
+        handle.write('{"sample": "A1.ab1", "dig')
+    record = journal.Journal(str(path), "context").lookup(input_file)
+    assert record.fastq == "@A1\n"
+    assert record.entry is None
+
+    # changed input files start over
+    assert journal.Journal(str(path), "context").lookup(_input(tmp_path, "A1.ab1", "changed")).fastq is None
+
+    with pytest.raises(journal.JournalError):
+        journal.Journal(str(path), "other context")
+
+
+def test_resume(tmp_path, monkeypatch, make_config):
+    good = _input(tmp_path, "A1.fasta")
+    bad = _input(tmp_path, "A2.fasta")
+    processed = []
+
+    def fake_process(input_file, tmpdir, config, record=None):
+        processed.append(input_file.name)
+        if input_file.name == "A2.fasta" and len(processed) < 3:
+            raise core.TranslationError("Codon 'A*G' is invalid")
+        return _row(input_file), None, None
+
+    monkeypatch.setattr(core, "_process_sample", fake_process)
+    outdir = tmp_path / "out"
+
+    def run():
+        config = make_config(outdir=str(outdir), resume=True)
+        config._output = OutputDirectory(str(outdir))
+        core.setup_journal(config, context="context")
+        return [core.process_sample(input_file, str(tmp_path), config) for input_file in (good, bad)]
+
+    rows = run()
+    assert rows[0] == _row(good)
+    assert rows[1][1:-1] == ["NA"] * len(core.REGIONS)
+    assert rows[1][-1] == "failed to process: TranslationError: Codon 'A*G' is invalid"
+    assert processed == ["A1.fasta", "A2.fasta"]
+
+    # the finished sample is taken from the journal, the failed one is retried
+    assert run() == [_row(good), _row(bad)]
+    assert processed == ["A1.fasta", "A2.fasta", "A2.fasta"]
+    assert run() == [_row(good), _row(bad)]
+    assert processed == ["A1.fasta", "A2.fasta", "A2.fasta"]
+
+
+def test_resume_basecalled(tmp_path, monkeypatch, make_config):
+    input_file = _input(tmp_path, "A1.ab1", "ab1 data")
+    config = make_config(outdir=str(tmp_path / "out"), input_format="ab1", resume=True, no_fastqs=True)
+    core.setup_journal(config, context="context")
+    record = config._journal.lookup(input_file)
+    config._journal.record(record, "basecall", "@A1\nACGT\n+\nIIII\n")
+
+    def fail_basecall(*args):
+        raise AssertionError("basecalled again")
+
+    mapped = []
+    monkeypatch.setattr(core, "basecall_reads", fail_basecall)
+    monkeypatch.setattr(core, "map_file", lambda sequence_file, scratch_dir, config, reads: mapped.append(reads))
+    monkeypatch.setattr(core, "classify_bam", lambda bam_file, config: _row(input_file))
+    assert _row(input_file) == core.process_sample(input_file, str(tmp_path), config)
+    assert mapped == ["@A1\nACGT\n+\nIIII\n"]
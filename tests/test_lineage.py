@@ -0,0 +1,72 @@
+"""Test assigning lineages from mutation profiles."""
+
+import pathlib
+
+import pytest
+
+from covid_spike_classification import core, lineage
+from covid_spike_classification.archive import OutputDirectory
+
+LINEAGES = str(pathlib.Path(__file__).parent.parent / "ref" / "lineages.csv")
+
+
+def _cells(found=(), unknown=()):
+    return ["NA" if variant in unknown else "1" if variant in found else "0" for variant in core.REGIONS]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return lineage.LineageIndex.from_file(LINEAGES)
+
+
+def test_assign(index):
+    alpha = ["N501Y", "A570D", "D614G", "P681H", "T716I"]
+    assert ("B.1.1.7", "1.00") == index.assign(_cells(alpha))
+    # optional mutations are allowed
+    assert "B.1.1.7" == index.assign(_cells(alpha + ["E484K"]))[0]
+    assert ("B.1", "1.00") == index.assign(_cells(["D614G"]))
+    assert ("B", "1.00") == index.assign(_cells())
+    # a found mutation no lineage has
+    assert ("unassigned", "0") == index.assign(_cells(["D614G", "Y453F"]))
+    assert ("NA", "0") == index.assign(_cells(unknown=core.REGIONS))
+
+
+def test_assign_unknown(index):
+    unknown = ["E484K", "E484Q", "E484A", "N501Y", "L452R", "L452M"]
+    # required mutations that were called but not found rule a lineage out
+    assert "B.1.1.7" not in index.assign(_cells(["D614G", "P681H"], unknown))[0].split()
+    # unknown ones only lower the confidence, optional mutations don't count
+    name, confidence = index.assign(_cells(["D614G", "A570D", "P681H", "T716I"], unknown))
+    assert name == "B.1.1.7"
+    assert float(confidence) == pytest.approx(1 - 5 / (len(core.REGIONS) - 1), abs=0.01)
+
+    # lineages tying on all criteria are listed together
+    ties = lineage.LineageIndex([("X", ["D614G"], []), ("Y", ["D614G"], [])])
+    assert ("X Y", "1.00") == ties.assign(_cells(["D614G"]))
+
+
+def test_read_lineages(tmp_path):
+    path = tmp_path / "lineages.csv"
+    path.write_text("# comment\nlineage,required,optional\nA,N501Y D614G,E484K\n,,\n")
+    assert [("A", ["N501Y", "D614G"], ["E484K"])] == lineage.read_lineages(str(path))
+
+    path.write_text("lineage,required\nA,N501Y X123Y\n")
+    with pytest.raises(lineage.LineageError, match="X123Y"):
+        lineage.read_lineages(str(path))
+    path.write_text("lineage,required\nA,N501Y\nA,D614G\n")
+    with pytest.raises(lineage.LineageError, match="twice"):
+        lineage.read_lineages(str(path))
+    path.write_text("name,mutations\nA,N501Y\n")
+    with pytest.raises(lineage.LineageError):
+        lineage.read_lineages(str(path))
+
+
+def test_write_results_lineage_columns(tmp_path, make_config):
+    config = make_config(outdir=str(tmp_path), lineages=LINEAGES)
+    config._output = OutputDirectory(str(tmp_path))
+    lineage.setup_lineages(config)
+    core.write_results([["A1"] + _cells(["D614G"]) + ["D614G found (1:10 000)"]], config)
+
+    header, row = (tmp_path / "results.csv").read_text().splitlines()
+    assert header.split(",")[-3:] == ["lineage", "lineage_confidence", "comment"]
+    assert row.split(",")[-3:] == ["B.1", "1.00", "D614G found (1:10 000)"]
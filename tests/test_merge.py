@@ -0,0 +1,115 @@
+"""Test merging the outputs of sharded runs."""
+
+import json
+import zipfile
+
+import pytest
+
+from covid_spike_classification import core, merge, triage
+from covid_spike_classification.archive import OutputDirectory
+from covid_spike_classification.__main__ import parse_args, parse_shard
+
+HEADER = ",".join(core.result_columns())
+
+
+def _row(sample, comment=""):
+    return ",".join([sample] + ["0"] * len(core.REGIONS) + [comment])
+
+
+def _write_shard(path, index, count, rows, files=None, inputs=None):
+    path.mkdir()
+    (path / "results.csv").write_text("".join(f"{line}\n" for line in [HEADER] + rows))
+    info = {"shard": index, "shards": count}
+    if inputs is not None:
+        info["inputs"] = inputs
+    (path / core.SHARD_INFO).write_text(json.dumps(info))
+    (path / "metrics.json").write_text("{}")
+    for name, content in (files or {}).items():
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text(content)
+
+
+def test_merge(tmp_path):
+    failed = ",".join(["C1"] + ["NA"] * len(core.REGIONS) + ["read failed to align"])
+    _write_shard(tmp_path / "shard1", 1, 2, [_row("A1"), failed], {"C1.ab1.fastq": "@C1\n"})
+    _write_shard(tmp_path / "shard2", 2, 2, [_row("A2"), _row("B1")], {"bams/A2.fasta.bam": "bam"})
+
+    merge.merge([str(tmp_path / "shard2"), str(tmp_path / "shard1")], str(tmp_path / "out"))
+    lines = (tmp_path / "out" / "results.csv").read_text().splitlines()
+    assert lines == [HEADER, _row("A1"), _row("A2"), _row("B1"), failed]
+    assert (tmp_path / "out" / "C1.ab1.fastq").read_text() == "@C1\n"
+    assert (tmp_path / "out" / "bams" / "A2.fasta.bam").read_text() == "bam"
+    assert not (tmp_path / "out" / "metrics.json").exists()
+    assert not (tmp_path / "out" / core.SHARD_INFO).exists()
+    assert not (tmp_path / "out" / triage.TRIAGE_FILE).exists()
+
+
+def test_merge_input_order(tmp_path, make_config):
+    reads = tmp_path / "reads"
+    reads.mkdir()
+    for name in ("A1.fasta", "A1-2.fasta", "B1.fasta"):
+        (reads / name).write_text(">x\nACGT\n")
+    shards = []
+    for index in (1, 2):
+        config = make_config(reads=str(reads), input_format="fasta", shard=(index, 2), outdir=str(tmp_path))
+        config._output = OutputDirectory(str(tmp_path / f"info{index}"))
+        core.write_shard_info(config)
+        info = json.loads((tmp_path / f"info{index}" / core.SHARD_INFO).read_text())
+        samples = [sample for sample, _ in info["inputs"]]
+        _write_shard(tmp_path / f"shard{index}", index, 2, [_row(sample) for sample in samples],
+                     inputs=info["inputs"])
+        shards.append(str(tmp_path / f"shard{index}"))
+
+    merge.merge(shards, str(tmp_path / "out"))
+    lines = (tmp_path / "out" / "results.csv").read_text().splitlines()
+    # like a single run, ordered by file name: 'A1-2.fasta' < 'A1.fasta'
+    assert lines == [HEADER, _row("A1-2"), _row("A1"), _row("B1")]
+
+
+def test_merge_triage(tmp_path):
+    header = "sample,reads,failure"
+    _write_shard(tmp_path / "shard1", 1, 2, [_row("B1")], {triage.TRIAGE_FILE: f"{header}\nB1,0,no reads\n"})
+    _write_shard(tmp_path / "shard2", 2, 2, [_row("A1")], {triage.TRIAGE_FILE: f"{header}\nA1,1,\n"})
+
+    merge.merge([str(tmp_path / "shard1"), str(tmp_path / "shard2")], str(tmp_path / "out"))
+    lines = (tmp_path / "out" / triage.TRIAGE_FILE).read_text().splitlines()
+    assert lines == [header, "A1,1,", "B1,0,no reads"]
+
+
+def test_merge_zips(tmp_path):
+    for index, sample in ((1, "B1"), (2, "A1")):
+        with zipfile.ZipFile(tmp_path / f"shard{index}.zip", "w") as zip_file:
+            zip_file.writestr("results.csv", f"{HEADER}\n{_row(sample)}\n")
+            zip_file.writestr(core.SHARD_INFO, json.dumps({"shard": index, "shards": 2}))
+
+    merge.merge([str(tmp_path / "shard1.zip"), str(tmp_path / "shard2.zip")], str(tmp_path / "out"),
+                zip_results=True)
+    with zipfile.ZipFile(tmp_path / "out.zip") as zip_file:
+        assert zip_file.namelist() == ["results.csv"]
+        assert zip_file.read("results.csv").decode("utf-8").splitlines() == [HEADER, _row("A1"), _row("B1")]
+
+
+def test_merge_incomplete(tmp_path):
+    _write_shard(tmp_path / "shard1", 1, 3, [_row("A1")])
+    _write_shard(tmp_path / "shard3", 3, 3, [_row("A3")])
+    with pytest.raises(merge.MergeError, match="Missing shards: 2"):
+        merge.merge([str(tmp_path / "shard1"), str(tmp_path / "shard3")], str(tmp_path / "out"))
+    with pytest.raises(merge.MergeError, match="more than once"):
+        merge.merge([str(tmp_path / "shard1"), str(tmp_path / "shard1"), str(tmp_path / "shard3")],
+                    str(tmp_path / "out"))
+
+
+def test_merge_different_columns(tmp_path):
+    _write_shard(tmp_path / "shard1", 1, 2, [_row("A1")])
+    _write_shard(tmp_path / "shard2", 2, 2, [])
+    (tmp_path / "shard2" / "results.csv").write_text(",".join(core.result_columns(scan=True)) + "\n")
+    with pytest.raises(merge.MergeError, match="different columns"):
+        merge.merge([str(tmp_path / "shard1"), str(tmp_path / "shard2")], str(tmp_path / "out"))
+
+
+def test_parse_shard():
+    assert (2, 4) == parse_shard("2/4")
+    assert (2, 4) == parse_args(["reads", "--shard", "2/4"]).shard
+    for invalid in ("0/4", "5/4", "2", "a/b"):
+        with pytest.raises(Exception):
+            parse_shard(invalid)
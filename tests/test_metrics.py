@@ -0,0 +1,127 @@
+"""Test the run metrics."""
+
+import marshal
+import signal
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from covid_spike_classification import core, metrics
+
+
+def test_stage_metrics():
+    run_metrics = metrics.RunMetrics()
+    with run_metrics.stage("map"):
+        pass
+    with pytest.raises(RuntimeError):
+        with run_metrics.stage("map"):
+            raise RuntimeError("failed")
+    run_metrics.add("call", 2.0, 1.5)
+
+    totals = run_metrics.as_dict()["stages"]
+    assert totals["map"]["calls"] == 2
+    assert totals["map"]["wall"] >= 0
+    assert totals["call"] == {"calls": 1, "wall": 2.0, "cpu": 1.5}
+
+
+def test_stage_without_metrics(make_config):
+    config = make_config()
+    with metrics.stage(config, "map"):
+        pass
+    metrics.count(config, "cache_hits")
+
+    config._metrics = metrics.RunMetrics()
+    with metrics.stage(config, "map"):
+        pass
+    metrics.count(config, "cache_hits")
+    assert config._metrics.as_dict()["stages"]["map"]["calls"] == 1
+    assert config._metrics.as_dict()["counters"]["cache_hits"] == 1
+
+
+def test_samples_per_thread():
+    run_metrics = metrics.RunMetrics()
+
+    def work(name):
+        with run_metrics.sample(name), run_metrics.stage("pileup"):
+            pass
+
+    threads = [threading.Thread(target=work, args=(f"sample{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with run_metrics.stage("report"):
+        pass
+
+    result = run_metrics.as_dict()
+    assert sorted(result["samples"]) == ["sample0", "sample1", "sample2", "sample3"]
+    for sample in result["samples"].values():
+        assert list(sample["stages"]) == ["pileup"]
+    assert result["stages"]["pileup"]["calls"] == 4
+    assert result["stages"]["report"]["calls"] == 1
+
+
+def test_tracked_processes(make_config):
+    config = make_config()
+    config._metrics = metrics.RunMetrics()
+    with config._metrics.sample("sample1"):
+        assert 0 == metrics.call_tool(config, [sys.executable, "-c", "pass"])
+        with pytest.raises(subprocess.CalledProcessError):
+            metrics.check_call_tool(config, [sys.executable, "-c", "raise SystemExit(3)"])
+        process = metrics.popen(config, [sys.executable, "-c", "print('hi')"], stdout=subprocess.PIPE)
+        assert b"hi\n" == process.communicate()[0]
+        assert 0 == process.returncode
+        process = metrics.popen(config, [sys.executable, "-c", "import time; time.sleep(60)"])
+        process.kill()
+        assert -signal.SIGKILL == process.wait()
+
+    result = config._metrics.as_dict()
+    tool = metrics.tool_name([sys.executable])
+    assert result["tools"][tool]["calls"] == 4
+    assert result["tools"][tool]["failures"] == 2
+    assert result["tools"][tool]["max_rss"] > 0
+    processes = result["samples"]["sample1"]["processes"]
+    assert [process["exit_status"] for process in processes] == [0, 3, 0, -signal.SIGKILL]
+    assert all(process["cpu"] >= 0 and process["wall"] > 0 for process in processes)
+
+
+def test_tool_name():
+    assert "samtools sort" == metrics.tool_name(["samtools", "sort", "-m", "64M", "-"])
+    assert "bowtie2" == metrics.tool_name(["/usr/bin/bowtie2", "-x", "ref.index"])
+    assert "tracy basecall" == metrics.tool_name(["tracy", "basecall", "-f", "fastq"])
+
+
+def test_prometheus():
+    run_metrics = metrics.RunMetrics()
+    run_metrics.add("map", 1.5, 0.5)
+    run_metrics.add_process(None, ["samtools", "index", "a.bam"], 0.25, 0.125, 2048, 1)
+    run_metrics.count("cache_hits", 2)
+
+    text = run_metrics.to_prometheus()
+    assert text.endswith("\n")
+    lines = text.splitlines()
+    assert 'csc_stage_wall_seconds_total{stage="map"} 1.5' in lines
+    assert 'csc_tool_failures_total{tool="samtools index"} 1' in lines
+    assert 'csc_tool_max_rss_bytes{tool="samtools index"} 2048' in lines
+    assert "csc_cache_hits_total 2" in lines
+    assert "# TYPE csc_tool_max_rss_bytes gauge" in lines
+
+
+def test_profile():
+    assert metrics.RunMetrics().profile_stats() is None
+
+    run_metrics = metrics.RunMetrics(profile=True)
+    with run_metrics.run(), run_metrics.sample("sample1"):
+        core.translate("ATG")
+    stats = marshal.loads(run_metrics.profile_stats())
+    assert any(function == "translate" for _, _, function in stats)
+
+
+def test_build_row_counts_failed_pileups(make_config):
+    config = make_config(silence_warnings=True)
+    config._metrics = metrics.RunMetrics()
+    calls = {region: core.PileupFailedError() for region in core.CODONS}
+    core.build_row("sample1", calls, config, "sample1.bam")
+    assert config._metrics.as_dict()["counters"]["pileup_failed"] == len(core.REGIONS)
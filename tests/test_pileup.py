@@ -0,0 +1,238 @@
+"""Test the native pileup engine."""
+
+import gzip
+import pathlib
+import struct
+
+import pytest
+
+from Bio import SeqIO
+
+from covid_spike_classification import core, pileup
+
+DATA_DIR = pathlib.Path(__file__).parent / "data"
+REFERENCE = pathlib.Path(__file__).parent.parent / "ref" / "NC_045512.fasta"
+AMPLICON_START = 22799
+
+
+@pytest.fixture
+def config(make_config):
+    return make_config(pileup_engine="native", reference=str(REFERENCE), silence_warnings=True)
+
+
+def _sam_line(name, sequence, position=AMPLICON_START, cigar=None, flag=0, qualities=None):
+    if cigar is None:
+        cigar = f"{len(sequence)}M"
+    if qualities is None:
+        qualities = "I" * len(sequence)
+    return "\t".join([name, str(flag), "NC_045512", str(position), "42", cigar, "*", "0", "0",
+                      sequence, qualities]) + "\n"
+
+
+def _amplicon(name):
+    return str(SeqIO.read(DATA_DIR / f"{name}.fasta", "fasta").seq)
+
+
+def _codon_calls(bam_file, config):
+    return core._call_chunks(core.codon_columns(bam_file, config), core.parse_columns, bam_file)
+
+
+def _bam_record(position, cigar, sequence, flag=0):
+    name = b"read\0"
+    cigar_values = [length << 4 | pileup.CIGAR_OPS.index(op) for op, length in cigar]
+    packed = bytearray()
+    for i in range(0, len(sequence), 2):
+        high = pileup.BAM_SEQ_CODES.index(sequence[i])
+        low = pileup.BAM_SEQ_CODES.index(sequence[i + 1]) if i + 1 < len(sequence) else 0
+        packed.append(high << 4 | low)
+    body = struct.pack("<iiBBHHHiiii", 0, position - 1, len(name), 42, 0, len(cigar), flag, len(sequence),
+                       -1, -1, 0)
+    body += name + struct.pack(f"<{len(cigar)}I", *cigar_values) + bytes(packed) + bytes([40] * len(sequence))
+    return struct.pack("<i", len(body)) + body
+
+
+def test_fasta_index_matches_built_index():
+    reference = pileup.FastaIndex(str(REFERENCE))
+    built = pileup.build_fai(reference._map)
+    assert list(built) == ["NC_045512"]
+    length, _, line_bases, _ = built["NC_045512"]
+    assert length == 29903
+    assert line_bases == 70
+
+    sequence = str(SeqIO.read(REFERENCE, "fasta").seq)
+    assert sequence[22810:22813] == reference.fetch("NC_045512", 22811, 22813)
+    assert sequence[:75] == reference.fetch("NC_045512", 1, 75)
+    assert sequence[-5:] == reference.fetch("NC_045512", 29899, 29910)
+
+
+def test_parse_cigar():
+    assert [("S", 3), ("M", 10), ("D", 1), ("M", 2)] == pileup.parse_cigar("3S10M1D2M")
+    assert [] == pileup.parse_cigar("*")
+
+
+@pytest.mark.parametrize("fasta", sorted(DATA_DIR.glob("*.fasta")), ids=lambda path: path.stem)
+def test_native_engine_finds_mutation(fasta, tmp_path, config):
+    mutation = fasta.stem
+    sam_file = tmp_path / "sample.sam"
+    sam_file.write_text(_sam_line(mutation, _amplicon(mutation)))
+
+    parts = core.classify_bam(str(sam_file), config)
+    row = dict(zip(core.result_columns(), parts))
+    for variant in core.REGIONS:
+        expected = "1" if variant == mutation else "0"
+        assert row[variant] == expected, variant
+    assert f"{mutation} found" in row["comment"]
+
+
+def test_native_engine_handles_deletion_and_soft_clip(tmp_path, config):
+    sequence = _amplicon("E484K")
+    deletion = 23012 - AMPLICON_START
+    # soft-clip the first five bases and delete the first base of codon 484
+    clipped = "NNNNN" + sequence[:deletion] + sequence[deletion + 1:]
+    cigar = f"5S{deletion}M1D{len(sequence) - deletion - 1}M"
+    sam_file = tmp_path / "sample.sam"
+    sam_file.write_text(_sam_line("del", clipped, cigar=cigar))
+
+    calls = _codon_calls(str(sam_file), config)
+    assert isinstance(calls["NC_045512:23012-23014"], core.BaseDeletedError)
+    assert calls["NC_045512:23063-23065"][0] == calls["NC_045512:23063-23065"][1]
+
+
+def test_native_engine_read_ends(tmp_path, config):
+    sequence = _amplicon("N501Y")
+    # read ends in the middle of codon 501
+    end = 23064 - AMPLICON_START
+    sam_file = tmp_path / "sample.sam"
+    sam_file.write_text(_sam_line("short", sequence[:end]))
+
+    calls = _codon_calls(str(sam_file), config)
+    assert isinstance(calls["NC_045512:23063-23065"], core.PileupFailedError)
+    assert isinstance(calls["NC_045512:23756-23758"], core.PileupFailedError)
+    assert calls["NC_045512:23012-23014"] == ("E", "E", [(40, False)] * 3)
+
+
+def test_native_engine_quality_filter_and_strand():
+    reference = pileup.load_reference(str(REFERENCE))
+    sequence = _amplicon("N501Y")
+    qualities = [40] * len(sequence)
+    qualities[23063 - AMPLICON_START] = 2
+    low = pileup.Alignment("NC_045512", AMPLICON_START, 0, [("M", len(sequence))], sequence, qualities)
+    reverse = pileup.Alignment("NC_045512", AMPLICON_START + 1, pileup.FLAG_REVERSE,
+                               [("M", len(sequence) - 1)], sequence[1:], [30] * (len(sequence) - 1))
+    unmapped = pileup.Alignment("NC_045512", AMPLICON_START, 0x4, [("M", 5)], "NNNNN", [40] * 5)
+
+    columns = pileup.pileup_columns(reference, [reverse, low, unmapped], ["NC_045512:23063-23065"])
+    assert [("A", "t", 30), ("A", "A", 40), ("T", "T", 40)] == columns["NC_045512:23063-23065"]
+
+
+def test_native_engine_combine():
+    reference = pileup.load_reference(str(REFERENCE))
+    sequence = _amplicon("N501Y")
+    # the forward read is unsure about codon 501, the reverse read isn't
+    qualities = [40] * len(sequence)
+    qualities[23063 - AMPLICON_START] = 20
+    forward = pileup.Alignment("NC_045512", AMPLICON_START, 0, [("M", len(sequence))], sequence, qualities)
+    reverse = pileup.Alignment("NC_045512", AMPLICON_START, pileup.FLAG_REVERSE, [("M", len(sequence))],
+                               sequence, [30] * len(sequence))
+
+    region = "NC_045512:23063-23065"
+    first = pileup.pileup_columns(reference, [forward, reverse], [region])
+    assert [("A", "T", 20), ("A", "A", 40), ("T", "T", 40)] == first[region]
+    combined = pileup.pileup_columns(reference, [forward, reverse], [region], combine=True)
+    assert [("A", "t", 30), ("A", "A", 40), ("T", "T", 40)] == combined[region]
+
+
+@pytest.mark.parametrize("combine", [False, True])
+def test_native_engine_matches_samtools(combine):
+    # mpileup.txt is the output of samtools mpileup -B, like core.pileup_regions runs it, for sample.sam,
+    # see generate_mpileup.sh. The reads cover forward and reverse strands, soft clips, a deletion, an
+    # insertion, a base below samtools' minimum base quality and a read ending within codon 501.
+    reference = pileup.load_reference(str(REFERENCE))
+    sam = (DATA_DIR / "pileup" / "sample.sam").read_bytes()
+    native = pileup.pileup_columns(reference, list(core.parse_sam(sam.splitlines())), core.CODONS, combine=combine)
+    pileups = core.split_pileup((DATA_DIR / "pileup" / "mpileup.txt").read_text(), core.CODONS)
+
+    for region in core.CODONS:
+        # calls only use the first three columns, samtools' are cut off there
+        assert core.pileup_to_columns(pileups[region], combine) == native[region][:3], region
+
+
+def test_pileup_regions_without_baq(monkeypatch, config):
+    commands = []
+
+    class FakeMpileup:
+        def communicate(self):
+            return b"", None
+
+    def fake_popen(config, cmd, **kwargs):
+        commands.append(cmd)
+        return FakeMpileup()
+
+    monkeypatch.setattr(core, "popen", fake_popen)
+    core.pileup_regions(str(REFERENCE), "sample.bam", core.CODONS, config)
+    # one run over all codons, with the read's own base qualities like the native engine
+    assert len(commands) == 1
+    assert "-B" in commands[0]
+
+
+def test_pileup_to_columns_combine():
+    pileup_text = "\n".join([
+        "NC_045512\t23063\tA\t2\t^].t\t5?",
+        "NC_045512\t23064\tA\t2\t.+2AG,\tI?",
+        "NC_045512\t23065\tT\t2\t*,$\tI?",
+    ])
+    # read starts and ends, indels and deletions are skipped over, bases beat deletions
+    expected = [("A", "t", 30), ("A", "A", 40), ("T", "T", 30)]
+    assert expected == core.pileup_to_columns(pileup_text, combine=True)
+
+
+def test_read_bam(tmp_path, config):
+    sequence = _amplicon("D614G")
+    header = b"BAM\1" + struct.pack("<i", 0) + struct.pack("<i", 1)
+    header += struct.pack("<i", 10) + b"NC_045512\0" + struct.pack("<i", 29903)
+    bam_file = tmp_path / "sample.bam"
+    bam_file.write_bytes(gzip.compress(header + _bam_record(AMPLICON_START, [("M", len(sequence))], sequence)))
+
+    alignments = pileup.read_alignments(str(bam_file))
+    assert len(alignments) == 1
+    assert alignments[0].reference_name == "NC_045512"
+    assert alignments[0].position == AMPLICON_START
+    assert alignments[0].sequence == sequence
+    assert alignments[0].qualities == [40] * len(sequence)
+
+    calls = _codon_calls(str(bam_file), config)
+    assert calls["NC_045512:23402-23404"][:2] == ("D", "G")
+
+
+def test_classify_sam(monkeypatch, config):
+    sam = "@HD\tVN:1.0\n" + _sam_line("P681R", _amplicon("P681R"))
+    monkeypatch.setattr(core, "align_file", lambda sequence_file, config, reads=None: sam.encode("utf-8"))
+
+    parts = core.classify_sam("/tmp/P681R.fasta", config)
+    row = dict(zip(core.result_columns(), parts))
+    assert row["sample"] == "P681R"
+    assert row["P681R"] == "1"
+    assert row["P681H"] == "0"
+
+
+def test_classify_sam_failed(monkeypatch, config):
+    monkeypatch.setattr(core, "align_file", lambda sequence_file, config, reads=None: None)
+
+    parts = core.classify_sam("/tmp/broken.fasta", config)
+    assert parts[0] == "broken"
+    assert parts[1:-1] == ["NA"] * len(core.REGIONS)
+    assert parts[-1] == "read failed to align"
+
+
+def test_scan_lists_all_substitutions(tmp_path, make_config):
+    sam_file = tmp_path / "sample.sam"
+    sam_file.write_text(_sam_line("P681R", _amplicon("P681R")))
+    config = make_config(pileup_engine="native", reference=str(REFERENCE), silence_warnings=True, scan=True)
+
+    parts = core.classify_bam(str(sam_file), config)
+    row = dict(zip(core.result_columns(scan=True), parts))
+    assert row["P681R"] == "1"
+    assert row["substitutions"] == "P681R"
+
+    parts = core._failed_row("failed", "read failed to align", config)
+    assert len(parts) == len(core.result_columns(scan=True))
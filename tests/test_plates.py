@@ -0,0 +1,102 @@
+"""Test processing several plates in one run."""
+
+import zipfile
+
+import pytest
+
+from covid_spike_classification import core, plates
+
+
+def _fake_process(input_file, tmpdir, config):
+    return [core._sample_id(input_file.name)] + ["0"] * len(core.REGIONS) + [config.outdir]
+
+
+def test_read_manifest(tmp_path):
+    manifest = tmp_path / "plates.txt"
+    manifest.write_text("# backlog\nplate1.zip\n\n/data/plate2\tsecond\n")
+    assert [(str(tmp_path / "plate1.zip"), None), ("/data/plate2", "second")] == plates.read_manifest(manifest)
+
+
+def test_plate_name():
+    assert "plate1" == plates.plate_name("/data/plate1.zip")
+    assert "plate2" == plates.plate_name("/data/plate2/")
+
+
+def test_interleave():
+    first = plates.Plate("first", None)
+    first.samples = ["a", "b", "c"]
+    second = plates.Plate("second", None)
+    second.samples = ["x"]
+    assert [(first, "a"), (second, "x"), (first, "b"), (first, "c")] == plates.interleave([first, second])
+
+
+def test_setup_plates_duplicate_names(monkeypatch, make_config):
+    monkeypatch.setattr(plates, "setup_index", lambda config: None)
+    config = make_config()
+    with pytest.raises(ValueError):
+        plates.setup_plates([("a/plate.zip", None), ("b/plate", None)], config)
+
+
+def test_plates(tmp_path, monkeypatch, make_config):
+    (tmp_path / "plate1").mkdir()
+    for name in ("A2", "A1"):
+        (tmp_path / "plate1" / f"{name}.fasta").write_text(f">{name}\nACGT\n")
+    with zipfile.ZipFile(tmp_path / "plate2.zip", "w") as zip_file:
+        zip_file.writestr("B1.fasta", ">B1\nACGT\n")
+
+    monkeypatch.setattr(core, "process_sample", _fake_process)
+    monkeypatch.setattr(plates, "setup_index", lambda config: None)
+    outdir = tmp_path / "out"
+    config = make_config(outdir=str(outdir), jobs=2)
+    plates.main(config, [(str(tmp_path / "plate1"), None), (str(tmp_path / "plate2.zip"), "second")],
+                combined=True)
+
+    first = (outdir / "plate1" / "results.csv").read_text().splitlines()
+    assert first[0] == ",".join(core.result_columns())
+    assert [line.split(",")[0] for line in first[1:]] == ["A1", "A2"]
+    assert first[1].endswith(str(outdir / "plate1"))
+    second = (outdir / "second" / "results.csv").read_text().splitlines()
+    assert [line.split(",")[0] for line in second[1:]] == ["B1"]
+
+    combined = (outdir / "results.csv").read_text().splitlines()
+    assert combined[0] == ",".join(["plate"] + core.result_columns())
+    assert sorted(line.split(",")[:2] for line in combined[1:]) == [
+        ["plate1", "A1"], ["plate1", "A2"], ["second", "B1"]]
+
+
+def test_plates_zip_results(tmp_path, monkeypatch, make_config):
+    for plate in ("plate1", "plate2"):
+        (tmp_path / plate).mkdir()
+        (tmp_path / plate / "A1.fasta").write_text(">A1\nACGT\n")
+
+    monkeypatch.setattr(core, "process_sample", _fake_process)
+    monkeypatch.setattr(plates, "setup_index", lambda config: None)
+    outdir = tmp_path / "out"
+    config = make_config(outdir=str(outdir), zip_results=True)
+    plates.main(config, [(str(tmp_path / "plate1"), None), (str(tmp_path / "plate2"), None)])
+
+    for plate in ("plate1", "plate2"):
+        with zipfile.ZipFile(outdir / f"{plate}.zip") as zip_file:
+            assert ["results.csv"] == zip_file.namelist()
+    assert not (outdir / "results.csv").exists()
+
+
+def test_plates_stdout_batch_calling(tmp_path, monkeypatch, make_config, capsys):
+    pytest.importorskip("numpy")
+    for plate in ("plate1", "plate2"):
+        (tmp_path / plate).mkdir()
+        for name in ("A1", "A2"):
+            (tmp_path / plate / f"{name}.fasta").write_text(f">{name}\nACGT\n")
+    monkeypatch.setattr(core, "process_sample", _fake_process)
+    monkeypatch.setattr(plates, "setup_index", lambda config: None)
+
+    printed = []
+    for batch_calling in (False, True):
+        outdir = tmp_path / f"out-{batch_calling}"
+        config = make_config(outdir=str(outdir), stdout=True, batch_calling=batch_calling)
+        plates.main(config, [(str(tmp_path / "plate1"), None), (str(tmp_path / "plate2"), None)])
+        printed.append(capsys.readouterr().out.replace(str(outdir), "<outdir>"))
+    # both print one row per sample, prefixed with its plate
+    assert printed[0] == printed[1]
+    assert [line.split(",")[:2] for line in printed[1].splitlines()] == [
+        ["plate1", "A1"], ["plate2", "A1"], ["plate1", "A2"], ["plate2", "A2"]]
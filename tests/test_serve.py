@@ -0,0 +1,119 @@
+"""Test the HTTP classification service."""
+
+import gzip
+import io
+import json
+import pathlib
+import threading
+import urllib.error
+import urllib.request
+import zipfile
+
+import pytest
+
+from covid_spike_classification import classifier, core, index, metrics, serve
+from covid_spike_classification.config import CSCConfig
+
+DATA_DIR = pathlib.Path(__file__).parent / "data"
+REFERENCE = str(pathlib.Path(__file__).parent.parent / "ref" / "NC_045512.fasta")
+
+
+def _fake_build(fasta, prefix, threads, quiet):
+    pathlib.Path(f"{prefix}.1.bt2").write_text("")
+
+
+class FakeClassifier:
+    def __init__(self):
+        self.config = CSCConfig.__new__(CSCConfig)
+        self.config._metrics = None
+        self.config.jobs = 1
+        self.batches = []
+
+    def classify(self, inputs):
+        self.batches.append(list(inputs))
+        if b"bad" in inputs:
+            raise ValueError("bad input")
+        return [f"result {item.decode()}" for item in inputs]
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, "_bowtie2_build", _fake_build)
+    with classifier.Classifier(REFERENCE, index_dir=str(tmp_path / "indices"), jobs=2, fast_path=True) as csc:
+        csc.config._metrics = metrics.RunMetrics(per_sample=False)
+        batcher = serve.MicroBatcher(csc, batch_size=4, batch_wait=0.01, queue_size=4)
+        batcher.start()
+        http_server = serve.ClassifyServer(("127.0.0.1", 0), batcher)
+        thread = threading.Thread(target=http_server.serve_forever)
+        thread.start()
+        try:
+            yield f"http://127.0.0.1:{http_server.server_address[1]}"
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+            thread.join()
+            batcher.stop()
+
+
+def _post(url, body):
+    with urllib.request.urlopen(urllib.request.Request(url, data=body)) as response:
+        return response.read()
+
+
+def test_classify_upload(server):
+    fasta = (DATA_DIR / "N501Y.fasta").read_bytes()
+    results = json.loads(_post(f"{server}/classify?name=S1.fasta", fasta))["results"]
+    assert ["S1"] == [result["sample"] for result in results]
+    assert results[0]["calls"]["N501Y"] == "1"
+
+    plate = io.BytesIO()
+    with zipfile.ZipFile(plate, "w") as zip_file:
+        zip_file.writestr("plate/E484K.fasta", (DATA_DIR / "E484K.fasta").read_bytes())
+        zip_file.writestr("K417N.fasta.gz", gzip.compress((DATA_DIR / "K417N.fasta").read_bytes()))
+        zip_file.writestr("notes.txt", "not reads")
+    csv = _post(f"{server}/classify?format=csv", plate.getvalue()).decode("utf-8").splitlines()
+    assert csv[0] == ",".join(core.result_columns())
+    rows = [line.split(",") for line in csv[1:]]
+    assert ["E484K", "K417N"] == [row[0] for row in rows]
+    assert rows[0][list(core.REGIONS).index("E484K") + 1] == "1"
+
+
+def test_health_and_metrics(server):
+    _post(f"{server}/classify", (DATA_DIR / "D614G.fasta").read_bytes())
+    with urllib.request.urlopen(f"{server}/health") as response:
+        health = json.loads(response.read())
+    assert health["status"] == "ok"
+    assert health["queue_size"] == 4
+    with urllib.request.urlopen(f"{server}/metrics") as response:
+        text = response.read().decode("utf-8")
+    assert "csc_requests_total 1" in text.splitlines()
+    assert "csc_samples 1" in text.splitlines()
+    assert "csc_queued_requests 0" in text.splitlines()
+
+
+def test_bad_upload(server):
+    with pytest.raises(urllib.error.HTTPError) as err:
+        _post(f"{server}/classify", b"not reads")
+    assert err.value.code == 400
+
+
+def test_micro_batches():
+    fake = FakeClassifier()
+    batcher = serve.MicroBatcher(fake, batch_size=3, batch_wait=1, queue_size=8)
+    jobs = [serve.Job([b"a", b"b"]), serve.Job([b"bad"]), serve.Job([b"c"])]
+    for job in jobs:
+        batcher._queue.put(job)
+    batcher._classify(batcher._next_batch())
+
+    # the failing request is retried alone, the others still get their results
+    assert jobs[0].results == ["result a", "result b"]
+    assert isinstance(jobs[1].error, ValueError)
+    assert jobs[2].results is None
+    assert fake.batches[0] == [b"a", b"b", b"bad"]
+
+
+def test_backpressure():
+    batcher = serve.MicroBatcher(FakeClassifier(), queue_size=1)
+    batcher._queue.put(serve.Job([b"a"]))
+    with pytest.raises(serve.ServerBusy):
+        batcher.submit([b"b"])
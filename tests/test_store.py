@@ -0,0 +1,117 @@
+"""Test the SQLite results store."""
+
+import pathlib
+
+import pytest
+
+from covid_spike_classification import core, store
+from covid_spike_classification.archive import InputData, OutputDirectory
+
+REFERENCE = str(pathlib.Path(__file__).parent.parent / "ref" / "NC_045512.fasta")
+
+
+def _row(sample, found=(), comment=""):
+    cells = ["1" if variant in found else "0" for variant in core.REGIONS]
+    comment = "; ".join([f"{variant} found (1:10 000)" for variant in found] + ([comment] if comment else []))
+    return [sample] + cells + [comment]
+
+
+def _add(result_store, config, parts, digest=None):
+    return result_store.add(parts, config, digest or f"digest-{parts[0]}")
+
+
+def test_add_is_idempotent(tmp_path, make_config):
+    path = str(tmp_path / "results.db")
+    config = make_config(reference=REFERENCE, outdir=str(tmp_path / "run1"), reads="plate1.zip")
+    result_store = store.ResultStore(path)
+    assert _add(result_store, config, _row("A1", ["E484K", "N501Y"]))
+    assert _add(result_store, config, _row("A2"))
+    assert not _add(result_store, config, _row("A1", ["E484K", "N501Y"]))
+    result_store.close()
+
+    # rerunning the plate stores nothing, not even a run
+    result_store = store.ResultStore(path)
+    rerun = make_config(reference=REFERENCE, outdir=str(tmp_path / "run2"), reads="plate1.zip")
+    assert not _add(result_store, rerun, _row("A1", ["E484K", "N501Y"]))
+    # a changed input file or other settings are a new result
+    assert _add(result_store, rerun, _row("A1", ["E484K"]), "other digest")
+    other = make_config(reference=REFERENCE, outdir=str(tmp_path / "run3"), show_unexpected=True)
+    assert _add(result_store, other, _row("A2"))
+
+    results = list(result_store.query())
+    assert [(1, "A1"), (1, "A2"), (2, "A1"), (3, "A2")] == [(run, sample) for run, _, sample, *_ in results]
+    assert results[0][3]["E484K"] == "1"
+    assert result_store._db.execute("SELECT ratio FROM calls WHERE mutation = 'N501Y' AND call = '1'").fetchall() \
+        == [("1:10 000",)]
+    result_store.close()
+
+
+def test_query(tmp_path, make_config):
+    result_store = store.ResultStore(str(tmp_path / "results.db"))
+    config = make_config(reference=REFERENCE, outdir=str(tmp_path / "run1"))
+    _add(result_store, config, _row("A1", ["E484K", "N501Y"]))
+    _add(result_store, config, _row("A2", ["E484K"]))
+    _add(result_store, config, _row("A3", comment="read failed to align"))
+
+    assert ["A1", "A2"] == [result[2] for result in result_store.query(found=["E484K"])]
+    assert ["A1"] == [result[2] for result in result_store.query(found=["E484K", "N501Y"])]
+    assert ["A3"] == [result[2] for result in result_store.query(samples=["A3"])]
+    assert [] == list(result_store.query(since="2999-01-01"))
+    assert 3 == len(list(result_store.query(since="2000-01-01", runs=[1])))
+
+    rows = list(store.export_rows(result_store.query(samples=["A3"])))
+    assert rows == [_row("A3", comment="read failed to align")]
+    rows = list(store.export_rows(result_store.query(samples=["A3"]), scan=True, with_run=True))
+    assert rows[0][:3] == ["1", result_store._db.execute("SELECT started FROM runs").fetchone()[0], "A3"]
+    assert rows[0][-2:] == ["NA", "read failed to align"]
+    result_store.close()
+
+
+def test_rows_committed_per_sample(tmp_path, make_config):
+    path = str(tmp_path / "results.db")
+    result_store = store.ResultStore(path)
+    config = make_config(reference=REFERENCE, outdir=str(tmp_path / "run1"))
+    _add(result_store, config, _row("A1", ["E484K"]))
+    # another connection sees the row while the run is still going, like after a crash
+    reader = store.ResultStore(path)
+    assert ["A1"] == [result[2] for result in reader.query()]
+    reader.close()
+    result_store.close()
+
+
+def test_version_mismatch(tmp_path):
+    path = str(tmp_path / "results.db")
+    result_store = store.ResultStore(path)
+    result_store._db.execute("UPDATE info SET value = '0' WHERE key = 'version'")
+    result_store.close()
+    with pytest.raises(store.StoreError):
+        store.ResultStore(path)
+
+
+def test_write_results_stores_rows(tmp_path, make_config, capsys):
+    config = make_config(reference=REFERENCE, outdir=str(tmp_path / "out"), store=str(tmp_path / "results.db"))
+    config._output = OutputDirectory(config.outdir)
+    store.setup_store(config)
+    for sample in ("A1", "A2"):
+        config._digests.append(InputData(f"{sample}.fasta", sample.encode("utf-8")).digest())
+    core.write_results([_row("A1", ["K417N"]), _row("A2")], config)
+    config._store.close()
+
+    store.main([str(tmp_path / "results.db"), "--found", "K417N"])
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == [",".join(core.result_columns()), ",".join(_row("A1", ["K417N"]))]
+
+
+def test_inputs_sharing_a_sample_id_stored(tmp_path, monkeypatch, make_config, capsys):
+    config = make_config(reference=REFERENCE, outdir=str(tmp_path / "out"), store=str(tmp_path / "results.db"),
+                         jobs=2)
+    config._output = OutputDirectory(config.outdir)
+    store.setup_store(config)
+    monkeypatch.setattr(core, "_process_sample",
+                        lambda input_file, tmpdir, config, record: (_row(core._sample_id(input_file.name)), None, None))
+    inputs = [InputData(name, name.encode("utf-8")) for name in ("X.F.fasta", "X.R.fasta")]
+    core.write_results(core.iter_samples(inputs, str(tmp_path), config), config)
+    config._store.close()
+
+    store.main([str(tmp_path / "results.db"), "--sample", "X"])
+    assert len(capsys.readouterr().out.splitlines()) == 3
@@ -0,0 +1,66 @@
+"""Test the native ab1 basecaller."""
+
+import pathlib
+import sys
+
+import pytest
+
+from Bio import SeqIO
+
+from covid_spike_classification import core, trace
+from covid_spike_classification.archive import InputData, InputGroup
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent / "data"))
+
+from generate_trace import write_abif  # noqa: E402
+
+DATA_DIR = pathlib.Path(__file__).parent / "data"
+
+
+def _trace(tmp_path, name, read, qualities):
+    path = tmp_path / name
+    write_abif(str(path), name, read, qualities)
+    return path
+
+
+def test_mott_trim():
+    assert (2, 6) == trace.mott_trim([5, 5, 30, 30, 30, 30, 5, 5])
+    assert (0, 3) == trace.mott_trim([40, 40, 40])
+    assert (0, 0) == trace.mott_trim([2, 2, 2])
+    assert (0, 0) == trace.mott_trim([])
+
+
+def test_decode_trace(tmp_path):
+    read = "ACGTACGTNACGTACGT"
+    qualities = [3, 4] + [35] * (len(read) - 4) + [2, 2]
+    data = _trace(tmp_path, "S1.ab1", read, qualities).read_bytes()
+
+    assert f"@S1.ab1\n{read[2:-2]}\n+\n{'D' * (len(read) - 4)}\n" == trace.decode_trace(data, "S1.ab1")
+    untrimmed = trace.decode_trace(data, "S1.ab1", trim=False).splitlines()
+    assert [read, "$%"] == [untrimmed[1], untrimmed[3][:2]]
+
+    with pytest.raises(ValueError, match="not an ab1 file"):
+        trace.decode_trace(b">S1\nACGT\n", "S1.fasta")
+
+
+def test_decode_fixture():
+    # tests/data/traces/N501Y.ab1 holds N501Y.fasta with 20 bases of quality 5 on both ends
+    read = str(SeqIO.read(DATA_DIR / "N501Y.fasta", "fasta").seq)
+    name, sequence, plus, qualities = trace.decode_trace((DATA_DIR / "traces" / "N501Y.ab1").read_bytes(),
+                                                         "N501Y.ab1").splitlines()
+    assert (name, sequence, plus) == ("@N501Y.ab1", read[20:-20], "+")
+    assert set(qualities) == {"I"}
+
+
+def test_basecall_native(tmp_path, make_config):
+    config = make_config(input_format="ab1", basecaller="native")
+    forward = _trace(tmp_path, "S1_F.ab1", "ACGTACGT", [30] * 8)
+    reverse = _trace(tmp_path, "S1_R.ab1", "TTGGCCAA", [30] * 8)
+
+    fastq = core.basecall_reads(str(forward), str(tmp_path), config)
+    assert fastq == "@S1_F.ab1\nACGTACGT\n+\n????????\n"
+    # grouped and in-memory reads are decoded without materializing them
+    group = InputGroup("S1", [InputData("S1_F.ab1", forward.read_bytes()), InputData("S1_R.ab1", reverse.read_bytes())])
+    combined = core._basecall_input(group, None, str(tmp_path), config)
+    assert combined == fastq + "@S1_R.ab1\nTTGGCCAA\n+\n????????\n"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["S1_F.ab1", "S1_R.ab1"]
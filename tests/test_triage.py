@@ -0,0 +1,78 @@
+"""Test triaging reads before alignment."""
+
+import pathlib
+
+from Bio import SeqIO
+from Bio.Seq import reverse_complement
+
+from covid_spike_classification import core, triage
+from covid_spike_classification.archive import InputData, OutputDirectory
+
+DATA_DIR = pathlib.Path(__file__).parent / "data"
+REFERENCE = str(pathlib.Path(__file__).parent.parent / "ref" / "NC_045512.fasta")
+
+
+def _amplicon(name):
+    return str(SeqIO.read(DATA_DIR / f"{name}.fasta", "fasta").seq)
+
+
+def _stats(reads, sequence_format="fastq"):
+    return triage.read_stats(reads, sequence_format, REFERENCE, tuple(core.CODONS))
+
+
+def test_trim_ends():
+    assert (2, 5) == triage.trim_ends([5, 10, 30, 40, 20, 19, 3])
+    assert (0, 3) == triage.trim_ends([30, 30, 30])
+    assert (3, 3) == triage.trim_ends([1, 2, 3])
+
+
+def test_read_stats():
+    sequence = _amplicon("N501Y")
+    qualities = "#" * 10 + "I" * (len(sequence) - 20) + "#" * 10
+    stats = _stats(f"@read\n{sequence}\n+\n{qualities}\n")
+    assert stats["reads"] == 1
+    assert stats["length"] == len(sequence)
+    assert stats["trimmed_length"] == len(sequence) - 20
+    assert stats["trimmed_quality"] == 40
+    assert stats["mean_quality"] < 40
+    assert stats["n_fraction"] == 0
+    assert stats["anchored_codons"] > 0
+
+    # reverse reads span the same codons, fasta reads count as quality 40
+    reverse = _stats(f">read\n{reverse_complement(sequence)}\n", "fasta")
+    assert reverse["anchored_codons"] == stats["anchored_codons"]
+    assert reverse["mean_quality"] == 40
+
+    empty = _stats("")
+    assert (0, 1, 0) == (empty["reads"], empty["n_fraction"], empty["anchored_codons"])
+
+
+def test_triage_failure(make_config):
+    config = make_config(triage=True)
+    stats = _stats(f">read\n{_amplicon('N501Y')}\n", "fasta")
+    assert triage.triage_failure(stats, config) is None
+    assert triage.triage_failure(dict(stats, reads=0), config) == "no reads"
+    assert triage.triage_failure(dict(stats, trimmed_length=50), config) == "trimmed read length 50 < 100"
+    assert triage.triage_failure(dict(stats, trimmed_quality=8.5), config) == "trimmed mean quality 8.5 < 10"
+    assert triage.triage_failure(dict(stats, n_fraction=0.75), config) == "N fraction 0.75 > 0.5"
+    assert triage.triage_failure(dict(stats, anchored_codons=0), config) == "reads span 0 tracked codons < 1"
+
+
+def test_triage_skips_sample(tmp_path, make_config):
+    config = make_config(triage=True, fast_path=True, reference=REFERENCE, outdir=str(tmp_path))
+    config._output = OutputDirectory(str(tmp_path))
+    reads = InputData("S1.fasta", f">S1\n{'N' * 300}\n".encode("utf-8"))
+
+    parts = core.process_sample(reads, str(tmp_path), config)
+    assert parts[1:-1] == ["NA"] * len(core.REGIONS)
+    assert parts[-1] == "skipped by triage: N fraction 1.0 > 0.5"
+
+    passed = InputData("S2.fasta", f">S2\n{_amplicon('N501Y')}\n".encode("utf-8"))
+    assert core.process_sample(passed, str(tmp_path), config)[-1].endswith("called via anchored fast path")
+
+    core.write_triage(config)
+    lines = (tmp_path / triage.TRIAGE_FILE).read_text().splitlines()
+    assert lines[0] == ",".join(("sample",) + triage.STATS + ("failure",))
+    assert [line.split(",")[0] for line in lines[1:]] == ["S1", "S2"]
+    assert lines[1].endswith(",N fraction 1.0 > 0.5")
+    assert lines[2].endswith(",")
@@ -0,0 +1,95 @@
+"""Test the watch folder mode."""
+
+import os
+import threading
+import time
+import types
+import zipfile
+
+import pytest
+
+from covid_spike_classification import core, watch
+from covid_spike_classification.__main__ import WATCH_CONFLICTS, parse_args
+
+
+def test_ready_files():
+    previous = {"a.fasta": (10, 1.0), "b.fasta": (5, 1.0)}
+    current = {"a.fasta": (10, 1.0), "b.fasta": (8, 2.0), "c.fasta": (1, 3.0)}
+    assert ["a.fasta"] == watch.ready_files(previous, current)
+
+
+@pytest.mark.parametrize("option", sorted(WATCH_CONFLICTS))
+def test_watch_conflicts(option, capsys):
+    flag = f"--{option.replace('_', '-')}"
+    value = {"group_pattern": ["(.+)"], "lineages": ["lineages.csv"], "shard": ["1/2"], "store": ["results.db"]}
+    with pytest.raises(SystemExit):
+        parse_args(["--watch", "drop", flag, *value.get(option, [])])
+    assert f"{flag} can't be combined with --watch" in capsys.readouterr().err
+
+
+def test_run_name():
+    assert "plate1" == watch.run_name(os.path.join("plate1", "sub", "a.ab1"))
+    assert "plate2" == watch.run_name("plate2.zip")
+
+
+def _wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_watch(tmp_path, monkeypatch, make_config):
+    drop_dir = tmp_path / "drop"
+    outdir = tmp_path / "out"
+    (drop_dir / "plate1").mkdir(parents=True)
+    (drop_dir / "plate1" / "A1.fasta").write_text(">A1\nACGT\n")
+    with zipfile.ZipFile(drop_dir / "plate2.zip", "w") as zip_file:
+        zip_file.writestr("B1.fasta", ">B1\nACGT\n")
+        zip_file.writestr("B2.fasta", ">B2\nACGT\n")
+        zip_file.writestr("notes.txt", "ignored")
+
+    processed = []
+
+    def fake_process(input_file, tmpdir, config):
+        processed.append(input_file.name)
+        return [core._sample_id(input_file.name)] + ["0"] * len(core.REGIONS) + [""]
+
+    monkeypatch.setattr(watch, "process_sample", fake_process)
+    monkeypatch.setattr(watch, "setup_index", lambda config: None)
+    config = make_config(watch=str(drop_dir), outdir=str(outdir), jobs=2)
+    evictions = []
+    monkeypatch.setattr(watch, "setup_cache", lambda config, max_entries: setattr(
+        config, "_cache", types.SimpleNamespace(max_entries=max_entries, evict=lambda: evictions.append(True))))
+    stop = threading.Event()
+    thread = threading.Thread(target=watch.watch, args=(config, 0.05, stop))
+    thread.start()
+    try:
+        assert _wait_for(lambda: len(processed) == 3)
+        (drop_dir / "plate1" / "A2.fasta").write_text(">A2\nACGT\n")
+        assert _wait_for(lambda: len(processed) == 4)
+        assert _wait_for(lambda: len((outdir / watch.LEDGER).read_text().splitlines()) == 3)
+        # the cache is trimmed while the daemon runs, not only once it stops
+        assert _wait_for(lambda: evictions)
+    finally:
+        stop.set()
+        thread.join()
+    assert config._cache.max_entries == watch.MAX_CACHED_SAMPLES
+
+    assert ["A1.fasta", "A2.fasta", "B1.fasta", "B2.fasta"] == sorted(processed)
+    plate1 = (outdir / "plate1" / "results.csv").read_text().splitlines()
+    assert plate1[0].startswith("sample,")
+    assert sorted(line.split(",")[0] for line in plate1[1:]) == ["A1", "A2"]
+    plate2 = (outdir / "plate2" / "results.csv").read_text().splitlines()
+    assert sorted(line.split(",")[0] for line in plate2[1:]) == ["B1", "B2"]
+
+    # a restart doesn't pick up already processed files again
+    stop = threading.Event()
+    thread = threading.Thread(target=watch.watch, args=(config, 0.05, stop))
+    thread.start()
+    time.sleep(0.3)
+    stop.set()
+    thread.join()
+    assert len(processed) == 4